@@ -8,6 +8,7 @@ import transaction
 
 from ntorque.model import CreateApplication
 from ntorque.model import GetActiveKey
+from ntorque.model import TASK_PRIORITIES
 
 from ntorque.work.main import Bootstrap
 
@@ -16,6 +17,12 @@ def parse_args():
     
     parser = argparse.ArgumentParser()
     parser.add_argument('--name')
+    parser.add_argument('--priority', default=u'normal',
+            choices=TASK_PRIORITIES, help='default task priority')
+    parser.add_argument('--share', type=int, default=1,
+            help='fair scheduling weight')
+    parser.add_argument('--max-in-flight', type=int,
+            help='maximum number of tasks to perform at once')
     args = parser.parse_args()
     if not args.name:
         raise ValueError(parser.format_help())
@@ -38,6 +45,9 @@ def main():
     get_key = GetActiveKey()
     with transaction.manager:
         app = create_app(name)
+        app.default_priority = args.priority.decode('utf8')
+        app.share = args.share
+        app.max_in_flight = args.max_in_flight
         api_key = get_key(app).value
     
     print u'Created application with API key: {0}\n'.format(api_key)
@@ -0,0 +1,76 @@
+"""Add ``ntorque_topics``, ``ntorque_subscriptions`` and ``ntorque_payloads``
+  and the ``payload_id`` column on ``ntorque_tasks``.
+
+  Revision ID: 1f3c5a9b2d7e
+  Revises: 32ee88d6d6d
+  Created: 2026-10-19 09:12:41.503118
+"""
+
+# Revision identifiers, used by Alembic.
+revision = '1f3c5a9b2d7e'
+down_revision = '32ee88d6d6d'
+
+from alembic import op
+import sqlalchemy as sa
+
+from sqlalchemy.dialects import postgresql
+
+def upgrade():
+    op.create_table('ntorque_topics',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('c', sa.DateTime(), nullable=False),
+        sa.Column('m', sa.DateTime(), nullable=False),
+        sa.Column('v', sa.Integer(), nullable=False),
+        sa.Column('is_active', sa.Boolean(), nullable=False),
+        sa.Column('is_deleted', sa.Boolean(), nullable=False),
+        sa.Column('activated', sa.DateTime(), nullable=True),
+        sa.Column('deactivated', sa.DateTime(), nullable=True),
+        sa.Column('deleted', sa.DateTime(), nullable=True),
+        sa.Column('undeleted', sa.DateTime(), nullable=True),
+        sa.Column('app_id', sa.Integer(), nullable=True),
+        sa.Column('name', sa.Unicode(length=96), nullable=False),
+        sa.ForeignKeyConstraint(['app_id'], ['ntorque_applications.id'], ),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_topics', 'ntorque_topics', ['app_id', 'name'],
+            unique=True)
+    op.create_table('ntorque_subscriptions',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('c', sa.DateTime(), nullable=False),
+        sa.Column('m', sa.DateTime(), nullable=False),
+        sa.Column('v', sa.Integer(), nullable=False),
+        sa.Column('is_active', sa.Boolean(), nullable=False),
+        sa.Column('is_deleted', sa.Boolean(), nullable=False),
+        sa.Column('activated', sa.DateTime(), nullable=True),
+        sa.Column('deactivated', sa.DateTime(), nullable=True),
+        sa.Column('deleted', sa.DateTime(), nullable=True),
+        sa.Column('undeleted', sa.DateTime(), nullable=True),
+        sa.Column('topic_id', sa.Integer(), nullable=False),
+        sa.Column('url', sa.Unicode(length=256), nullable=False),
+        sa.Column('method', postgresql.ENUM(u'DELETE', u'PATCH', u'POST', u'PUT',
+                name='ntorque_request_methods', create_type=False),
+                nullable=False),
+        sa.Column('timeout', sa.Integer(), nullable=True),
+        sa.ForeignKeyConstraint(['topic_id'], ['ntorque_topics.id'], ),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_table('ntorque_payloads',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('c', sa.DateTime(), nullable=False),
+        sa.Column('m', sa.DateTime(), nullable=False),
+        sa.Column('v', sa.Integer(), nullable=False),
+        sa.Column('charset', sa.Unicode(length=24), nullable=False),
+        sa.Column('enctype', sa.Unicode(length=256), nullable=False),
+        sa.Column('body', sa.UnicodeText(), nullable=True),
+        sa.Column('headers', sa.UnicodeText(), nullable=True),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.add_column('ntorque_tasks', sa.Column('payload_id', sa.Integer(),
+            sa.ForeignKey('ntorque_payloads.id'), nullable=True))
+
+def downgrade():
+    op.drop_column('ntorque_tasks', 'payload_id')
+    op.drop_table('ntorque_payloads')
+    op.drop_table('ntorque_subscriptions')
+    op.drop_index('ix_topics', 'ntorque_topics')
+    op.drop_table('ntorque_topics')
@@ -0,0 +1,27 @@
+"""Add task ``expires`` deadline and the ``EXPIRED`` status.
+
+  Revision ID: 2a7d9e4f1c85
+  Revises: 4b8e0d2c6a13
+  Created: 2026-10-19 12:21:54.640317
+"""
+
+# Revision identifiers, used by Alembic.
+revision = '2a7d9e4f1c85'
+down_revision = '4b8e0d2c6a13'
+
+from alembic import op
+import sqlalchemy as sa
+
+def upgrade():
+    # ``ALTER TYPE ... ADD VALUE`` can't run inside a transaction block.
+    op.execute('COMMIT')
+    op.execute("ALTER TYPE ntorque_task_statuses ADD VALUE 'EXPIRED'")
+    op.add_column('ntorque_tasks', sa.Column('expires', sa.DateTime(),
+            nullable=True))
+    op.create_index('ix_ntorque_tasks_status_due_expires', 'ntorque_tasks',
+            ['status', 'due', 'expires'])
+
+def downgrade():
+    op.drop_index('ix_ntorque_tasks_status_due_expires', 'ntorque_tasks')
+    op.drop_column('ntorque_tasks', 'expires')
+    # Note that postgres doesn't support removing a value from an enum type.
@@ -0,0 +1,20 @@
+"""Add a partial index on the due date of pending tasks.
+
+  Revision ID: 3e7b9c2d4f58
+  Revises: 6d2f4a8c1b93
+  Created: 2026-10-19 16:21:52.640127
+"""
+
+# Revision identifiers, used by Alembic.
+revision = '3e7b9c2d4f58'
+down_revision = '6d2f4a8c1b93'
+
+from alembic import op
+import sqlalchemy as sa
+
+def upgrade():
+    op.create_index('ix_ntorque_tasks_pending_due', 'ntorque_tasks', ['due'],
+            postgresql_where=sa.text("status = 'PENDING'"))
+
+def downgrade():
+    op.drop_index('ix_ntorque_tasks_pending_due', 'ntorque_tasks')
@@ -0,0 +1,47 @@
+"""Add task ``priority`` and application ``default_priority``.
+
+  Revision ID: 4b8e0d2c6a13
+  Revises: 1f3c5a9b2d7e
+  Created: 2026-10-19 11:02:17.224861
+"""
+
+# Revision identifiers, used by Alembic.
+revision = '4b8e0d2c6a13'
+down_revision = '1f3c5a9b2d7e'
+
+from alembic import op
+import sqlalchemy as sa
+
+from sqlalchemy.sql import table, column
+
+from ntorque.model.orm import Task
+
+def upgrade():
+    bind = op.get_bind()
+    typ = Task.__table__.c.priority.type
+    impl = typ.dialect_impl(bind.dialect)
+    impl.create(bind, checkfirst=True)
+    for table_name, column_name in (('ntorque_tasks', 'priority'),
+            ('ntorque_applications', 'default_priority')):
+        # Add with ``nullable=True``.
+        op.add_column(
+            table_name,
+            sa.Column(
+                column_name,
+                sa.Enum(
+                    u'high', u'normal', u'low',
+                    name='ntorque_task_priorities'
+                ),
+                nullable=True
+            )
+        )
+        # Set the default value.
+        rows = table(table_name, column(column_name))
+        op.execute(rows.update().values({column_name: u'normal'}))
+        # Now we can set ``nullable=False``.
+        op.alter_column(table_name, column_name, nullable=False)
+
+def downgrade():
+    op.drop_column('ntorque_applications', 'default_priority')
+    op.drop_column('ntorque_tasks', 'priority')
+    sa.Enum(name='ntorque_task_priorities').drop(op.get_bind(), checkfirst=False)
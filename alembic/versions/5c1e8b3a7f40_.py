@@ -0,0 +1,20 @@
+"""Add task ``token`` used to asynchronously complete or fail tasks.
+
+  Revision ID: 5c1e8b3a7f40
+  Revises: 2a7d9e4f1c85
+  Created: 2026-10-19 13:47:09.118502
+"""
+
+# Revision identifiers, used by Alembic.
+revision = '5c1e8b3a7f40'
+down_revision = '2a7d9e4f1c85'
+
+from alembic import op
+import sqlalchemy as sa
+
+def upgrade():
+    op.add_column('ntorque_tasks', sa.Column('token', sa.Unicode(length=40),
+            nullable=True))
+
+def downgrade():
+    op.drop_column('ntorque_tasks', 'token')
@@ -0,0 +1,57 @@
+"""Add ``ntorque_endpoints`` and the ``endpoint_id`` and ``path`` columns on
+  ``ntorque_tasks``, making the task ``url`` nullable.
+
+  Revision ID: 6d2f4a8c1b93
+  Revises: 5c1e8b3a7f40
+  Created: 2026-10-19 15:02:36.274910
+"""
+
+# Revision identifiers, used by Alembic.
+revision = '6d2f4a8c1b93'
+down_revision = '5c1e8b3a7f40'
+
+from alembic import op
+import sqlalchemy as sa
+
+from sqlalchemy.dialects import postgresql
+
+def upgrade():
+    op.create_table('ntorque_endpoints',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('c', sa.DateTime(), nullable=False),
+        sa.Column('m', sa.DateTime(), nullable=False),
+        sa.Column('v', sa.Integer(), nullable=False),
+        sa.Column('is_active', sa.Boolean(), nullable=False),
+        sa.Column('is_deleted', sa.Boolean(), nullable=False),
+        sa.Column('activated', sa.DateTime(), nullable=True),
+        sa.Column('deactivated', sa.DateTime(), nullable=True),
+        sa.Column('deleted', sa.DateTime(), nullable=True),
+        sa.Column('undeleted', sa.DateTime(), nullable=True),
+        sa.Column('app_id', sa.Integer(), nullable=True),
+        sa.Column('name', sa.Unicode(length=96), nullable=False),
+        sa.Column('url', sa.Unicode(length=256), nullable=False),
+        sa.Column('method', postgresql.ENUM(u'DELETE', u'PATCH', u'POST', u'PUT',
+                name='ntorque_request_methods', create_type=False),
+                nullable=False),
+        sa.Column('headers', sa.UnicodeText(), nullable=True),
+        sa.Column('timeout', sa.Integer(), nullable=True),
+        sa.Column('max_retries', sa.Integer(), nullable=True),
+        sa.ForeignKeyConstraint(['app_id'], ['ntorque_applications.id'], ),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_endpoints', 'ntorque_endpoints', ['app_id', 'name'],
+            unique=True)
+    op.add_column('ntorque_tasks', sa.Column('endpoint_id', sa.Integer(),
+            sa.ForeignKey('ntorque_endpoints.id'), nullable=True))
+    op.add_column('ntorque_tasks', sa.Column('path', sa.Unicode(length=256),
+            nullable=True))
+    op.alter_column('ntorque_tasks', 'url', existing_type=sa.Unicode(length=256),
+            nullable=True)
+
+def downgrade():
+    op.alter_column('ntorque_tasks', 'url', existing_type=sa.Unicode(length=256),
+            nullable=False)
+    op.drop_column('ntorque_tasks', 'path')
+    op.drop_column('ntorque_tasks', 'endpoint_id')
+    op.drop_index('ix_endpoints', 'ntorque_endpoints')
+    op.drop_table('ntorque_endpoints')
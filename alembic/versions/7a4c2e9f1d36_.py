@@ -0,0 +1,24 @@
+"""Add application ``share`` and ``max_in_flight`` used for fair scheduling.
+
+  Revision ID: 7a4c2e9f1d36
+  Revises: 3e7b9c2d4f58
+  Created: 2026-10-19 17:08:44.913205
+"""
+
+# Revision identifiers, used by Alembic.
+revision = '7a4c2e9f1d36'
+down_revision = '3e7b9c2d4f58'
+
+from alembic import op
+import sqlalchemy as sa
+
+def upgrade():
+    op.add_column('ntorque_applications', sa.Column('share', sa.Integer(),
+            nullable=False, server_default='1'))
+    op.alter_column('ntorque_applications', 'share', server_default=None)
+    op.add_column('ntorque_applications', sa.Column('max_in_flight',
+            sa.Integer(), nullable=True))
+
+def downgrade():
+    op.drop_column('ntorque_applications', 'max_in_flight')
+    op.drop_column('ntorque_applications', 'share')
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+
+"""Use this script from the command line to compare how fast tasks can be
+  dequeued and acquired using the Redis notification path and by claiming
+  batches of due tasks straight from the database.
+
+  Neither path calls the web hooks: this just measures dequeue + acquire.
+  Configure ``DATABASE_URL`` and ``REDIS_URL`` as per the README, run the
+  migrations and then::
+
+      python bench_claim.py
+
+"""
+
+from ntorque.work import patch
+patch.green_threads()
+
+import sys
+import time
+import transaction
+
+from datetime import datetime
+from datetime import timedelta
+
+from ntorque import model
+from ntorque.model import transport
+from ntorque.work.main import Bootstrap
+
+from pyramid_redis.hooks import RedisFactory
+
+# How many tasks do you want to benchmark with?
+NUM_TASKS = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+
+# How many tasks to claim per round trip.
+BATCH_SIZE = 100
+
+# The redis list to use as a notification channel.
+CHANNEL = 'ntorque:bench'
+
+# The web hook url to store (it's never called).
+WEBHOOK_URL = u'http://localhost/bench'
+
+def create_tasks(n):
+    """Create ``n`` tasks and return their ids."""
+
+    factory = model.TaskFactory(None, WEBHOOK_URL, 20, u'POST')
+    with transaction.manager:
+        ids = [factory(body=u'{}').id for i in range(n)]
+    return ids
+
+def reset_tasks(ids):
+    """Make the tasks pending and due again."""
+
+    task_cls = model.Task
+    values = {
+        'due': datetime.utcnow() - timedelta(seconds=1),
+        'retry_count': 0,
+        'status': model.TASK_STATUSES['pending'],
+    }
+    with transaction.manager:
+        query = task_cls.query.filter(task_cls.id.in_(ids))
+        query.update(values, synchronize_session=False)
+
+def delete_tasks(ids):
+    task_cls = model.Task
+    with transaction.manager:
+        query = task_cls.query.filter(task_cls.id.in_(ids))
+        query.delete(synchronize_session=False)
+
+def bench_redis(redis, ids):
+    """Push an instruction per task, then pop and acquire them one by one."""
+
+    notify = transport.ListNotifier(redis)
+    redis.delete(CHANNEL)
+    notify(CHANNEL, *['{0}:0'.format(x) for x in ids])
+    t1 = time.time()
+    while True:
+        instruction = redis.lpop(CHANNEL)
+        if instruction is None:
+            break
+        task_id, retry_count = map(int, instruction.split(':'))
+        model.TaskManager().acquire(task_id, retry_count)
+        model.Session.remove()
+    return time.time() - t1
+
+def bench_claim(ids):
+    """Claim the tasks in batches."""
+
+    claim = model.ClaimDueTasks()
+    t1 = time.time()
+    while True:
+        with transaction.manager:
+            tasks = claim(limit=BATCH_SIZE)
+        model.Session.remove()
+        if not tasks:
+            break
+    return time.time() - t1
+
+def main():
+    config = Bootstrap()()
+    settings = config.registry.settings
+    redis = RedisFactory()(settings, registry=config.registry)
+    ids = create_tasks(NUM_TASKS)
+    try:
+        reset_tasks(ids)
+        redis_secs = bench_redis(redis, ids)
+        reset_tasks(ids)
+        claim_secs = bench_claim(ids)
+    finally:
+        delete_tasks(ids)
+    for name, secs in (('redis', redis_secs), ('claim', claim_secs)):
+        print '{0}: {1} tasks acquired in {2:.2f} seconds ({3:.0f} / sec)'.format(
+                name, NUM_TASKS, secs, NUM_TASKS / secs)
+
+if __name__ == '__main__':
+    main()
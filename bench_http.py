@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+
+"""Use this script from the command line to compare the per task latency of
+  calling web hooks with a new connection per request and with the
+  ``SessionPool``, which keeps connections (and their TLS sessions) alive
+  per host.
+
+  It runs a local HTTPS stub server, with a throwaway self signed
+  certificate (so it needs the ``openssl`` command), and doesn't touch the
+  database or Redis::
+
+      python bench_http.py [num_requests]
+
+"""
+
+from ntorque.work import patch
+patch.green_threads()
+
+import BaseHTTPServer
+import os
+import shutil
+import SocketServer
+import ssl
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+
+from ntorque.work.perform import SessionPool
+
+# How many requests do you want to benchmark with?
+NUM_REQUESTS = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+
+# The request body to POST.
+BODY = u'{"foo": "bar"}'
+
+class StubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Respond to every POST with an empty 200, keeping the connection open."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.getheader('content-length', 0)))
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+class StubServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Handle each connection in its own thread, as they're kept open."""
+
+    daemon_threads = True
+
+def generate_certificate(directory):
+    """Generate a self signed certificate for ``localhost``, returning the
+      paths to the certificate and its key.
+    """
+
+    cert = os.path.join(directory, 'cert.pem')
+    key = os.path.join(directory, 'key.pem')
+    subprocess.check_call(['openssl', 'req', '-x509', '-newkey', 'rsa:2048',
+            '-nodes', '-days', '1', '-subj', '/CN=localhost', '-keyout', key,
+            '-out', cert], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    return cert, key
+
+def start_server(cert, key):
+    """Start the stub server on a free port, returning its url."""
+
+    server = StubServer(('localhost', 0), StubHandler)
+    server.socket = ssl.wrap_socket(server.socket, certfile=cert, keyfile=key,
+            server_side=True)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return 'https://localhost:{0}/hooks'.format(server.server_port)
+
+def bench(make_request, url, cert):
+    """Make the requests one after another, returning the latencies."""
+
+    latencies = []
+    for i in range(NUM_REQUESTS):
+        t1 = time.time()
+        response = make_request('POST', url, data=BODY, verify=cert,
+                timeout=20)
+        response.raise_for_status()
+        latencies.append(time.time() - t1)
+    return latencies
+
+def main():
+    directory = tempfile.mkdtemp()
+    try:
+        cert, key = generate_certificate(directory)
+        url = start_server(cert, key)
+        results = (
+            ('new connection', bench(requests.request, url, cert)),
+            ('session pool', bench(SessionPool(), url, cert)),
+        )
+    finally:
+        shutil.rmtree(directory)
+    for name, latencies in results:
+        latencies.sort()
+        mean = sum(latencies) / len(latencies)
+        p99 = latencies[int(len(latencies) * 0.99) - 1]
+        print '{0}: {1} requests, mean {2:.2f} ms, p99 {3:.2f} ms'.format(
+                name, len(latencies), mean * 1000, p99 * 1000)
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,18 @@
 # -*- coding: utf-8 -*-
 
-"""Gunicorn configuration."""
+"""Gunicorn configuration.
 
+  In production, the app is preloaded in the master process so that workers
+  share its (copy-on-write) memory pages. As the app is loaded before the
+  ``on_starting`` hook, the master is monkey patched when the config is
+  loaded. To stop the garbage collector unsharing those pages, the master
+  collects once, before the first fork, and then freezes (or, before
+  Python 3.7, raises the thresholds of) the gc, db connections are disposed
+  of after forking and each worker periodically logs its unique (i.e.:
+  unshared) resident set size.
+"""
+
+import gc
 import logging
 import signal
 import sys
@@ -20,14 +31,59 @@ if os.environ.has_key('GUNICORN_SERVER_SOFTWARE'):
     import gunicorn
     gunicorn.SERVER_SOFTWARE = os.environ['GUNICORN_SERVER_SOFTWARE']
 
+def _unique_rss(pid):
+    """Sum the private pages mapped by process ``pid``, in kB."""
+
+    total = 0
+    try:
+        with open('/proc/{0}/smaps'.format(pid)) as f:
+            for line in f:
+                if line.startswith('Private_'):
+                    total += int(line.split()[1])
+    except IOError:
+        return None
+    return total
+
+# Has the master collected before forking?
+_gc_state = {'is_collected': False}
+
+def _pre_fork(server, worker):
+    # Only collect before the first fork, not every time a worker is
+    # (re)spawned, e.g.: after ``max_requests``.
+    if _gc_state['is_collected']:
+        return
+    gc.collect()
+    if hasattr(gc, 'freeze'):
+        gc.freeze()
+    else:
+        gc.set_threshold(*gc_thresholds)
+    _gc_state['is_collected'] = True
+
 def _post_fork(server, worker):
     gevent_psycopg2.monkey_patch()
+    gc.set_threshold(*gc_thresholds)
+    if preload_app:
+        # Make sure the worker doesn't share any db connections opened in
+        # the master. Redis connection pools reset themselves after a fork.
+        from ntorque.model import Base
+        if Base.metadata.bind is not None:
+            Base.metadata.bind.dispose()
+    if memory_report_interval:
+        def report():
+            while True:
+                gevent.sleep(memory_report_interval)
+                server.log.info('Worker %s unique rss: %s kB', worker.pid,
+                        _unique_rss(worker.pid))
+        gevent.spawn(report)
 
-def _on_starting(server):
+def _patch():
     if 'threading' in sys.modules:
         del sys.modules['threading']
     gevent.monkey.patch_all()
 
+def _on_starting(server):
+    _patch()
+
 def _on_exit(server):
     gevent.shutdown()
 
@@ -60,15 +116,33 @@ bind = '0.0.0.0:{0}'.format(os.environ.get('PORT', 5100))
 daemon = asbool(os.environ.get('GUNICORN_DAEMON', False))
 max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS', 24000))
 mode = os.environ.get('MODE', 'development')
-preload_app = asbool(os.environ.get('GUNICORN_PRELOAD_APP', False))
+preload_app = asbool(os.environ.get('GUNICORN_PRELOAD_APP', mode == 'production'))
 proc_name = os.environ.get('GUNICORN_PROC_NAME', 'ntorque')
 timeout = int(os.environ.get('GUNICORN_TIMEOUT', 10))
 workers = int(os.environ.get('GUNICORN_WORKERS', 2))
 worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gevent')
 
+# Tune the garbage collector, e.g.: ``GUNICORN_GC_THRESHOLDS=50000,20,20``.
+# When preloading, the first threshold defaults to much higher than Python's
+# ``700``, so the workers' gc unshares fewer of the preloaded pages.
+gc_thresholds = os.environ.get('GUNICORN_GC_THRESHOLDS',
+        '50000,20,20' if preload_app else '')
+gc_thresholds = [int(x) for x in gc_thresholds.split(',') if x.strip()]
+if not gc_thresholds:
+    gc_thresholds = gc.get_threshold()
+memory_report_interval = int(os.environ.get('GUNICORN_MEMORY_REPORT_INTERVAL',
+        60 if mode == 'production' else 0))
+
+if preload_app:
+    pre_fork = _pre_fork
+
 if 'gevent' in worker_class.lower():
     post_fork = _post_fork
-    if mode == 'development':
+    if preload_app:
+        # The preloaded app is imported before ``on_starting``, so patch now.
+        _patch()
+    elif mode == 'development':
         on_starting = _on_starting
+    if mode == 'development':
         when_ready = _when_ready
     on_exit = _on_exit
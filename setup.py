@@ -24,9 +24,12 @@ setup(
             'ls = setuptools_git:gitlsfiles'
         ],
         'console_scripts': [
+            'ntorque_claim = ntorque.work.claim:main',
             'ntorque_cleanup = ntorque.work.cleanup:main',
             'ntorque_consume = ntorque.work.consume:main',
-            'ntorque_requeue = ntorque.work.requeue:main'
+            'ntorque_rebuild = ntorque.work.rebuild:main',
+            'ntorque_requeue = ntorque.work.requeue:main',
+            'ntorque_schedule = ntorque.work.schedule:main'
         ]
     }
 )
@@ -27,8 +27,14 @@ DEFAULTS = {
     'authenticate': os.environ.get('NTORQUE_AUTHENTICATE', True),
     'default_timeout': os.environ.get('NTORQUE_DEFAULT_TIMEOUT', 60),
     'enable_hsts': os.environ.get('NTORQUE_ENABLE_HSTS', False),
+    'fair_scheduling': os.environ.get('NTORQUE_FAIR_SCHEDULING', False),
+    'inline_max_size': int(os.environ.get('NTORQUE_INLINE_MAX_SIZE', 2048)),
+    'instruction_format': os.environ.get('NTORQUE_INSTRUCTION_FORMAT', 'text'),
     'mode': os.environ.get('MODE', 'development'),
     'redis_channel': os.environ.get('NTORQUE_REDIS_CHANNEL', 'ntorque'),
+    'redis_schedule': os.environ.get('NTORQUE_REDIS_SCHEDULE', 'ntorque:scheduled'),
+    'redis_shards': os.environ.get('NTORQUE_REDIS_SHARDS', ''),
+    'transport': os.environ.get('NTORQUE_TRANSPORT', 'list'),
 }
 
 class IncludeMe(object):
@@ -19,7 +19,11 @@ from . import tree
 
 @view_config(context=tree.APIRoot)
 @view_config(context=tree.TaskRoot)
+@view_config(context=tree.EndpointRoot)
+@view_config(context=tree.TopicRoot)
+@view_config(context=model.Endpoint)
 @view_config(context=model.Task)
+@view_config(context=model.Topic)
 class MethodNotSupportedView(object):
     """Generic view exposed to throw 405 errors when endpoints are requested
       with an unsupported request method.
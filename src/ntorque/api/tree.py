@@ -1,10 +1,14 @@
 # -*- coding: utf-8 -*-
 
-"""Support Pyramid traversal to ``/tasks/:task_id``."""
+"""Support Pyramid traversal to ``/tasks/:task_id``, ``/topics/:name`` and
+  ``/endpoints/:name``.
+"""
 
 __all__ = [
     'APIRoot',
+    'EndpointRoot',
     'TaskRoot',
+    'TopicRoot',
 ]
 
 import logging
@@ -12,20 +16,27 @@ logger = logging.getLogger(__name__)
 
 import re
 VALID_INT = re.compile(r'^[0-9]+$')
+VALID_NAME = re.compile(r'^[\w.-]{1,96}$')
 
 from ntorque import model
 from ntorque import root
 
 class APIRoot(root.TraversalRoot):
-    """Support ``tasks`` traversal."""
+    """Support ``tasks``, ``topics`` and ``endpoints`` traversal."""
 
     def __init__(self, *args, **kwargs):
         super(APIRoot, self).__init__(*args, **kwargs)
+        self.endpoints_root = kwargs.get('endpoints_root', EndpointRoot)
         self.tasks_root = kwargs.get('tasks_root', TaskRoot)
+        self.topics_root = kwargs.get('topics_root', TopicRoot)
 
     def __getitem__(self, key):
+        if key == 'endpoints':
+            return self.endpoints_root(self.request, key=key, parent=self)
         if key == 'tasks':
             return self.tasks_root(self.request, key=key, parent=self)
+        if key == 'topics':
+            return self.topics_root(self.request, key=key, parent=self)
         raise KeyError(key)
 
 
@@ -48,3 +59,40 @@ class TaskRoot(root.TraversalRoot):
         raise KeyError(key)
 
 
+class TopicRoot(root.TraversalRoot):
+    """Lookup the authenticated application's topics by name."""
+
+    def __init__(self, *args, **kwargs):
+        super(TopicRoot, self).__init__(*args, **kwargs)
+        self.get_topic = kwargs.get('get_topic', model.LookupTopic())
+        self.valid_name = kwargs.get('valid_name', VALID_NAME)
+
+    def __getitem__(self, key):
+        """Lookup topic by name and, if found, make sure it's locatable."""
+
+        if self.valid_name.match(key):
+            app = self.request.application
+            context = self.get_topic(app, key)
+            if context:
+                return self.locatable(context, key)
+        raise KeyError(key)
+
+
+class EndpointRoot(root.TraversalRoot):
+    """Lookup the authenticated application's endpoints by name."""
+
+    def __init__(self, *args, **kwargs):
+        super(EndpointRoot, self).__init__(*args, **kwargs)
+        self.get_endpoint = kwargs.get('get_endpoint', model.LookupEndpoint())
+        self.valid_name = kwargs.get('valid_name', VALID_NAME)
+
+    def __getitem__(self, key):
+        """Lookup endpoint by name and, if found, make sure it's locatable."""
+
+        if self.valid_name.match(key):
+            app = self.request.application
+            context = self.get_endpoint(app, key)
+            if context:
+                return self.locatable(context, key)
+        raise KeyError(key)
+
@@ -3,19 +3,29 @@
 """Expose and implement the Torque API endpoints."""
 
 __all__ = [
+    'CompleteTask',
     'EnqueTask',
+    'FailTask',
+    'PublishTopic',
+    'SaveEndpointView',
+    'SubscribeToTopic',
 ]
 
 import logging
 logger = logging.getLogger(__name__)
 
+import hmac
 import re
 
+from datetime import datetime
+from datetime import timedelta
+
 from pyramid import httpexceptions
 from pyramid.security import NO_PERMISSION_REQUIRED
 from pyramid.view import view_config
 
 from ntorque import model
+from ntorque import util
 from ntorque.model import constants
 from . import tree
 
@@ -25,6 +35,10 @@ URL_PATTERN = r"""(?i)\b((?:[a-z][\w-]+:(?:/{1,3}|[a-z0-9%])|www\d{0,3}[.]|[a-z0
 VALID_INT = re.compile(r'^[0-9]+$')
 VALID_URL = re.compile(URL_PATTERN)
 
+# Endpoint path suffixes must fit in ``Task.path`` and can't change the host.
+MAX_PATH_LENGTH = 256
+VALID_PATH_PREFIXES = (u'/', u'?')
+
 @view_config(context=tree.APIRoot, permission=NO_PERMISSION_REQUIRED,
         request_method='GET', renderer='string')
 def installed_view(object):
@@ -32,51 +46,174 @@ def installed_view(object):
 
     return u'Torque installed and reporting for duty, sir!'
 
-@view_config(context=tree.APIRoot, permission='create', request_method='POST',
-        renderer='string')
-class EnqueTask(object):
-    """``POST /`` endpoint."""
+class ValidateTaskParams(object):
+    """Shared logic to validate the web hook ``url``, ``timeout`` and
+      ``method`` query params.
+    """
 
     def __init__(self, request, **kwargs):
         self.request = request
         self.bad_request = kwargs.get('bad_request', httpexceptions.HTTPBadRequest)
-        self.create_task = kwargs.get('create_task', model.CreateTask(request))
         self.default_method = kwargs.get('default_method', constants.DEFAULT_METHOD)
-        self.push_notify = kwargs.get('push_notify', model.PushTaskNotification(request))
+        self.default_priority = kwargs.get('default_priority',
+                constants.DEFAULT_PRIORITY)
+        self.parse_datetime = kwargs.get('parse_datetime', util.parse_datetime)
+        self.utcnow = kwargs.get('utcnow', datetime.utcnow)
+        self.max_path_length = kwargs.get('max_path_length', MAX_PATH_LENGTH)
         self.valid_int = kwargs.get('valid_int', VALID_INT)
         self.valid_methods = kwargs.get('valid_methods', constants.REQUEST_METHODS)
+        self.valid_priorities = kwargs.get('valid_priorities',
+                constants.TASK_PRIORITIES)
         self.valid_url = kwargs.get('valid_url', VALID_URL)
 
-    def __call__(self):
-        """Validate, store the task and return a 201 response."""
-
-        # Unpack.
-        request = self.request
-        settings = request.registry.settings
-
-        # Validate.
-        # - url
-        url = request.GET.get('url', None)
+    def validate_url(self):
+        url = self.request.GET.get('url', None)
         has_valid_url = url and self.valid_url.match(url)
         if not has_valid_url:
             raise self.bad_request(u'You must provide a valid web hook URL.')
-        # - timeout
-        default_timeout = settings.get('ntorque.default_timeout')
-        raw_timeout = request.GET.get('timeout', default_timeout)
+        return url
+
+    def validate_path(self):
+        """Return the optional ``path`` suffix to append to an endpoint's url,
+          which must start with a ``/`` or ``?``, so it can't change the host.
+        """
+
+        path = self.request.GET.get('path', None)
+        if path is None:
+            return None
+        if len(path) > self.max_path_length or \
+                not path.startswith(VALID_PATH_PREFIXES):
+            msg = u'The `path` must start with `/` or `?` and be at most {0} ' \
+                    u'characters long.'.format(self.max_path_length)
+            raise self.bad_request(msg)
+        return path
+
+    def validate_timeout(self, default=None):
+        raw_timeout = self.request.GET.get('timeout', default)
+        if raw_timeout is None:
+            return None
         try:
-            timeout = int(raw_timeout)
+            return int(raw_timeout)
         except ValueError:
             raise self.bad_request(u'You must provide a valid integer timeout.')
-        # - method
-        method = request.GET.get('method', self.default_method)
+
+    def validate_due(self):
+        """Return the datetime the task is scheduled for, from either a ``due``
+          ISO 8601 UTC datetime or a ``delay`` in seconds. Returns ``None``
+          if neither is provided.
+        """
+
+        request = self.request
+        raw_due = request.GET.get('due', None)
+        raw_delay = request.GET.get('delay', None)
+        if raw_due is not None and raw_delay is not None:
+            raise self.bad_request(u'Provide either a `due` or a `delay`.')
+        if raw_due is not None:
+            try:
+                return self.parse_datetime(raw_due)
+            except ValueError:
+                raise self.bad_request(u'You must provide a valid ISO 8601 due.')
+        if raw_delay is not None:
+            if not self.valid_int.match(raw_delay):
+                raise self.bad_request(u'You must provide a valid integer delay.')
+            return self.utcnow() + timedelta(seconds=int(raw_delay))
+        return None
+
+    def validate_expires(self):
+        """Return the datetime after which the task should not be performed,
+          from either an ``expires_at`` ISO 8601 UTC datetime or a ``ttl`` in
+          seconds. Returns ``None`` if neither is provided.
+        """
+
+        request = self.request
+        raw_expires = request.GET.get('expires_at', None)
+        raw_ttl = request.GET.get('ttl', None)
+        if raw_expires is not None and raw_ttl is not None:
+            raise self.bad_request(u'Provide either an `expires_at` or a `ttl`.')
+        if raw_expires is not None:
+            try:
+                return self.parse_datetime(raw_expires)
+            except ValueError:
+                msg = u'You must provide a valid ISO 8601 expires_at.'
+                raise self.bad_request(msg)
+        if raw_ttl is not None:
+            if not self.valid_int.match(raw_ttl):
+                raise self.bad_request(u'You must provide a valid integer ttl.')
+            return self.utcnow() + timedelta(seconds=int(raw_ttl))
+        return None
+
+    def validate_priority(self, app):
+        """Return the ``priority`` param, defaulting to the application's
+          default priority.
+        """
+
+        priority = self.request.GET.get('priority', None)
+        if priority is None:
+            return getattr(app, 'default_priority', self.default_priority)
+        if priority not in self.valid_priorities:
+            priorities_str = u', '.join(self.valid_priorities)
+            msg = u'Task `priority` must be one of: {0}.'.format(priorities_str)
+            raise self.bad_request(msg)
+        return priority
+
+    def validate_method(self, default=None):
+        if default is None:
+            default = self.default_method
+        method = self.request.GET.get('method', default)
         if method not in self.valid_methods:
             methods_str = u', '.join(self.valid_methods)
             msg = u'Request `method` must be one of: {0}.'.format(methods_str)
             raise self.bad_request(msg)
+        return method
 
-        # Store the task.
+@view_config(context=tree.APIRoot, permission='create', request_method='POST',
+        renderer='string')
+class EnqueTask(ValidateTaskParams):
+    """``POST /`` endpoint."""
+
+    def __init__(self, request, **kwargs):
+        super(EnqueTask, self).__init__(request, **kwargs)
+        self.create_task = kwargs.get('create_task', model.CreateTask(request))
+        self.get_endpoint = kwargs.get('get_endpoint', model.LookupEndpoint())
+        self.push_notify = kwargs.get('push_notify', model.PushTaskNotification(request))
+
+    def __call__(self):
+        """Validate, store the task and return a 201 response. Tasks either
+          provide a ``url`` or reference a registered ``endpoint`` by name,
+          with an optional ``path`` suffix.
+        """
+
+        # Unpack.
+        request = self.request
+        settings = request.registry.settings
         app = request.application
-        task = self.create_task(app, url, timeout, method)
+
+        # Validate.
+        endpoint_name = request.GET.get('endpoint', None)
+        if endpoint_name is None:
+            endpoint = path = None
+            url = self.validate_url()
+            timeout = self.validate_timeout(settings.get('ntorque.default_timeout'))
+            method = self.validate_method()
+        else:
+            endpoint = self.get_endpoint(app, endpoint_name)
+            if endpoint is None:
+                raise self.bad_request(u'You must provide a registered endpoint.')
+            url = None
+            path = self.validate_path()
+            default_timeout = endpoint.timeout
+            if default_timeout is None:
+                default_timeout = settings.get('ntorque.default_timeout')
+            timeout = self.validate_timeout(default_timeout)
+            method = self.validate_method(endpoint.method)
+        due = self.validate_due()
+        expires = self.validate_expires()
+        priority = self.validate_priority(app)
+
+        # Store the task.
+        task = self.create_task(app, url, timeout, method, due=due,
+                expires=expires, priority=priority, endpoint=endpoint,
+                path=path)
 
         # Notify.
         self.push_notify(task)
@@ -129,3 +266,191 @@ class PushTask(object):
         response.status_int = 201
         response.headers['Location'] = request.resource_url(task)[:-1]
         return ''
+
+class ResolveTaskView(object):
+    """Shared logic to asynchronously complete or fail a task, authenticated
+      by the task's token, provided in a ``NTORQUE-TASK-TOKEN`` header.
+    """
+
+    status_key = NotImplemented
+
+    def __init__(self, request, **kwargs):
+        self.request = request
+        self.compare = kwargs.get('compare', hmac.compare_digest)
+        self.conflict = kwargs.get('conflict', httpexceptions.HTTPConflict)
+        self.forbidden = kwargs.get('forbidden', httpexceptions.HTTPForbidden)
+        self.resolve = kwargs.get('resolve', model.ResolveTask())
+        self.statuses = kwargs.get('statuses', constants.TASK_STATUSES)
+
+    def __call__(self):
+        """Validate the token, update the task and return a 200 response."""
+
+        # Unpack.
+        request = self.request
+        task = request.context
+
+        # Validate.
+        token = request.headers.get('NTORQUE-TASK-TOKEN', '')
+        if not task.token or not self.compare(task.token.encode('utf8'), token):
+            raise self.forbidden(u'You must provide a valid task token.')
+
+        # Update the task, iff it's still pending.
+        status = self.statuses[self.status_key]
+        if not self.resolve(task, status):
+            raise self.conflict(u'The task is no longer pending.')
+        return {'id': task.id, 'status': status}
+
+@view_config(context=model.Task, name='complete', request_method='POST',
+        permission=NO_PERMISSION_REQUIRED, renderer='json')
+class CompleteTask(ResolveTaskView):
+    """``POST /tasks/task:id/complete`` to complete a task asynchronously."""
+
+    status_key = 'completed'
+
+@view_config(context=model.Task, name='fail', request_method='POST',
+        permission=NO_PERMISSION_REQUIRED, renderer='json')
+class FailTask(ResolveTaskView):
+    """``POST /tasks/task:id/fail`` to fail a task asynchronously."""
+
+    status_key = 'failed'
+
+@view_config(context=tree.TopicRoot, permission='create', request_method='POST',
+        renderer='string')
+class SubscribeToTopic(ValidateTaskParams):
+    """``POST /topics?name=:name&url=:url`` to subscribe a web hook url to one
+      of the authenticated application's topics.
+    """
+
+    def __init__(self, request, **kwargs):
+        super(SubscribeToTopic, self).__init__(request, **kwargs)
+        self.subscribe = kwargs.get('subscribe', model.CreateSubscription())
+        self.valid_name = kwargs.get('valid_name', tree.VALID_NAME)
+
+    def __call__(self):
+        """Validate, store the subscription and return a 201 response."""
+
+        # Unpack.
+        request = self.request
+
+        # Validate.
+        name = request.GET.get('name', None)
+        if not name or not self.valid_name.match(name):
+            raise self.bad_request(u'You must provide a valid topic name.')
+        url = self.validate_url()
+        timeout = self.validate_timeout()
+        method = self.validate_method()
+
+        # Store the subscription.
+        app = request.application
+        subscription = self.subscribe(app, name, url, method, timeout=timeout)
+
+        # Return a 201 response with the topic url as the Location header.
+        response = request.response
+        response.status_int = 201
+        response.headers['Location'] = request.resource_url(subscription.topic)[:-1]
+        return ''
+
+@view_config(context=model.Topic, permission='view', request_method='GET',
+        renderer='json')
+def topic_view(request):
+    """``GET /topics/:name`` endpoint."""
+
+    return request.context
+
+@view_config(context=model.Topic, permission='create', request_method='POST',
+        renderer='json')
+class PublishTopic(ValidateTaskParams):
+    """``POST /topics/:name`` to fan a single request body out to a task per
+      subscription to the topic.
+    """
+
+    def __init__(self, request, **kwargs):
+        super(PublishTopic, self).__init__(request, **kwargs)
+        self.create_tasks = kwargs.get('create_tasks', model.CreateTopicTasks(request))
+        self.push_notify = kwargs.get('push_notify', model.PushTaskNotification(request))
+        self.task_cls = kwargs.get('task_cls', model.Task)
+
+    def __call__(self):
+        """Store the payload and tasks, notify and return a 201 response."""
+
+        # Unpack.
+        request = self.request
+        settings = request.registry.settings
+        topic = request.context
+        timeout = int(settings.get('ntorque.default_timeout'))
+
+        # Store the tasks.
+        app = request.application
+        priority = self.validate_priority(app)
+        tasks = self.create_tasks(app, topic, timeout, priority=priority)
+
+        # Notify.
+        self.push_notify(*tasks)
+
+        # Return a 201 response with the task urls.
+        root = self.task_cls.__parent__
+        response = request.response
+        response.status_int = 201
+        return {
+            'tasks': [request.resource_url(root, str(x.id)) for x in tasks],
+        }
+
+@view_config(context=tree.EndpointRoot, permission='create',
+        request_method='POST', renderer='json')
+class SaveEndpointView(ValidateTaskParams):
+    """``POST /endpoints?name=:name&url=:url`` to register, or update, one of
+      the authenticated application's endpoints. Any passthrough headers are
+      stored as the endpoint's default headers.
+    """
+
+    def __init__(self, request, **kwargs):
+        super(SaveEndpointView, self).__init__(request, **kwargs)
+        self.header_prefix = kwargs.get('header_prefix',
+                constants.PROXY_HEADER_PREFIX)
+        self.save_endpoint = kwargs.get('save_endpoint', model.SaveEndpoint())
+        self.valid_name = kwargs.get('valid_name', tree.VALID_NAME)
+
+    def __call__(self):
+        """Validate, store the endpoint and return a 201 response."""
+
+        # Unpack.
+        request = self.request
+
+        # Validate.
+        name = request.GET.get('name', None)
+        if not name or not self.valid_name.match(name):
+            raise self.bad_request(u'You must provide a valid endpoint name.')
+        url = self.validate_url()
+        timeout = self.validate_timeout()
+        method = self.validate_method()
+        max_retries = request.GET.get('max_retries', None)
+        if max_retries is not None:
+            if not self.valid_int.match(max_retries):
+                msg = u'You must provide a valid integer max_retries.'
+                raise self.bad_request(msg)
+            max_retries = int(max_retries)
+
+        # Extract the default headers.
+        headers = {}
+        prefix = self.header_prefix.lower()
+        for key, value in request.headers.items():
+            if key.lower().startswith(prefix):
+                headers[key[len(prefix):]] = value
+
+        # Store the endpoint.
+        app = request.application
+        endpoint = self.save_endpoint(app, name, url, method, headers=headers,
+                timeout=timeout, max_retries=max_retries)
+
+        # Return a 201 response with the endpoint url as the Location header.
+        response = request.response
+        response.status_int = 201
+        response.headers['Location'] = request.resource_url(endpoint)[:-1]
+        return endpoint
+
+@view_config(context=model.Endpoint, permission='view', request_method='GET',
+        renderer='json')
+def endpoint_view(request):
+    """``GET /endpoints/:name`` endpoint."""
+
+    return request.context
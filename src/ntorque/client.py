@@ -39,6 +39,8 @@ logger = logging.getLogger(__name__)
 import requests
 import os
 
+from datetime import datetime
+from datetime import timedelta
 from os.path import join as join_path
 from urllib import urlencode
 
@@ -46,6 +48,7 @@ from pyramid_weblayer import tx
 
 from ntorque import model
 from ntorque.model import constants as c
+from ntorque.model import priority as p
 
 SUCCESS = u'DISPATCHED'
 FAILED = u'FAILED ({0})'
@@ -121,8 +124,12 @@ class HTTPTorqueClient(object):
         self.torque_url = torque_url
         self.api_key = api_key
 
-    def __call__(self, url, data=None, headers=None, method=None, timeout=None):
-        """Patch the api key into a POST request to the url."""
+    def __call__(self, url, data=None, headers=None, method=None, timeout=None,
+            due=None, delay=None, priority=None, expires_at=None, ttl=None):
+        """Patch the api key into a POST request to the url. Optionally
+          schedule the task for a ``due`` datetime or ``delay`` in seconds
+          and expire it at an ``expires_at`` datetime or after ``ttl`` seconds.
+        """
 
         # Unpack.
         dispatch = self.dispatcher
@@ -146,6 +153,16 @@ class HTTPTorqueClient(object):
             query['method'] = method
         if timeout is not None:
             query['timeout'] = timeout
+        if due is not None:
+            query['due'] = due.isoformat()
+        if delay is not None:
+            query['delay'] = int(delay)
+        if priority is not None:
+            query['priority'] = priority
+        if expires_at is not None:
+            query['expires_at'] = expires_at.isoformat()
+        if ttl is not None:
+            query['ttl'] = int(ttl)
 
         # Append the query params to the torque_url.
         divider = '&' if '?' in torque_url else '?'
@@ -165,6 +182,14 @@ class HybridTorqueClient(object):
       application using the zope ``transaction`` machinery, this provides a
       guarantee that application state will always be rebuildable from the db
       and that tasks will never be lost due to nTorque being down or restarting.
+
+      Alternatively, provide a ``notifier`` (see ``ntorque.model.transport``)
+      to notify the workers directly, rather than via the push endpoint. A
+      transactional notifier, such as the ``PostgresNotifier``, notifies in
+      the same transaction that stores the task. Other notifiers notify when
+      the transaction commits. Either way, tasks due in the future are left
+      for the requeue process to pick up when they're due. If the channels
+      are sharded over multiple redis instances, use a ``ShardedNotifier``.
     """
 
     def __init__(self, dispatcher, torque_url, api_key=None, app_id=None, **kwargs):
@@ -172,13 +197,23 @@ class HybridTorqueClient(object):
         self.torque_url = torque_url
         self.api_key = api_key
         self.app_id = app_id
+        self.notifier = kwargs.get('notifier', None)
+        self.channel = kwargs.get('channel', os.environ.get('NTORQUE_REDIS_CHANNEL',
+                'ntorque'))
+        self.get_channel = kwargs.get('get_channel', p.get_channel)
+        self.join_tx = kwargs.get('join_tx', tx.join_to_transaction)
         self.factory_cls = kwargs.get('factory_cls', model.TaskFactory)
         self.lookup = kwargs.get('lookup', model.LookupApplication())
         self.header_prefix = kwargs.get('header_prefix', c.PROXY_HEADER_PREFIX)
         self.join_path = kwargs.get('join_path', join_path)
+        self.utcnow = kwargs.get('utcnow', datetime.utcnow)
 
-    def __call__(self, url, data=None, headers=None, method=None, timeout=None, due=None):
-        """Patch the api key into a POST request to the url."""
+    def __call__(self, url, data=None, headers=None, method=None, timeout=None,
+            due=None, delay=None, priority=None, expires_at=None, ttl=None):
+        """Store the task and push a notification. Optionally schedule the task
+          for a ``due`` datetime or ``delay`` in seconds and expire it at an
+          ``expires_at`` datetime or after ``ttl`` seconds.
+        """
 
         # Compose.
         if headers is None:
@@ -208,6 +243,18 @@ class HybridTorqueClient(object):
         if content_type: # Extract just the enctype.
             properties['enctype'] = content_type.split(';')[0]
 
+        # Schedule the first attempt, if necessary.
+        if delay is not None:
+            due = self.utcnow() + timedelta(seconds=delay)
+        if due is not None:
+            properties['due'] = due
+
+        # Set the expiry deadline, if necessary.
+        if ttl is not None:
+            expires_at = self.utcnow() + timedelta(seconds=ttl)
+        if expires_at is not None:
+            properties['expires'] = expires_at
+
         # Either use the app_id or the api_key to get an application. Note that
         # the task factory works with `None`, an id or an instance. Using an
         # app_id is more efficient as it skips a db query.
@@ -217,6 +264,12 @@ class HybridTorqueClient(object):
         elif api_key:
             application = self.lookup(api_key)
 
+        # Use the priority provided, falling back on the application's default.
+        if priority is None:
+            priority = getattr(application, 'default_priority', None)
+        if priority is not None:
+            properties['priority'] = priority
+
         # Instantiate a task factory.
         factory = self.factory_cls(application, url, timeout, method)
 
@@ -227,7 +280,13 @@ class HybridTorqueClient(object):
         return self.notify(task, headers)
 
     def notify(self, task, headers):
-        """Use the normal dispatcher to send a push notification."""
+        """Use the normal dispatcher to send a push notification. Note that
+          the push endpoint adds tasks due in the future to the schedule.
+        """
+
+        # Notify directly, if configured to.
+        if self.notifier is not None:
+            return self.notify_directly(task)
 
         # Unpack.
         dispatch = self.dispatcher
@@ -244,3 +303,24 @@ class HybridTorqueClient(object):
 
         # Dispatch the notification.
         return dispatch(url, None, headers)
+
+    def notify_directly(self, task):
+        """Use the notifier to notify the workers, unless the task is due in
+          the future.
+        """
+
+        # Unpack.
+        notify = self.notifier
+
+        # Leave tasks that are due in the future for the requeue process.
+        if task.due is not None and task.due > self.utcnow():
+            return SUCCESS, None, None
+
+        # Notify now, if transactional, or when the transaction commits.
+        channel = self.get_channel(self.channel, task.priority)
+        instruction = '{0}:{1}'.format(task.id, task.retry_count)
+        if notify.is_transactional:
+            notify(channel, instruction)
+        else:
+            self.join_tx(notify, channel, instruction)
+        return SUCCESS, None, None
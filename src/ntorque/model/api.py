@@ -3,16 +3,27 @@
 """Provides business logic to read and write data using the ORM."""
 
 __all__ = [
+    'ClaimDueTasks',
     'CreateApplication',
+    'CreateSubscription',
     'CreateTask',
+    'CreateTopicTasks',
     'DeleteOldTasks',
+    'ExpireTasks',
     'GetActiveKey',
     'GetDueTasks',
+    'GetPendingTasks',
+    'GetSchedulingPolicies',
     'LookupApplication',
+    'LookupEndpoint',
     'LookupTask',
+    'LookupTopic',
     'PushTaskNotification',
+    'ResolveTask',
+    'SaveEndpoint',
     'TaskFactory',
     'TaskManager',
+    'TopicTaskFactory',
 ]
 
 import logging
@@ -22,6 +33,18 @@ import json
 import transaction
 
 from datetime import datetime
+from datetime import timedelta
+
+from sqlalchemy.dialects.postgresql import ARRAY
+from sqlalchemy.orm import joinedload
+from sqlalchemy.sql import and_
+from sqlalchemy.sql import bindparam
+from sqlalchemy.sql import case
+from sqlalchemy.sql import exists
+from sqlalchemy.sql import func
+from sqlalchemy.sql import or_
+from sqlalchemy.sql import select
+from sqlalchemy.types import Integer
 
 from pyramid.security import ALL_PERMISSIONS
 from pyramid.security import Allow, Deny
@@ -29,9 +52,27 @@ from pyramid.security import Authenticated, Everyone
 
 from pyramid_weblayer import tx
 
+from ntorque import util
+
 from . import constants as c
 from . import due
+from . import instruction as instructions
 from . import orm as model
+from . import priority
+from . import shard
+from . import transport
+
+def zip_rows(name, **columns):
+    """Return a ``FROM`` clause, aliased as ``name``, that zips each of the
+      ``columns``' bound ``(values, type)`` arrays into rows, so many rows can
+      be updated with their own values in a single statement.
+    """
+
+    items = sorted(columns.items())
+    return select([func.unnest(bindparam(None, value=list(values),
+            type_=ARRAY(type_))).label(key) for key, (values, type_) in items
+            ]).alias(name)
+
 
 class CreateApplication(object):
     """Create an application."""
@@ -61,11 +102,32 @@ class CreateTask(object):
         self.default_enctype = kwargs.get('default_enctype', c.DEFAULT_ENCTYPE)
         self.header_prefix = kwargs.get('header_prefix', c.PROXY_HEADER_PREFIX)
 
-    def __call__(self, application, url, timeout, method):
+    def __call__(self, application, url, timeout, method, due=None,
+            priority=None, expires=None, endpoint=None, path=None):
         """Unpack ``enctype, body and headers`` from the request and then
           pass through as args to the underlying ``CreateTask`` factory.
+          If provided, ``due`` schedules the task's first attempt and
+          ``expires`` sets a deadline after which it won't be performed.
+          Tasks for a registered ``endpoint`` pass ``url=None`` and an
+          optional ``path`` suffix.
         """
 
+        kwargs = self.unpack()
+        if endpoint is not None:
+            kwargs['endpoint'] = endpoint
+            kwargs['path'] = path
+        if due is not None:
+            kwargs['due'] = due
+        if expires is not None:
+            kwargs['expires'] = expires
+        if priority is not None:
+            kwargs['priority'] = priority
+        factory = self.factory_cls(application, url, timeout, method)
+        return factory(**kwargs)
+
+    def unpack(self):
+        """Return the ``body, charset, enctype and headers`` from the request."""
+
         # Get the content type and parse the encoding type out of it.
         request = self.request
         content_type = request.headers.get('Content-Type', None)
@@ -88,9 +150,23 @@ class CreateTask(object):
                 k = key[len(self.header_prefix):]
                 headers[k] = value
 
-        # Use the underlying factory to create the task.
-        factory = self.factory_cls(application, url, timeout, method)
-        return factory(body=body, charset=charset, enctype=enctype, headers=headers)
+        return dict(body=body, charset=charset, enctype=enctype, headers=headers)
+
+class CreateTopicTasks(CreateTask):
+    """Create a task for each of a topic's subscriptions from a ``request``."""
+
+    def __init__(self, request, **kwargs):
+        super(CreateTopicTasks, self).__init__(request, **kwargs)
+        self.factory_cls = kwargs.get('factory_cls', TopicTaskFactory)
+
+    def __call__(self, application, topic, default_timeout, priority=None):
+        """Unpack the request data and pass through to the underlying
+          ``TopicTaskFactory``.
+        """
+
+        factory = self.factory_cls(application, topic, default_timeout,
+                priority=priority)
+        return factory(**self.unpack())
 
 class TaskFactory(object):
     """Create and store a task."""
@@ -133,26 +209,245 @@ class TaskFactory(object):
         self.session.flush()
         return task
 
+class TopicTaskFactory(object):
+    """Store a request body once as a ``Payload`` and fan it out to a task per
+      active subscription, using a single multi-row insert.
+    """
+
+    def __init__(self, app, topic, default_timeout, priority=None, **kwargs):
+        self.app = app
+        self.topic = topic
+        self.default_timeout = default_timeout
+        self.priority = priority or c.DEFAULT_PRIORITY
+        self.due_factory = kwargs.get('due_factory', due.DueFactory())
+        self.payload_cls = kwargs.get('payload_cls', model.Payload)
+        self.session = kwargs.get('session', model.Session)
+        self.statuses = kwargs.get('statuses', c.TASK_STATUSES)
+        self.task_cls = kwargs.get('task_cls', model.Task)
+        self.utcnow = kwargs.get('utcnow', datetime.utcnow)
+
+    def __call__(self, body=u'', headers=None, **kwargs):
+        """Create the payload and tasks. Returns a list of ``(id, retry_count,
+          due, priority, app_id)`` rows -- enough to push notifications with.
+          The tasks belong to the topic's application, so they're routed to
+          its sub-channel when fair scheduling.
+        """
+
+        # Unpack.
+        task_cls = self.task_cls
+        subscriptions = [x for x in self.topic.subscriptions if x.is_active]
+        if not subscriptions:
+            return []
+
+        # Store the shared payload.
+        if headers is None:
+            headers = {}
+        payload = self.payload_cls(body=body, headers=json.dumps(headers), **kwargs)
+        self.session.add(payload)
+        self.session.flush()
+
+        # Build a row per subscription. The values are explicit (rather than
+        # relying on column defaults) so they're consistent across the rows.
+        key = lambda attr: attr.property.columns[0].key
+        app_id = self.topic.app_id
+        if app_id is None:
+            app_id = getattr(self.app, 'id', self.app)
+        now = self.utcnow()
+        rows = []
+        for item in subscriptions:
+            timeout = item.timeout
+            if timeout is None:
+                timeout = self.default_timeout
+            rows.append({
+                key(task_cls.app_id): app_id,
+                key(task_cls.created): now,
+                key(task_cls.due): self.due_factory(timeout, 0),
+                key(task_cls.method): item.method,
+                key(task_cls.modified): now,
+                key(task_cls.payload_id): payload.id,
+                key(task_cls.priority): self.priority,
+                key(task_cls.retry_count): 0,
+                key(task_cls.status): self.statuses['pending'],
+                key(task_cls.timeout): timeout,
+                key(task_cls.token): model.generate_task_token(),
+                key(task_cls.url): item.url,
+                key(task_cls.version): 1,
+            })
+
+        # Insert them in one statement, returning the new ids.
+        table = task_cls.__table__
+        statement = table.insert().values(rows).returning(table.c.id,
+                table.c.retry_count, table.c.due, table.c.priority,
+                table.c.app_id)
+        return self.session.execute(statement).fetchall()
+
+class SaveEndpoint(object):
+    """Register an application's named endpoint, or update it if it already
+      exists.
+    """
+
+    def __init__(self, **kwargs):
+        self.endpoint_cls = kwargs.get('endpoint_cls', model.Endpoint)
+        self.lookup = kwargs.get('lookup', LookupEndpoint())
+        self.session = kwargs.get('session', model.Session)
+
+    def __call__(self, app, name, url, method, headers=None, timeout=None,
+            max_retries=None):
+        """Get or create the endpoint and set its properties."""
+
+        if headers is None:
+            headers = {}
+        endpoint = self.lookup(app, name)
+        if endpoint is None:
+            endpoint = self.endpoint_cls(app=app, name=name)
+            self.session.add(endpoint)
+        endpoint.url = url
+        endpoint.method = method
+        endpoint.headers = json.dumps(headers)
+        endpoint.timeout = timeout
+        endpoint.max_retries = max_retries
+        self.session.flush()
+        return endpoint
+
+class CreateSubscription(object):
+    """Subscribe a web hook url to an application's named topic, creating
+      the topic if it doesn't exist yet.
+    """
+
+    def __init__(self, **kwargs):
+        self.lookup = kwargs.get('lookup', LookupTopic())
+        self.session = kwargs.get('session', model.Session)
+        self.subscription_cls = kwargs.get('subscription_cls', model.Subscription)
+        self.topic_cls = kwargs.get('topic_cls', model.Topic)
+
+    def __call__(self, app, name, url, method, timeout=None):
+        """Get or create the topic and add an active subscription to it."""
+
+        topic = self.lookup(app, name)
+        if topic is None:
+            topic = self.topic_cls(app=app, name=name)
+            self.session.add(topic)
+        subscription = self.subscription_cls(method=method, timeout=timeout,
+                url=url)
+        topic.subscriptions.append(subscription)
+        self.session.flush()
+        return subscription
+
 class PushTaskNotification(object):
-    """Add a transaction commit hook to push a task onto the redis channel."""
+    """Add a transaction commit hook to push tasks onto the redis channel.
+
+      Tasks that are due in the future are instead added to the schedule
+      sorted set, scored by their due timestamp, to be released onto the
+      channel by the ``ntorque_schedule`` process when they fall due.
+
+      Both the channel and the schedule are routed by task priority and, if
+      ``ntorque.fair_scheduling`` is enabled (for the ``list`` transport), by
+      application, registering the application ids as they're used. Due
+      instructions are pushed using the configured ``ntorque.transport``'s
+      notifier. Transactional notifiers are called immediately, within the
+      current transaction, and don't have a schedule: their tasks that are
+      due in the future are left for the ``RequeuePoller`` to pick up.
+
+      If ``ntorque.instruction_format`` is ``binary`` (and the transport
+      isn't ``postgres``, whose notifications must be text), instructions
+      carry the request data of tasks no larger than
+      ``ntorque.inline_max_size`` bytes. The ``(id, retry_count, ...)`` rows
+      returned when publishing to a topic don't have their request data to
+      hand, so their instructions are just the binary header. Nor do the
+      instructions of scheduled tasks, or of tasks for an endpoint, whose
+      url, headers and retry limit can change before they're performed.
+
+      If ``ntorque.redis_shards`` are configured, instructions are pushed
+      onto the channel, or added to the schedule, on their task's shard.
+    """
 
     def __init__(self, request, **kwargs):
         self.request = request
+        self.encode = kwargs.get('encode', instructions.encode)
+        self.encode_text = kwargs.get('encode_text', instructions.encode_text)
+        self.get_channel = kwargs.get('get_channel', priority.get_channel)
+        self.get_notifier = kwargs.get('get_notifier', transport.get_notifier)
+        self.get_shards = kwargs.get('get_shards', shard.GetRedisShards())
         self.join_tx = kwargs.get('join_tx', tx.join_to_transaction)
+        self.to_timestamp = kwargs.get('to_timestamp', util.to_timestamp)
+        self.utcnow = kwargs.get('utcnow', datetime.utcnow)
 
-    def __call__(self, task):
-        """Prepare instruction and add to channel on tx commit."""
+    def __call__(self, *tasks):
+        """Prepare instructions and add to channel on tx commit."""
 
         # Unpack.
         request = self.request
         settings = request.registry.settings
+        transport_name = settings.get('ntorque.transport', c.DEFAULT_TRANSPORT)
+        now = self.utcnow()
 
-        # Prepare instruction.
-        instruction = '{0}:{1}'.format(task.id, task.retry_count)
+        # Get the notifier.
+        shards = None
+        if transport_name == transport.POSTGRES:
+            notify = self.get_notifier(transport_name)
+        else:
+            shards = self.get_shards(settings, registry=request.registry)
+            notify = self.get_notifier(transport_name, redis=request.redis,
+                    shards=shards)
+
+        # Route by application when fair scheduling.
+        is_fair = priority.is_fair(settings)
+        app_ids = set()
+
+        # Use the binary instruction format, if configured.
+        instruction_format = settings.get('ntorque.instruction_format',
+                instructions.TEXT)
+        is_binary = instruction_format == instructions.BINARY and \
+                transport_name != transport.POSTGRES
+        max_size = int(settings.get('ntorque.inline_max_size', 0))
+
+        # Prepare instructions, grouped by priority channel and splitting out
+        # the ones scheduled in the future.
+        by_channel = {}
+        scheduled = {}
+        for task in tasks:
+            due = getattr(task, 'due', None)
+            is_due = due is None or due <= now
+            if is_binary:
+                task_data = None
+                if hasattr(task, '__json__') and is_due and \
+                        getattr(task, 'endpoint_id', None) is None:
+                    task_data = task.__json__(include_request_data=True)
+                    task_data['expires'] = task.expires
+                instruction = self.encode(task.id, task.retry_count,
+                        task_data=task_data, max_size=max_size)
+            else:
+                instruction = self.encode_text(task.id, task.retry_count)
+            task_priority = getattr(task, 'priority', None)
+            app_id = getattr(task, 'app_id', None) if is_fair else None
+            if app_id is not None:
+                app_ids.add(app_id)
+            if not is_due:
+                key = self.get_channel(settings['ntorque.redis_schedule'],
+                        task_priority, app_id=app_id)
+                redis = request.redis if shards is None else shards.get(task.id)
+                items = scheduled.setdefault((redis, key), {})
+                items[instruction] = self.to_timestamp(due)
+            else:
+                key = self.get_channel(settings['ntorque.redis_channel'],
+                        task_priority, app_id=app_id)
+                by_channel.setdefault(key, []).append(instruction)
+
+        # Notify now, if transactional.
+        if notify.is_transactional:
+            for channel, items in by_channel.items():
+                notify(channel, *items)
+            return
 
-        # Push onto the queue when the current transaction commits.
-        channel = settings['ntorque.redis_channel']
-        self.join_tx(request.redis.rpush, channel, instruction)
+        # Otherwise push onto the queue / schedule when the current
+        # transaction commits, registering any application ids first.
+        if app_ids:
+            apps_key = priority.get_apps_key(settings['ntorque.redis_channel'])
+            self.join_tx(request.redis.sadd, apps_key, *app_ids)
+        for channel, items in by_channel.items():
+            self.join_tx(notify, channel, *items)
+        for (redis, schedule), items in scheduled.items():
+            self.join_tx(redis.zadd, schedule, **items)
 
 
 class GetActiveKey(object):
@@ -201,7 +496,9 @@ class GetActiveKeyValues(object):
 
 
 class GetDueTasks(object):
-    """Get tasks that are due and pending."""
+    """Get tasks that are due, pending and haven't expired, oldest due
+      first.
+    """
 
     def __init__(self, **kwargs):
         self.utcnow = kwargs.get('utcnow', datetime.utcnow)
@@ -218,33 +515,172 @@ class GetDueTasks(object):
 
         # Build the query.
         query = model_cls.query.filter(model_cls.status==status)
-        query = query.filter(model_cls.due<self.utcnow())
+        query = query.filter(model_cls.due<now)
+        query = query.filter(or_(model_cls.expires==None, model_cls.expires>now))
 
         # Batch.
+        query = query.order_by(model_cls.due)
         query = query.offset(offset).limit(limit)
 
         # Return the results.
         return query.all()
 
 
+class GetPendingTasks(object):
+    """Stream the ``id``, ``retry_count``, ``priority``, ``app_id`` and
+      ``due`` date of every pending task that hasn't expired, in id order,
+      using a server side cursor, so the results are never all in memory.
+    """
+
+    def __init__(self, **kwargs):
+        self.utcnow = kwargs.get('utcnow', datetime.utcnow)
+        self.statuses = kwargs.get('statuses', c.TASK_STATUSES)
+        self.task_cls = kwargs.get('task_cls', model.Task)
+
+    def __call__(self, batch_size=1000):
+        """Return an iterator over the tasks."""
+
+        # Unpack.
+        model_cls = self.task_cls
+        now = self.utcnow()
+        status = self.statuses['pending']
+
+        # Build the query.
+        query = model_cls.query.with_entities(model_cls.id,
+                model_cls.retry_count, model_cls.priority, model_cls.app_id,
+                model_cls.due)
+        query = query.filter(model_cls.status==status)
+        query = query.filter(or_(model_cls.expires==None, model_cls.expires>now))
+        query = query.order_by(model_cls.id)
+
+        # Stream the results.
+        query = query.execution_options(stream_results=True)
+        return query.yield_per(batch_size)
+
+
+class ClaimDueTasks(object):
+    """Claim a batch of due, pending tasks directly from the db.
+
+      Discovers and acquires up to ``limit`` tasks in a single
+      ``UPDATE ... WHERE id IN (SELECT ... FOR UPDATE SKIP LOCKED) RETURNING``
+      statement, which increments their retry count and generates their next
+      due date and status in SQL. Skipping locked rows means that parallel
+      claimers neither block on, nor claim, the same tasks.
+    """
+
+    def __init__(self, **kwargs):
+        self.due_clause = kwargs.get('due_clause', due.DueClause())
+        self.endpoint_cls = kwargs.get('endpoint_cls', model.Endpoint)
+        self.session = kwargs.get('session', model.Session)
+        self.status_clause = kwargs.get('status_clause', due.StatusClause())
+        self.statuses = kwargs.get('statuses', c.TASK_STATUSES)
+        self.task_cls = kwargs.get('task_cls', model.Task)
+        self.utcnow = kwargs.get('utcnow', datetime.utcnow)
+
+    def __call__(self, limit=100):
+        """Claim the tasks and return their request data."""
+
+        # Unpack.
+        task_cls = self.task_cls
+        table = task_cls.__table__
+        endpoints = self.endpoint_cls.__table__
+        now = self.utcnow()
+
+        # Select the oldest due, pending, unexpired tasks, skipping rows that
+        # are locked by parallel claimers.
+        query = select([table.c.id]).where(and_(
+                table.c.status==self.statuses['pending'],
+                table.c.due<now,
+                or_(table.c.expires==None, table.c.expires>now)))
+        query = query.order_by(table.c.due).limit(limit)
+        query = query.suffix_with('FOR UPDATE SKIP LOCKED')
+
+        # Acquire them, applying any endpoint retry limit.
+        retry_count = table.c.retry_count + 1
+        max_retries = select([endpoints.c.max_retries]).where(
+                endpoints.c.id==table.c.endpoint_id).as_scalar()
+        statement = table.update().where(table.c.id.in_(query)).values(
+                retry_count=retry_count,
+                due=self.due_clause(now, table.c.timeout, retry_count),
+                status=self.status_clause(retry_count, max_retries=max_retries))
+        statement = statement.returning(table.c.id)
+        ids = [row.id for row in self.session.execute(statement)]
+        if not ids:
+            return []
+
+        # Read the request data.
+        query = task_cls.query.filter(task_cls.id.in_(ids))
+        query = query.options(joinedload('endpoint'), joinedload('payload'))
+        query = query.populate_existing()
+        return [x.__json__(include_request_data=True) for x in query]
+
+
+class GetSchedulingPolicies(object):
+    """Get the fair scheduling ``share`` and ``max_in_flight`` cap of the
+      active applications, as a dict keyed by application id.
+    """
+
+    def __init__(self, **kwargs):
+        self.app_cls = kwargs.get('app_cls', model.Application)
+
+    def __call__(self):
+        app_cls = self.app_cls
+        query = app_cls.query.filter(*app_cls.active_clauses())
+        query = query.with_entities(app_cls.id, app_cls.share,
+                app_cls.max_in_flight)
+        return dict([(x.id, (x.share, x.max_in_flight)) for x in query])
+
+
+class ExpireTasks(object):
+    """Flag pending tasks whose ``expires`` deadline has passed as expired."""
+
+    def __init__(self, **kwargs):
+        self.utcnow = kwargs.get('utcnow', datetime.utcnow)
+        self.statuses = kwargs.get('statuses', c.TASK_STATUSES)
+        self.task_cls = kwargs.get('task_cls', model.Task)
+
+    def __call__(self):
+        """Build a query and call a bulk update."""
+
+        # Unpack.
+        model_cls = self.task_cls
+        now = self.utcnow()
+
+        # Build the query.
+        query = model_cls.query.filter(model_cls.status==self.statuses['pending'])
+        query = query.filter(model_cls.expires<=now)
+        with transaction.manager:
+            num_expired = query.update({'status': self.statuses['expired']},
+                    synchronize_session=False)
+        return num_expired
+
+
 class DeleteOldTasks(object):
     """Delete tasks last modified more than a time delta ago."""
 
     def __init__(self, **kwargs):
         self.utcnow = kwargs.get('utcnow', datetime.utcnow)
+        self.payload_cls = kwargs.get('payload_cls', model.Payload)
         self.task_cls = kwargs.get('task_cls', model.Task)
 
     def __call__(self, delta):
-        """Build a query and call a bulk delete."""
+        """Build a query and call a bulk delete. Then delete any old payloads
+          that no longer have tasks referencing them.
+        """
 
         # Unpack.
         model_cls = self.task_cls
+        payload_cls = self.payload_cls
         delta_ago = self.utcnow() - delta
 
-        # Build the query.
+        # Build the queries.
         query = model_cls.query.filter(model_cls.modified<delta_ago)
+        is_referenced = exists().where(model_cls.payload_id==payload_cls.id)
+        payloads = payload_cls.query.filter(payload_cls.modified<delta_ago)
+        payloads = payloads.filter(~is_referenced)
         with transaction.manager:
             num_deleted = query.delete()
+            payloads.delete(synchronize_session=False)
         return num_deleted
 
 
@@ -281,7 +717,7 @@ class LookupTask(object):
     """Lookup a task by ``id``."""
 
     def __init__(self, **kwargs):
-        self.patch_acl = kwargs.get('patch_acl', PatchTaskACL())
+        self.patch_acl = kwargs.get('patch_acl', PatchACL())
         self.task_cls = kwargs.get('task_cls', model.Task)
 
     def __call__(self, id_):
@@ -293,30 +729,97 @@ class LookupTask(object):
         return task
 
 
-class PatchTaskACL(object):
+class LookupEndpoint(object):
+    """Lookup an application's active endpoint by ``name``."""
+
+    def __init__(self, **kwargs):
+        self.endpoint_cls = kwargs.get('endpoint_cls', model.Endpoint)
+        self.patch_acl = kwargs.get('patch_acl', PatchACL())
+
+    def __call__(self, app, name):
+        """Get the endpoint. If it exists, patch its ACL."""
+
+        # Unpack.
+        endpoint_cls = self.endpoint_cls
+
+        # Query active endpoints with this name belonging to this app.
+        query = endpoint_cls.query.filter(*endpoint_cls.active_clauses())
+        query = query.filter(endpoint_cls.app==app, endpoint_cls.name==name)
+        endpoint = query.first()
+        if endpoint:
+            self.patch_acl(endpoint)
+        return endpoint
+
+
+class LookupTopic(object):
+    """Lookup an application's active topic by ``name``."""
+
+    def __init__(self, **kwargs):
+        self.patch_acl = kwargs.get('patch_acl', PatchACL())
+        self.topic_cls = kwargs.get('topic_cls', model.Topic)
+
+    def __call__(self, app, name):
+        """Get the topic. If it exists, patch its ACL."""
+
+        # Unpack.
+        topic_cls = self.topic_cls
+
+        # Query active topics with this name belonging to this app.
+        query = topic_cls.query.filter(*topic_cls.active_clauses())
+        query = query.filter(topic_cls.app==app, topic_cls.name==name)
+        topic = query.first()
+        if topic:
+            self.patch_acl(topic)
+        return topic
+
+
+class PatchACL(object):
     def __init__(self, **kwargs):
         self.get_keys = kwargs.get('get_keys', GetActiveKeyValues())
 
-    def __call__(self, task):
-        """If the ACL is NotImplemented, implement it."""
+    def __call__(self, context):
+        """If the ``context``'s ACL is NotImplemented, implement it."""
 
         # Exit if already patched.
-        if task.__acl__ is not NotImplemented:
+        if context.__acl__ is not NotImplemented:
             return
 
         # Start off denying access.
         rules = [(Deny, Everyone, ALL_PERMISSIONS),]
 
-        # And then grant access to ``task.app``.
-        if task.app:
-            for api_key in self.get_keys(task.app):
+        # And then grant access to ``context.app``.
+        if context.app:
+            for api_key in self.get_keys(context.app):
                 rule = (Allow, api_key, ALL_PERMISSIONS)
                 rules.insert(0, rule)
 
         # Set the ACL to the rules list.
-        task.__acl__ = rules
+        context.__acl__ = rules
+
+# Backwards compatible alias.
+PatchTaskACL = PatchACL
+
 
 
+class ResolveTask(object):
+    """Asynchronously complete or fail a pending task, e.g.: after its web hook
+      responded with a 202 and then finished performing it.
+    """
+
+    def __init__(self, **kwargs):
+        self.statuses = kwargs.get('statuses', c.TASK_STATUSES)
+        self.task_cls = kwargs.get('task_cls', model.Task)
+
+    def __call__(self, task, status):
+        """Set the task's status, iff it's still pending. Returns whether the
+          task was updated.
+        """
+
+        query = self.task_cls.query.filter_by(id=task.id,
+                status=self.statuses['pending'])
+        return bool(query.update({'status': status},
+                synchronize_session=False))
+
 
 class TaskManager(object):
     """Provide methods to ``acquire`` a task and then ``reschedule``,
@@ -325,63 +828,276 @@ class TaskManager(object):
       Encapsulates the ``task_data`` returned from ``__json__()``ing the
       instance returned from the ``acquire`` query and uses this data to
       update the right task with the right values when setting the status.
+
+      Tasks past their ``expires`` deadline are flagged as expired, in the
+      same transaction as the acquire query, rather than being acquired.
     """
 
     def __init__(self, **kwargs):
+        self.due_clause = kwargs.get('due_clause', due.DueClause())
         self.due_factory = kwargs.get('due_factory', due.DueFactory())
         self.session = kwargs.get('session', model.Session)
+        self.status_clause = kwargs.get('status_clause', due.StatusClause())
         self.statuses = kwargs.get('statuses', c.TASK_STATUSES)
         self.task_cls = kwargs.get('task_cls', model.Task)
         self.tx_manager = kwargs.get('tx_manager', transaction.manager)
+        self.utcnow = kwargs.get('utcnow', datetime.utcnow)
+        self.expired = []
+        self.is_expired = False
 
     def _update(self, **values):
-        """Consistent logic to update the task. Note that it includes
-          the retry_count and timeout as these are used by the onupdate
-          functions and thus need to be in the sqlalchemy execution
-          context's current params.
+        """Consistent logic to update the task, iff it hasn't been acquired
+          again since.
         """
 
-        # Unpack.
-        retry_count = self.task_data['retry_count']
-        timeout = self.task_data['timeout']
+        table = self.task_cls.__table__
+        self.update_where(and_(table.c.id==self.task_id,
+                table.c.retry_count==self.task_data['retry_count']), **values)
 
-        # Merge the values with a consistent values dict.
-        values_dict = {
-            'retry_count': retry_count,
-            'timeout': timeout,
-        }
-        values_dict.update(values)
-        query = self.task_cls.query.filter_by(id=self.task_id,
-                retry_count=retry_count)
+    def update_where(self, where, **values):
+        """Update the tasks that match the ``where`` clause in a single
+          statement. The due date and status, unless provided, are generated
+          in SQL by the ``onupdate`` expressions, from each row's timeout and
+          retry count. Returns the number of rows updated.
+        """
+
+        statement = self.task_cls.__table__.update().where(where).values(
+                **values)
         with self.tx_manager:
-            query.update(values_dict)
+            return self.session.execute(statement).rowcount
 
-    def acquire(self, id_, retry_count):
+    def assign(self, task_data):
+        """Manage a task that has already been acquired, e.g.: claimed in a
+          batch by ``ClaimDueTasks``.
+        """
+
+        self.task_id = task_data['id']
+        self.task_data = task_data
+        self.is_expired = False
+
+    def acquire(self, id_, retry_count, recover=False):
         """Get a task by ``id`` and ``retry_count``, transactionally setting the
           status to ``in_progress`` and incrementing the ``retry_count``.
+
+          If ``recover`` is true, the instruction was reclaimed from a dead
+          consumer, which may have acquired the task before dying. So a still
+          pending task with the next ``retry_count`` is acquired as well, once
+          it's due, i.e.: once the dead consumer's attempt has timed out. A
+          task that a live consumer is still performing isn't due yet.
+
+          The task is acquired with a single conditional ``UPDATE``, so if
+          parallel workers have the same instruction, only one of them gets
+          the task.
+        """
+
+        self.task_id = id_
+        self.task_data = None
+        self.is_expired = False
+        table = self.task_cls.__table__
+        if recover:
+            where = and_(table.c.id==id_, or_(
+                    table.c.retry_count==retry_count,
+                    and_(table.c.retry_count==retry_count + 1,
+                            table.c.status==self.statuses['pending'],
+                            table.c.due<=self.utcnow())))
+        else:
+            where = and_(table.c.id==id_, table.c.retry_count==retry_count)
+        for row in self.acquire_where(where):
+            if row.status == self.statuses['expired']:
+                self.is_expired = True
+            else:
+                self.task_data = self.to_task_data(row)
+        return self.task_data
+
+    def acquire_inline(self, id_, retry_count, inline_data):
+        """Acquire a task whose request data was carried inline by its
+          instruction, using a single ``UPDATE ... RETURNING id`` statement
+          that doesn't read the task's request data from the db.
+
+          Tasks past their ``expires`` deadline are handed to ``acquire``,
+          to be flagged as expired.
         """
 
+        now = self.utcnow()
+        expires = inline_data['expires']
+        if expires is not None and expires <= now:
+            return self.acquire(id_, retry_count)
         self.task_id = id_
         self.task_data = None
-        query = self.task_cls.query
-        query = query.filter_by(id=id_, retry_count=retry_count)
+        self.is_expired = False
+
+        # Increment the retry count and generate the next due date and status
+        # in SQL, applying any endpoint retry limit.
+        table = self.task_cls.__table__
+        next_retry_count = table.c.retry_count + 1
+        statement = table.update().where(and_(table.c.id==id_,
+                table.c.retry_count==retry_count))
+        statement = statement.values(retry_count=next_retry_count,
+                due=self.due_clause(now, table.c.timeout, next_retry_count),
+                status=self.status_clause(next_retry_count,
+                        max_retries=inline_data['max_retries']))
+        statement = statement.returning(table.c.id)
         with self.tx_manager:
-            task = query.first()
-            if task:
-                task.retry_count = retry_count + 1
-                self.session.add(task)
-                self.task_data = task.__json__(include_request_data=True)
+            row = self.session.execute(statement).first()
+        if row is not None:
+            task_data = dict(inline_data)
+            task_data['id'] = id_
+            task_data['retry_count'] = retry_count + 1
+            self.task_data = task_data
         return self.task_data
 
+    def acquire_many(self, instructions):
+        """Acquire the tasks for a batch of ``(id, retry_count)`` pairs in a
+          single ``UPDATE ... FROM ... RETURNING`` statement, that also
+          returns their request data. Tasks past their ``expires`` deadline
+          are flagged as expired instead.
+
+          Returns a list of lightweight ``task_data`` dicts, as per
+          ``Task.__json__``, and the list of pairs that were skipped, because
+          they didn't match a task or their task expired. The ids of the
+          expired tasks are stored as ``self.expired``.
+        """
+
+        self.expired = []
+        instructions = list(instructions)
+        if not instructions:
+            return [], []
+
+        # Unpack.
+        table = self.task_cls.__table__
+        expired = self.statuses['expired']
+        rows = zip_rows('instructions',
+                id=([x for x, _ in instructions], Integer),
+                retry_count=([x for _, x in instructions], Integer))
+
+        # Acquire the tasks that match an instruction.
+        results = self.acquire_where(and_(table.c.id==rows.c.id,
+                table.c.retry_count==rows.c.retry_count))
+
+        # Build the task data.
+        tasks = []
+        acquired = set()
+        for row in results:
+            if row.status == expired:
+                self.expired.append(row.id)
+                continue
+            acquired.add((row.id, row.retry_count - 1))
+            tasks.append(self.to_task_data(row))
+        skipped = [x for x in instructions if tuple(x) not in acquired]
+        return tasks, skipped
+
+    def acquire_where(self, where):
+        """Acquire the tasks that match the ``where`` clause, in a single
+          conditional ``UPDATE ... RETURNING`` statement, that also returns
+          their request data. Tasks past their ``expires`` deadline are
+          flagged as expired instead.
+
+          As the ``where`` clause is re-checked against a row that's been
+          updated by a concurrent transaction, conditioning it on the
+          ``retry_count`` means only one worker can acquire a task.
+        """
+
+        # Unpack.
+        now = self.utcnow()
+        table = self.task_cls.__table__
+        endpoints = model.Endpoint.__table__
+        payloads = model.Payload.__table__
+        expired = self.statuses['expired']
+
+        # Read request data from the task's endpoint and payload, if any.
+        def from_endpoint(column):
+            return select([endpoints.c[column]]).where(
+                    endpoints.c.id==table.c.endpoint_id).as_scalar()
+        def from_payload(column):
+            query = select([payloads.c[column]]).where(
+                    payloads.c.id==table.c.payload_id).as_scalar()
+            return case([(table.c.payload_id==None, table.c[column])],
+                    else_=query).label(column)
+
+        # Increment the retry count and generate the next due date and status
+        # in SQL, unless the task has expired.
+        max_retries = from_endpoint('max_retries')
+        is_expired = and_(table.c.expires!=None, table.c.expires<=now)
+        next_retry_count = table.c.retry_count + 1
+        statement = table.update().where(where)
+        statement = statement.values(
+                retry_count=case([(is_expired, table.c.retry_count)],
+                        else_=next_retry_count),
+                due=case([(is_expired, table.c.due)],
+                        else_=self.due_clause(now, table.c.timeout,
+                                next_retry_count)),
+                status=case([(is_expired, expired)],
+                        else_=self.status_clause(next_retry_count,
+                                max_retries=max_retries)))
+        statement = statement.returning(table.c.id, table.c.retry_count,
+                table.c.due, table.c.expires, table.c.priority,
+                table.c.status, table.c.timeout, table.c.url, table.c.path,
+                table.c.endpoint_id, table.c.method, table.c.token,
+                from_payload('body'), from_payload('charset'),
+                from_payload('enctype'), from_payload('headers'),
+                from_endpoint('url').label('endpoint_url'),
+                from_endpoint('headers').label('endpoint_headers'),
+                max_retries.label('max_retries'))
+        with self.tx_manager:
+            results = self.session.execute(statement).fetchall()
+        return results
+
+    def to_task_data(self, row):
+        """Return the ``task_data`` for a row returned by ``acquire_where``."""
+
+        url = row.url
+        headers = json.loads(row.headers)
+        if row.endpoint_id is not None:
+            url = row.endpoint_url + (row.path or u'')
+            endpoint_headers = json.loads(row.endpoint_headers)
+            endpoint_headers.update(headers)
+            headers = endpoint_headers
+        return {
+            'body': row.body,
+            'charset': row.charset,
+            'due': row.due.isoformat(),
+            'endpoint_id': row.endpoint_id,
+            'enctype': row.enctype,
+            'expires': row.expires.isoformat() if row.expires else None,
+            'headers': headers,
+            'id': row.id,
+            'max_retries': row.max_retries,
+            'method': row.method,
+            'priority': row.priority,
+            'retry_count': row.retry_count,
+            'status': row.status,
+            'timeout': row.timeout,
+            'token': row.token,
+            'url': url,
+        }
+
     def reschedule(self):
         """Reschedule a task by setting the due date -- does the same as the
           default / onupdate machinery but with a timeout of 0.
         """
 
-        retry_count = self.task_data['retry_count']
-        self._update(due=self.due_factory(0, retry_count))
+        table = self.task_cls.__table__
+        self._update(due=self.due_clause(self.utcnow(), 0,
+                table.c.retry_count))
         return self.statuses['pending']
 
+    def lease(self, seconds):
+        """Leave a task pending whilst it's performed asynchronously, by
+          setting its due date ``seconds`` in the future. If it's not completed
+          or failed by then, it will be retried.
+
+          The lease only applies whilst the task is still pending, so if the
+          web hook has already completed or failed it, it's left as it is.
+        """
+
+        table = self.task_cls.__table__
+        pending = self.statuses['pending']
+        self.update_where(and_(table.c.id==self.task_id,
+                table.c.retry_count==self.task_data['retry_count'],
+                table.c.status==pending), status=pending,
+                due=self.utcnow() + timedelta(seconds=seconds))
+        return pending
+
     def complete(self):
         """Flag a task as completed."""
 
@@ -396,4 +1112,23 @@ class TaskManager(object):
         self._update(status=status)
         return status
 
+    def resolve_many(self, action, instructions):
+        """``complete``, ``fail`` or ``reschedule`` the tasks for a batch of
+          ``(id, retry_count)`` pairs in a single statement, iff they haven't
+          been acquired again since. Returns the number of tasks updated.
+        """
+
+        table = self.task_cls.__table__
+        rows = zip_rows('instructions',
+                id=([x for x, _ in instructions], Integer),
+                retry_count=([x for _, x in instructions], Integer))
+        if action == 'reschedule':
+            values = {'due': self.due_clause(self.utcnow(), 0,
+                    table.c.retry_count)}
+        else:
+            key = {'complete': 'completed', 'fail': 'failed'}[action]
+            values = {'status': self.statuses[key]}
+        return self.update_where(and_(table.c.id==rows.c.id,
+                table.c.retry_count==rows.c.retry_count), **values)
+
 
@@ -8,12 +8,21 @@ DEFAULT_ENCTYPE = u'application/x-www-form-urlencoded'
 
 DEFAULT_METHOD = u'POST'
 
+DEFAULT_PRIORITY = u'normal'
+
+DEFAULT_TRANSPORT = u'list'
+
 PROXY_HEADER_PREFIX = u'NTORQUE-PASSTHROUGH-'
 
 REQUEST_METHODS = [u'DELETE', u'PATCH', u'POST', u'PUT']
 
+TASK_PRIORITIES = [u'high', u'normal', u'low']
+
+TRANSPORTS = [u'list', u'postgres', u'stream']
+
 TASK_STATUSES = {
     'completed': u'COMPLETED',
+    'expired': u'EXPIRED',
     'failed': u'FAILED',
     'pending': u'PENDING',
 }
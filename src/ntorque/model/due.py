@@ -1,11 +1,13 @@
 # -*- coding: utf-8 -*-
 
 """Provides core logic to auto-generate task status and due date based on the
-  task's retry count.
+  task's retry count, plus equivalent SQL expressions for set based updates.
 """
 
 __all__ = [
+    'DueClause',
     'DueFactory',
+    'StatusClause',
     'StatusFactory',
 ]
 
@@ -16,6 +18,12 @@ import datetime
 import os
 import transaction
 
+from sqlalchemy.sql import case
+from sqlalchemy.sql import func
+from sqlalchemy.sql import literal
+from sqlalchemy.sql import literal_column
+from sqlalchemy.types import DateTime
+
 from ntorque import backoff
 from . import constants
 
@@ -89,3 +97,64 @@ class StatusFactory(object):
         return self.statuses[key]
 
 
+class DueClause(object):
+    """Express the ``DueFactory`` logic as a SQL expression, so the due date
+      can be generated within set based ``UPDATE`` statements.
+    """
+
+    def __init__(self, **kwargs):
+        self.settings = kwargs.get('settings', DEFAULT_SETTINGS)
+        self.factor = kwargs.get('factor', 2)
+        self.interval = kwargs.get('interval', literal_column("interval '1 second'"))
+        self.utcnow = kwargs.get('utcnow', func.timezone(u'UTC', func.now()))
+
+    def __call__(self, now, timeout, retry_count):
+        """Return an expression for the datetime ``timeout + backoff`` seconds
+          after ``now``, where ``timeout`` and ``retry_count`` are typically
+          column expressions. If ``now`` is ``None``, the db's current utc
+          time is used.
+        """
+
+        # Unpack.
+        settings = self.settings
+        min_delay = float(settings.get('min_delay'))
+        max_delay = float(settings.get('max_delay'))
+
+        # Bind the current datetime, if necessary.
+        if now is None:
+            now = self.utcnow
+        elif isinstance(now, datetime.datetime):
+            now = literal(now, type_=DateTime)
+
+        # Backoff from the ``min_delay``, as per ``ntorque.backoff.Backoff``.
+        if settings.get('backoff') == u'linear':
+            value = min_delay * (retry_count + 1)
+        else:
+            value = min_delay * func.power(self.factor, retry_count)
+
+        # Add the timeout and limit at the ``max_delay``.
+        delay = func.least(value + timeout, max_delay)
+
+        # Due now if this is the first time, otherwise ``delay`` seconds later.
+        return case([(retry_count == 0, now)], else_=now + delay * self.interval)
+
+
+class StatusClause(object):
+    """Express the ``StatusFactory`` logic as a SQL expression."""
+
+    def __init__(self, **kwargs):
+        self.settings = kwargs.get('settings', DEFAULT_SETTINGS)
+        self.statuses = kwargs.get('statuses', constants.TASK_STATUSES)
+
+    def __call__(self, retry_count, max_retries=None):
+        """Return an expression for pending if within the retry limit, else
+          failed. ``max_retries`` can be an expression that overrides the
+          configured limit when it's not null.
+        """
+
+        limit = int(self.settings.get('max_retries'))
+        if max_retries is not None:
+            limit = func.coalesce(max_retries, limit)
+        statuses = self.statuses
+        return case([(retry_count > limit, statuses['failed'])],
+                else_=statuses['pending'])
@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+
+"""Provides logic to encode and decode the task instructions that are pushed
+  onto the notification channels.
+
+  The original ``text`` format is an ascii ``'id:retry_count'`` string::
+
+      >>> encode_text(12, 3)
+      '12:3'
+      >>> decode('12:3')
+      (12, 3, None)
+
+  The versioned ``binary`` format packs the task id and retry count into a
+  fixed size header::
+
+      >>> data = encode(12, 3)
+      >>> len(data)
+      13
+      >>> decode(data)
+      (12, 3, None)
+
+  And can also carry a small task's request data, so the worker can acquire
+  the task without reading it from the db::
+
+      >>> task_data = {
+      ...     'body': u'{"foo": "bar"}',
+      ...     'charset': u'utf8',
+      ...     'enctype': u'application/json',
+      ...     'expires': None,
+      ...     'headers': {u'Foo': u'Bar'},
+      ...     'max_retries': None,
+      ...     'method': u'POST',
+      ...     'timeout': 20,
+      ...     'token': u'abc',
+      ...     'url': u'http://example.com/hooks',
+      ... }
+      >>> data = encode(12, 3, task_data)
+      >>> task_id, retry_count, inline_data = decode(data)
+      >>> inline_data == task_data
+      True
+
+  Unless the request data is larger than ``max_size`` bytes::
+
+      >>> decode(encode(12, 3, task_data, max_size=64))
+      (12, 3, None)
+
+  Either way, the ``text`` format is used as the instruction's key::
+
+      >>> get_key(data)
+      '12:3'
+      >>> get_task_id(data), get_task_id('12:3')
+      (12, 12)
+
+"""
+
+__all__ = [
+    'BINARY',
+    'TEXT',
+    'decode',
+    'encode',
+    'encode_text',
+    'get_key',
+    'get_task_id',
+]
+
+import logging
+logger = logging.getLogger(__name__)
+
+import json
+import struct
+
+from datetime import datetime
+
+from ntorque import util
+
+BINARY = u'binary'
+TEXT = u'text'
+
+# The binary format's version, task id and retry count header, followed, if
+# the request data is inline, by the timeout, max retries and expires
+# timestamp, then each of the ``STRINGS`` prefixed by their length.
+VERSION = 1
+HEADER = struct.Struct('>BQI')
+INLINE = struct.Struct('>iid')
+LENGTH = struct.Struct('>I')
+STRINGS = ('url', 'method', 'enctype', 'charset', 'headers', 'body', 'token')
+
+# Encode ``None`` as an out of range length / value.
+NULL_LENGTH = 0xffffffff
+NULL_VALUE = -1
+
+def encode_text(task_id, retry_count):
+    """Encode an instruction in the ``text`` format."""
+
+    return '{0}:{1}'.format(task_id, retry_count)
+
+def encode(task_id, retry_count, task_data=None, max_size=2048):
+    """Encode an instruction in the ``binary`` format, including the
+      ``task_data``'s request data, if provided and not larger than
+      ``max_size`` bytes.
+    """
+
+    header = HEADER.pack(VERSION, task_id, retry_count)
+    if task_data is None:
+        return header
+
+    # Pack the numeric values.
+    max_retries = task_data['max_retries']
+    expires = task_data['expires']
+    parts = [INLINE.pack(task_data['timeout'],
+            NULL_VALUE if max_retries is None else max_retries,
+            NULL_VALUE if expires is None else util.to_timestamp(expires))]
+
+    # Pack the length prefixed strings.
+    size = INLINE.size
+    for key in STRINGS:
+        value = task_data[key]
+        if key == 'headers':
+            value = json.dumps(value, separators=(',', ':'))
+        if value is None:
+            parts.append(LENGTH.pack(NULL_LENGTH))
+        else:
+            value = value.encode('utf8')
+            parts.append(LENGTH.pack(len(value)))
+            parts.append(value)
+        size += LENGTH.size + len(value or '')
+        if size > max_size:
+            return header
+    return header + ''.join(parts)
+
+def decode(data):
+    """Decode an instruction in either format into a ``(task_id, retry_count,
+      inline_data)`` tuple, where ``inline_data`` is ``None`` unless the
+      instruction carries the task's request data.
+    """
+
+    if not data[:1].isdigit():
+        version, task_id, retry_count = HEADER.unpack_from(data)
+        if version != VERSION:
+            raise ValueError(u'Unsupported instruction version: {0}'.format(
+                    version))
+        inline_data = None
+        if len(data) > HEADER.size:
+            inline_data = decode_inline(data, HEADER.size)
+        return task_id, retry_count, inline_data
+    task_id, retry_count = map(int, data.split(':'))
+    return task_id, retry_count, None
+
+def decode_inline(data, offset):
+    """Decode the inline request data, starting at ``offset``."""
+
+    timeout, max_retries, expires = INLINE.unpack_from(data, offset)
+    offset += INLINE.size
+    inline_data = {
+        'expires': None,
+        'max_retries': None if max_retries == NULL_VALUE else max_retries,
+        'timeout': timeout,
+    }
+    if expires != NULL_VALUE:
+        inline_data['expires'] = datetime.utcfromtimestamp(expires)
+    for key in STRINGS:
+        length, = LENGTH.unpack_from(data, offset)
+        offset += LENGTH.size
+        value = None
+        if length != NULL_LENGTH:
+            value = data[offset:offset + length].decode('utf8')
+            offset += length
+        if key == 'headers':
+            value = json.loads(value)
+        inline_data[key] = value
+    return inline_data
+
+def get_key(data):
+    """Return the ``text`` format of an instruction in either format."""
+
+    if not data[:1].isdigit():
+        _, task_id, retry_count = HEADER.unpack_from(data)
+        return encode_text(task_id, retry_count)
+    return data
+
+def get_task_id(data):
+    """Return the task id of an instruction in either format."""
+
+    if not data[:1].isdigit():
+        return HEADER.unpack_from(data)[1]
+    return int(data.split(':', 1)[0])
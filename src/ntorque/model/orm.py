@@ -6,8 +6,12 @@ __all__ = [
     'APIKey',
     'Application',
     'Base',
+    'Endpoint',
+    'Payload',
     'Session',
+    'Subscription',
     'Task',
+    'Topic',
 ]
 
 import logging
@@ -21,6 +25,10 @@ from sqlalchemy import orm
 from sqlalchemy.schema import Column
 from sqlalchemy.schema import Index
 from sqlalchemy.schema import ForeignKey
+from sqlalchemy.sql import column
+from sqlalchemy.sql import literal_column
+from sqlalchemy.sql import select
+from sqlalchemy.sql import table
 
 from sqlalchemy.types import Boolean
 from sqlalchemy.types import DateTime
@@ -39,18 +47,23 @@ faux_root = lambda **kwargs: root.TraversalRoot(None, **kwargs)
 
 from ntorque import util
 generate_api_key = lambda: util.generate_random_digest(num_bytes=20)
+generate_task_token = lambda: util.generate_random_digest(num_bytes=20)
 
 from .constants import DEFAULT_CHARSET
 from .constants import DEFAULT_ENCTYPE
 from .constants import DEFAULT_METHOD
+from .constants import DEFAULT_PRIORITY
 from .constants import REQUEST_METHODS
+from .constants import TASK_PRIORITIES
 from .constants import TASK_STATUSES
 
+from .due import DueClause
 from .due import DueFactory
+from .due import StatusClause
 from .due import StatusFactory
 
 def next_due(context, get_due=None):
-    """Tie the due date factory into the SQLAlchemy onupdate machinery."""
+    """Tie the due date factory into the SQLAlchemy default machinery."""
 
     # Compose.
     if get_due is None:
@@ -65,7 +78,7 @@ def next_due(context, get_due=None):
     return get_due(timeout, retry_count)
 
 def next_status(context, get_status=None):
-    """Tie the status factory into the SQLAlchemy onupdate machinery."""
+    """Tie the status factory into the SQLAlchemy default machinery."""
 
     # Compose.
     if get_status is None:
@@ -78,6 +91,19 @@ def next_status(context, get_status=None):
     # Return the next due date.
     return get_status(retry_count)
 
+# Updates generate the due date and status in SQL, from the updated row's
+# current timeout and retry count, so they don't need to be passed through
+# Python and many rows can be updated in a single statement. The status
+# applies the retry limit of the task's endpoint, if any.
+_timeout = literal_column('ntorque_tasks.timeout', type_=Integer)
+_retry_count = literal_column('ntorque_tasks.retry_count', type_=Integer)
+_endpoints = table('ntorque_endpoints', column('id'),
+        column('max_retries', Integer))
+_max_retries = select([_endpoints.c.max_retries]).where(_endpoints.c.id==
+        literal_column('ntorque_tasks.endpoint_id')).as_scalar()
+due_on_update = DueClause()(None, _timeout, _retry_count)
+status_on_update = StatusClause()(_retry_count, max_retries=_max_retries)
+
 class LifeCycleMixin(object):
     """Provide life cycle flags for `is_active`` and ``is_deleted``."""
 
@@ -136,6 +162,16 @@ class Application(Base, BaseMixin, LifeCycleMixin):
 
     name = Column(Unicode(96), nullable=False)
 
+    # The priority to give tasks that don't specify one.
+    default_priority = Column(Enum(*TASK_PRIORITIES,
+            name='ntorque_task_priorities'), default=DEFAULT_PRIORITY,
+            nullable=False)
+
+    # With fair scheduling, the application's relative share of the workers
+    # and an optional cap on how many of its tasks can be in flight at once.
+    share = Column(Integer, default=1, nullable=False)
+    max_in_flight = Column(Integer)
+
 class APIKey(Base, BaseMixin, LifeCycleMixin):
     """Encapsulate an api key used to authenticate an application."""
 
@@ -153,6 +189,125 @@ class APIKey(Base, BaseMixin, LifeCycleMixin):
     value = Column(Unicode(40), default=generate_api_key, nullable=False,
             unique=True)
 
+class Endpoint(Base, BaseMixin, LifeCycleMixin):
+    """Encapsulate a registered web hook, which tasks can reference (with an
+      optional path suffix) rather than storing their own url and headers.
+    """
+
+    __tablename__ = 'ntorque_endpoints'
+    __table_args__ = (
+        Index('ix_endpoints', 'app_id', 'name', unique=True),
+    )
+
+    # Implemented during traversal to grant ``self.app`` access.
+    __acl__ = NotImplemented
+
+    # Faux root allows us to generate urls with request.resource_url.
+    __parent__ = faux_root(key='endpoints', parent=faux_root())
+
+    @property
+    def __name__(self):
+        return self.name
+
+
+    # Can belong to an ``Application``.
+    app_id = Column(Integer, ForeignKey('ntorque_applications.id'))
+    app = orm.relationship(Application, backref=orm.backref('endpoints',
+            cascade="all, delete-orphan", single_parent=True))
+
+    # Unique per application.
+    name = Column(Unicode(96), nullable=False)
+
+    # The base url, method and default headers to call the web hook with.
+    url = Column(Unicode(256), nullable=False)
+    method = Column(Enum(*REQUEST_METHODS, name='ntorque_request_methods'),
+            default=DEFAULT_METHOD, nullable=False)
+    headers = Column(UnicodeText, default=u'{}')
+
+    # Optional timeout and retry limit, overriding the global defaults.
+    timeout = Column(Integer)
+    max_retries = Column(Integer)
+
+    def __json__(self, request=None):
+        return {
+            'headers': json.loads(self.headers),
+            'id': self.id,
+            'max_retries': self.max_retries,
+            'method': self.method,
+            'name': self.name,
+            'timeout': self.timeout,
+            'url': self.url,
+        }
+
+class Topic(Base, BaseMixin, LifeCycleMixin):
+    """Encapsulate a named topic that fans out to its subscriptions."""
+
+    __tablename__ = 'ntorque_topics'
+    __table_args__ = (
+        Index('ix_topics', 'app_id', 'name', unique=True),
+    )
+
+    # Implemented during traversal to grant ``self.app`` access.
+    __acl__ = NotImplemented
+
+    # Faux root allows us to generate urls with request.resource_url.
+    __parent__ = faux_root(key='topics', parent=faux_root())
+
+    @property
+    def __name__(self):
+        return self.name
+
+
+    # Can belong to an ``Application``.
+    app_id = Column(Integer, ForeignKey('ntorque_applications.id'))
+    app = orm.relationship(Application, backref=orm.backref('topics',
+            cascade="all, delete-orphan", single_parent=True))
+
+    # Unique per application.
+    name = Column(Unicode(96), nullable=False)
+
+    def __json__(self, request=None):
+        subscriptions = [item for item in self.subscriptions if item.is_active]
+        return {
+            'id': self.id,
+            'name': self.name,
+            'subscriptions': [item.__json__() for item in subscriptions],
+        }
+
+class Subscription(Base, BaseMixin, LifeCycleMixin):
+    """Encapsulate a web hook url subscribed to a ``Topic``."""
+
+    __tablename__ = 'ntorque_subscriptions'
+
+    # Belongs to a ``Topic``.
+    topic_id = Column(Integer, ForeignKey('ntorque_topics.id'), nullable=False)
+    topic = orm.relationship(Topic, backref=orm.backref('subscriptions',
+            cascade="all, delete-orphan", single_parent=True))
+
+    # The web hook url, method and (optional) timeout to create tasks with.
+    url = Column(Unicode(256), nullable=False)
+    method = Column(Enum(*REQUEST_METHODS, name='ntorque_request_methods'),
+            default=DEFAULT_METHOD, nullable=False)
+    timeout = Column(Integer)
+
+    def __json__(self, request=None):
+        return {
+            'id': self.id,
+            'method': self.method,
+            'timeout': self.timeout,
+            'url': self.url,
+        }
+
+class Payload(Base, BaseMixin):
+    """Encapsulate a request body shared by the tasks fanned out from a topic."""
+
+    __tablename__ = 'ntorque_payloads'
+
+    charset = Column(Unicode(24), default=DEFAULT_CHARSET, nullable=False)
+    enctype = Column(Unicode(256), default=DEFAULT_ENCTYPE, nullable=False)
+    body = Column(UnicodeText)
+    headers = Column(UnicodeText, default=u'{}')
+
 class Task(Base, BaseMixin):
     """Encapsulate a task."""
 
@@ -162,6 +317,7 @@ class Task(Base, BaseMixin):
             'c',
             'due',
             'status',
+            ('status', 'due', 'expires'),
             # ('c', 'created'),
         ]
     )
@@ -191,16 +347,24 @@ class Task(Base, BaseMixin):
 
     # When should the task be retried? By default, this is the current time
     # plus the timeout, plus one second.
-    due = Column(DateTime, default=next_due, onupdate=next_due, nullable=False)
+    due = Column(DateTime, default=next_due, onupdate=due_on_update,
+            nullable=False)
+
+    # Optional deadline after which the task is expired rather than performed.
+    expires = Column(DateTime)
 
     # Is it completed or not?
     status = Column(Enum(*TASK_STATUSES.values(), name='ntorque_task_statuses'),
-            default=next_status, onupdate=next_status, index=True,
+            default=next_status, onupdate=status_on_update, index=True,
             nullable=False)
 
     # The web hook url and POST body with charset and content type. Note that
-    # the data is decoded from the charset to unicode.
-    url = Column(Unicode(256), nullable=False)
+    # the data is decoded from the charset to unicode. Tasks that reference an
+    # ``Endpoint`` store an optional path suffix instead of the url.
+    url = Column(Unicode(256))
+    endpoint_id = Column(Integer, ForeignKey('ntorque_endpoints.id'))
+    endpoint = orm.relationship(Endpoint)
+    path = Column(Unicode(256))
     charset = Column(Unicode(24), default=DEFAULT_CHARSET, nullable=False)
     enctype = Column(Unicode(256), default=DEFAULT_ENCTYPE, nullable=False)
     body = Column(UnicodeText)
@@ -208,23 +372,61 @@ class Task(Base, BaseMixin):
     # Pass through headers and the HTTP method to use.
     headers = Column(UnicodeText, default=u'{}')
 
+    # Tasks fanned out from a topic share their body, charset, enctype and
+    # headers in a single stored ``Payload``.
+    payload_id = Column(Integer, ForeignKey('ntorque_payloads.id'))
+    payload = orm.relationship(Payload)
+
     # Is it completed or not?
     method = Column(Enum(*REQUEST_METHODS, name='ntorque_request_methods'),
             default=DEFAULT_METHOD, nullable=False)
 
+    # Secret passed to the web hook, which it can use to asynchronously
+    # complete or fail the task after responding with a 202.
+    token = Column(Unicode(40), default=generate_task_token)
+
+    # Which priority channel are notifications pushed onto?
+    priority = Column(Enum(*TASK_PRIORITIES, name='ntorque_task_priorities'),
+            default=DEFAULT_PRIORITY, nullable=False)
+
+    def get_url(self):
+        """Return the web hook url, joining the endpoint url and path suffix
+          if the task references an endpoint.
+        """
+
+        if self.endpoint_id is None:
+            return self.url
+        return self.endpoint.url + (self.path or u'')
+
     def __json__(self, request=None, include_request_data=False):
         data = {
             'due': self.due.isoformat(),
+            'expires': self.expires.isoformat() if self.expires else None,
             'id': self.id,
+            'priority': self.priority,
             'retry_count': self.retry_count,
             'status': self.status,
             'timeout': self.timeout,
-            'url': self.url,
+            'url': self.get_url(),
         }
         if include_request_data:
-            data['body'] = self.body
-            data['charset'] = self.charset
-            data['enctype'] = self.enctype
-            data['headers'] = json.loads(self.headers)
+            source = self if self.payload_id is None else self.payload
+            data['body'] = source.body
+            data['charset'] = source.charset
+            data['enctype'] = source.enctype
+            data['endpoint_id'] = self.endpoint_id
+            data['headers'] = json.loads(source.headers)
+            data['max_retries'] = None
+            if self.endpoint_id is not None:
+                headers = json.loads(self.endpoint.headers)
+                headers.update(data['headers'])
+                data['headers'] = headers
+                data['max_retries'] = self.endpoint.max_retries
             data['method'] = self.method
+            data['token'] = self.token
         return data
+
+# Partial index on the due date of pending tasks, used to claim due tasks
+# directly from the db.
+Index('ix_ntorque_tasks_pending_due', Task.due,
+        postgresql_where=Task.status==TASK_STATUSES['pending'])
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+
+"""Provides logic to route task notifications to per-priority redis keys and
+  to interleave consumption of them according to configurable weights.
+
+  Normal priority tasks use the configured key as is, so existing deployments
+  keep working. Other priorities are suffixed::
+
+      >>> get_channel('ntorque', u'normal')
+      'ntorque'
+      >>> get_channel('ntorque', u'high')
+      'ntorque:high'
+
+  With fair scheduling, each application has its own sub-channels, whose ids
+  are registered in a set::
+
+      >>> get_channel('ntorque', u'low', app_id=12)
+      'ntorque:app:12:low'
+      >>> get_apps_key('ntorque')
+      'ntorque:apps'
+
+  Weights are configured as a whitespace separated list of
+  ``priority:weight`` pairs::
+
+      >>> parse_weights('high:6 normal:3 low:1')
+      [(u'high', 6), (u'normal', 3), (u'low', 1)]
+
+  And are interleaved smoothly, so that a lower priority is never starved for
+  long, even when every channel has a backlog::
+
+      >>> interleave([('a', 3), ('b', 1)])
+      ['a', 'a', 'b', 'a']
+
+"""
+
+__all__ = [
+    'get_apps_key',
+    'get_channel',
+    'interleave',
+    'is_fair',
+    'parse_weights',
+]
+
+import logging
+logger = logging.getLogger(__name__)
+
+from pyramid.settings import asbool
+
+from .constants import DEFAULT_PRIORITY
+from .constants import DEFAULT_TRANSPORT
+from .constants import TASK_PRIORITIES
+
+def get_apps_key(channel):
+    """Return the redis key of the set of application ids that have their own
+      sub-channels of ``channel``.
+    """
+
+    return '{0}:apps'.format(channel)
+
+def get_channel(channel, priority, app_id=None):
+    """Return the redis key for ``priority`` tasks, derived from ``channel``
+      and, if provided, the ``app_id``.
+    """
+
+    if app_id is not None:
+        channel = '{0}:app:{1}'.format(channel, app_id)
+    if not priority or priority == DEFAULT_PRIORITY:
+        return channel
+    return '{0}:{1}'.format(channel, priority)
+
+def is_fair(settings):
+    """Is fair scheduling enabled? Note that it's only supported by the
+      default ``list`` transport.
+    """
+
+    transport_name = settings.get('ntorque.transport', DEFAULT_TRANSPORT)
+    if transport_name != DEFAULT_TRANSPORT:
+        return False
+    return asbool(settings.get('ntorque.fair_scheduling', False))
+
+def parse_weights(value, priorities=TASK_PRIORITIES):
+    """Parse a ``'priority:weight ...'`` string into a list of
+      ``(priority, weight)`` tuples, validating the priorities.
+    """
+
+    weights = []
+    for item in value.strip().split():
+        priority, weight = item.split(':')
+        priority = priority.decode('utf8')
+        if priority not in priorities:
+            raise ValueError(u'Invalid priority: {0}'.format(priority))
+        weights.append((priority, int(weight)))
+    return weights
+
+def interleave(weights):
+    """Use the smooth weighted round robin algorithm to generate a sequence
+      of ``len(sum(weights))`` items from a list of ``(item, weight)`` tuples.
+    """
+
+    total = sum([weight for _, weight in weights])
+    current = [0] * len(weights)
+    sequence = []
+    for _ in range(total):
+        for i, (_, weight) in enumerate(weights):
+            current[i] += weight
+        best = current.index(max(current))
+        current[best] -= total
+        sequence.append(weights[best][0])
+    return sequence
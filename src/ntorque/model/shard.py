@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+
+"""Provides logic to spread the notification channels over multiple redis
+  instances, by routing task ids to redis nodes using a consistent hash ring::
+
+      >>> ring = HashRing(['redis://a', 'redis://b', 'redis://c'])
+      >>> ring.get_node(1234) in ring.nodes
+      True
+      >>> ring.get_node(1234) == ring.get_node('1234')
+      True
+
+  Adding a node only remaps the fraction of keys that the new node takes::
+
+      >>> keys = range(10000)
+      >>> bigger = HashRing(ring.nodes + ['redis://d'])
+      >>> moved = [x for x in keys if ring.get_node(x) != bigger.get_node(x)]
+      >>> set([bigger.get_node(x) for x in moved])
+      set(['redis://d'])
+      >>> 0.15 < len(moved) / float(len(keys)) < 0.35
+      True
+
+  Shards are configured as a whitespace separated list of redis urls::
+
+      >>> parse_urls(' redis://a:6379/0  redis://b:6379/0 ')
+      ['redis://a:6379/0', 'redis://b:6379/0']
+
+"""
+
+__all__ = [
+    'GetRedisShards',
+    'HashRing',
+    'RedisShards',
+    'parse_urls',
+]
+
+import logging
+logger = logging.getLogger(__name__)
+
+import bisect
+import hashlib
+
+from redis import StrictRedis
+
+from .constants import DEFAULT_TRANSPORT
+from .priority import is_fair
+
+def parse_urls(value):
+    """Parse a whitespace separated list of redis urls."""
+
+    if not value:
+        return []
+    return value.strip().split()
+
+class HashRing(object):
+    """Consistent hash ring, with ``replicas`` virtual points per node."""
+
+    def __init__(self, nodes, replicas=128):
+        self.nodes = list(nodes)
+        self.replicas = replicas
+        points = []
+        for node in self.nodes:
+            for i in range(replicas):
+                points.append((self.hash('{0}#{1}'.format(node, i)), node))
+        points.sort()
+        self.hashes = [x for x, _ in points]
+        self.points = [x for _, x in points]
+
+    def hash(self, value):
+        return int(hashlib.md5(str(value)).hexdigest()[:8], 16)
+
+    def get_node(self, key):
+        """Return the node for the ``key``: the first point clockwise."""
+
+        index = bisect.bisect(self.hashes, self.hash(key))
+        return self.points[index % len(self.points)]
+
+class RedisShards(object):
+    """Routes task ids to redis clients, keyed by their urls, using a
+      ``HashRing``. Keying by url means a node keeps its keys when other
+      nodes are added to or removed from the configuration.
+    """
+
+    def __init__(self, clients, **kwargs):
+        self.clients = clients
+        self.ring = kwargs.get('ring_cls', HashRing)(sorted(clients.keys()))
+
+    def get(self, task_id):
+        """Return the redis client for the ``task_id``."""
+
+        return self.clients[self.ring.get_node(task_id)]
+
+    def values(self):
+        """Return the redis clients, in a consistent order."""
+
+        return [self.clients[x] for x in sorted(self.clients.keys())]
+
+class GetRedisShards(object):
+    """Get the ``RedisShards`` configured by ``ntorque.redis_shards``,
+      caching them on the registry, if provided. Returns ``None`` if the
+      channels aren't sharded.
+
+      Note that sharding is only supported by the default ``list``
+      transport, without fair scheduling.
+    """
+
+    def __init__(self, **kwargs):
+        self.redis_cls = kwargs.get('redis_cls', StrictRedis)
+        self.shards_cls = kwargs.get('shards_cls', RedisShards)
+
+    def __call__(self, settings, registry=None):
+        urls = parse_urls(settings.get('ntorque.redis_shards'))
+        transport_name = settings.get('ntorque.transport', DEFAULT_TRANSPORT)
+        if not urls or transport_name != DEFAULT_TRANSPORT or is_fair(settings):
+            return None
+        shards = getattr(registry, 'ntorque_redis_shards', None)
+        if shards is None:
+            clients = dict([(x, self.redis_cls.from_url(x)) for x in urls])
+            shards = self.shards_cls(clients)
+            if registry is not None:
+                registry.ntorque_redis_shards = shards
+        return shards
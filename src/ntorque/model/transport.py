@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+
+"""Provides notifiers that push task instructions onto a notification channel
+  using the configured transport. Notifiers share a common interface: they're
+  called with a ``channel`` and one or more ``instructions`` and have an
+  ``is_transactional`` flag.
+
+  The default ``list`` transport pushes onto a redis list, which workers
+  ``BLPOP`` from. The ``stream`` transport adds entries to a redis stream
+  (derived from the channel name, so the two can co-exist whilst switching
+  over) which workers read using a consumer group::
+
+      >>> get_stream('ntorque:high')
+      'ntorque:high:stream'
+
+  Redis notifiers should be called after the current transaction commits.
+  The ``postgres`` transport is transactional: it issues ``pg_notify`` within
+  the current transaction, so the notification is only delivered, to workers
+  that ``LISTEN`` on the channel, if and when the transaction commits::
+
+      >>> get_notifier(u'postgres').is_transactional
+      True
+
+  When the channels are sharded over multiple redis instances (see
+  ``ntorque.model.shard``), the ``ShardedNotifier`` pushes each instruction
+  onto the channel on its task's shard.
+
+  ``QueueDepth`` measures how many instructions are waiting on the redis
+  channels, so producers can back off when the consumers fall behind.
+"""
+
+__all__ = [
+    'ListNotifier',
+    'PostgresNotifier',
+    'QueueDepth',
+    'ShardedNotifier',
+    'StreamNotifier',
+    'get_notifier',
+    'get_stream',
+]
+
+import logging
+logger = logging.getLogger(__name__)
+
+from sqlalchemy.sql import text
+
+from . import instruction
+from . import orm as model
+from . import priority
+from .constants import TASK_PRIORITIES
+
+# The consumer group that workers read streams with and the stream entry field
+# that holds the instruction.
+CONSUMER_GROUP = 'ntorque'
+STREAM_FIELD = 'i'
+
+POSTGRES = u'postgres'
+STREAM = u'stream'
+
+def get_stream(channel):
+    """Return the redis stream key for ``channel``."""
+
+    return '{0}:stream'.format(channel)
+
+class ListNotifier(object):
+    """Push instructions onto a redis list."""
+
+    is_transactional = False
+
+    def __init__(self, redis):
+        self.redis = redis
+
+    def __call__(self, channel, *instructions):
+        return self.redis.rpush(channel, *instructions)
+
+class StreamNotifier(object):
+    """Add instructions to a redis stream."""
+
+    is_transactional = False
+
+    def __init__(self, redis, **kwargs):
+        self.redis = redis
+        self.field = kwargs.get('field', STREAM_FIELD)
+        self.get_stream = kwargs.get('get_stream', get_stream)
+
+    def __call__(self, channel, *instructions):
+        stream = self.get_stream(channel)
+        pipeline = self.redis.pipeline()
+        for item in instructions:
+            pipeline.execute_command('XADD', stream, '*', self.field, item)
+        return pipeline.execute()
+
+class PostgresNotifier(object):
+    """Issue a ``pg_notify`` per instruction in the current transaction."""
+
+    is_transactional = True
+
+    def __init__(self, **kwargs):
+        self.session = kwargs.get('session', model.Session)
+        self.statement = kwargs.get('statement',
+                text('SELECT pg_notify(:channel, :payload)'))
+
+    def __call__(self, channel, *instructions):
+        params = [{'channel': channel, 'payload': x} for x in instructions]
+        self.session.execute(self.statement, params)
+
+class ShardedNotifier(object):
+    """Push instructions onto the channel on their task's redis shard."""
+
+    is_transactional = False
+
+    def __init__(self, shards, **kwargs):
+        self.shards = shards
+        self.get_task_id = kwargs.get('get_task_id', instruction.get_task_id)
+        self.notifier_cls = kwargs.get('notifier_cls', ListNotifier)
+
+    def __call__(self, channel, *instructions):
+        by_shard = {}
+        for item in instructions:
+            client = self.shards.get(self.get_task_id(item))
+            by_shard.setdefault(client, []).append(item)
+        return [self.notifier_cls(client)(channel, *items)
+                for client, items in by_shard.items()]
+
+def get_notifier(transport_name, redis=None, shards=None, **kwargs):
+    """Return a notifier for the transport. Note that only the default
+      ``list`` transport supports ``shards``.
+    """
+
+    if transport_name == POSTGRES:
+        return PostgresNotifier(**kwargs)
+    if transport_name == STREAM:
+        return StreamNotifier(redis, **kwargs)
+    if shards is not None:
+        return ShardedNotifier(shards, **kwargs)
+    return ListNotifier(redis)
+
+class QueueDepth(object):
+    """Count the instructions waiting on every priority (and, if ``is_fair``,
+      every application's) sub-channel of ``channel``, summed over the
+      ``shards``, if provided. Stream entries are deleted when they're acked,
+      so a stream's length counts its unread and pending entries.
+
+      Returns ``None`` for the ``postgres`` transport, whose notifications
+      aren't queued.
+    """
+
+    def __init__(self, transport_name, redis=None, shards=None, is_fair=False,
+            **kwargs):
+        self.transport_name = transport_name
+        self.redis = redis
+        self.is_fair = is_fair
+        self.clients = [redis] if shards is None else shards.values()
+        self.get_apps_key = kwargs.get('get_apps_key', priority.get_apps_key)
+        self.get_channel = kwargs.get('get_channel', priority.get_channel)
+        self.get_stream = kwargs.get('get_stream', get_stream)
+        self.priorities = kwargs.get('priorities', TASK_PRIORITIES)
+
+    def __call__(self, channel):
+        if self.transport_name == POSTGRES:
+            return None
+
+        # Unpack the channel keys.
+        app_ids = [None]
+        if self.is_fair:
+            app_ids += list(self.redis.smembers(self.get_apps_key(channel)))
+        keys = [self.get_channel(channel, x, app_id=y)
+                for x in self.priorities for y in app_ids]
+
+        # Sum their lengths.
+        depth = 0
+        for client in self.clients:
+            pipeline = client.pipeline(transaction=False)
+            for key in keys:
+                if self.transport_name == STREAM:
+                    pipeline.execute_command('XLEN', self.get_stream(key))
+                else:
+                    pipeline.llen(key)
+            depth += sum(pipeline.execute())
+        return depth
@@ -27,6 +27,7 @@ TEST_SETTINGS = {
             'DATABASE_URL', u'postgresql:///ntorque_test')),
     'ntorque.mode': 'testing',
     'ntorque.redis_channel': 'ntorque:testing',
+    'ntorque.redis_schedule': 'ntorque:testing:scheduled',
 }
 
 class TestAppFactory(object):
@@ -362,6 +362,77 @@ class TestCreatedTaskNotification(unittest.TestCase):
         self.assertTrue(location1.endswith(str(id1)))
         self.assertTrue(location2.endswith(str(id2)))
 
+    def test_binary_notification(self):
+        """With the binary instruction format, a created task's instruction
+          carries its request data and a topic's tasks' just their ids.
+        """
+
+        from ntorque.model import instruction
+
+        # Setup.
+        settings = {
+            'ntorque.authenticate': False,
+            'ntorque.inline_max_size': 2048,
+            'ntorque.instruction_format': instruction.BINARY,
+        }
+        api = self.app_factory(**settings)
+        channel = self.app_factory.settings.get('ntorque.redis_channel')
+        redis = self.app_factory.redis_client
+
+        # Enque a task.
+        url = u'http://example.com/hook'
+        endpoint = '/?url=' + urllib.quote_plus(url.encode('utf-8'))
+        r = api.post_json(endpoint, params={u'foo': u'bar'}, status=201)
+        location = r.headers['Location']
+
+        # Its instruction carries the request data.
+        task_id, retry_count, inline_data = instruction.decode(
+                redis.lpop(channel))
+        self.assertTrue(location.endswith(str(task_id)))
+        self.assertEquals(retry_count, 0)
+        self.assertEquals(inline_data['url'], url)
+        self.assertEquals(json.loads(inline_data['body']), {u'foo': u'bar'})
+
+        # Publishing to a topic pushes an instruction per task.
+        quoted = urllib.quote_plus(url.encode('utf-8'))
+        api.post('/topics?name=foo&url=' + quoted, status=201)
+        r = api.post_json('/topics/foo', params={u'foo': u'bar'}, status=201)
+        self.assertEquals(redis.llen(channel), 1)
+        task_id, retry_count, inline_data = instruction.decode(
+                redis.lpop(channel))
+        self.assertTrue(r.json['tasks'][0].endswith(str(task_id)))
+        self.assertEquals(retry_count, 0)
+
+    def test_binary_notification_not_inlined(self):
+        """The request data of scheduled tasks and tasks for an endpoint
+          isn't inlined, as it can change before they're performed.
+        """
+
+        from ntorque.model import instruction
+
+        # Setup.
+        settings = {
+            'ntorque.authenticate': False,
+            'ntorque.inline_max_size': 2048,
+            'ntorque.instruction_format': instruction.BINARY,
+        }
+        api = self.app_factory(**settings)
+        channel = self.app_factory.settings.get('ntorque.redis_channel')
+        schedule = self.app_factory.settings.get('ntorque.redis_schedule')
+        redis = self.app_factory.redis_client
+
+        # Schedule a task.
+        url = u'http://example.com/hook'
+        quoted = urllib.quote_plus(url.encode('utf-8'))
+        api.post('/?delay=60&url=' + quoted, status=201)
+        data, = redis.zrange(schedule, 0, -1)
+        self.assertEquals(instruction.decode(data)[2], None)
+
+        # Enqueue a task for an endpoint.
+        api.post('/endpoints?name=hooks&url=' + quoted, status=201)
+        api.post('/?endpoint=hooks&path=/foo', status=201)
+        self.assertEquals(instruction.decode(redis.lpop(channel))[2], None)
+
     def test_manual_push_notification(self):
         """Test creating a task manually and then pushing a notification."""
 
@@ -401,3 +472,346 @@ class TestCreatedTaskNotification(unittest.TestCase):
         self.assertTrue(retry_count is 0)
         self.assertTrue(location.endswith(str(task_id)))
 
+class TestAsyncCompletion(unittest.TestCase):
+    """Test asynchronously completing and failing tasks using their token."""
+
+    def setUp(self):
+        self.app_factory = boilerplate.TestAppFactory()
+
+    def tearDown(self):
+        self.app_factory.drop()
+
+    def makeTask(self):
+        from ntorque.model.api import TaskFactory
+        factory = TaskFactory(None, u'http://example.com/hook', 20, u'POST')
+        with transaction.manager:
+            task = factory()
+            return task.id, task.token.encode('utf-8')
+
+    def test_complete(self):
+        """Completing with the right token completes the task."""
+
+        from ntorque import model
+        api = self.app_factory()
+        task_id, token = self.makeTask()
+
+        # Complete it.
+        path = '/tasks/{0}/complete'.format(task_id)
+        r = api.post(path, headers={'NTORQUE-TASK-TOKEN': token}, status=200)
+        self.assertEquals(r.json['status'], u'COMPLETED')
+        with transaction.manager:
+            task = model.LookupTask()(task_id)
+            self.assertEquals(task.status, u'COMPLETED')
+
+        # It can't then be failed.
+        path = '/tasks/{0}/fail'.format(task_id)
+        api.post(path, headers={'NTORQUE-TASK-TOKEN': token}, status=409)
+
+    def test_invalid_token(self):
+        """Resolving a task requires its token."""
+
+        api = self.app_factory()
+        task_id, token = self.makeTask()
+        path = '/tasks/{0}/fail'.format(task_id)
+        api.post(path, status=403)
+        api.post(path, headers={'NTORQUE-TASK-TOKEN': 'wrong'}, status=403)
+
+class TestTaskPriority(unittest.TestCase):
+    """Test routing task notifications by priority."""
+
+    def setUp(self):
+        self.app_factory = boilerplate.TestAppFactory()
+
+    def tearDown(self):
+        self.app_factory.drop()
+
+    def test_priority_channel(self):
+        """High priority notifications are pushed onto the high channel."""
+
+        # Setup.
+        api = self.app_factory(**{'ntorque.authenticate': False})
+        settings = self.app_factory.settings
+        channel = settings.get('ntorque.redis_channel')
+        redis = self.app_factory.redis_client
+
+        # Enque a normal and a high priority task.
+        url = urllib.quote_plus(u'http://example.com/hook'.encode('utf-8'))
+        api.post('/?url=' + url, status=201)
+        api.post('/?priority=high&url=' + url, status=201)
+        self.assertEquals(redis.llen(channel), 1)
+        self.assertEquals(redis.llen(channel + ':high'), 1)
+
+    def test_invalid_priority(self):
+        """Invalid priorities are bad requests."""
+
+        api = self.app_factory(**{'ntorque.authenticate': False})
+        url = urllib.quote_plus(u'http://example.com/hook'.encode('utf-8'))
+        api.post('/?priority=urgent&url=' + url, status=400)
+
+    def test_application_default_priority(self):
+        """Tasks default to their application's default priority."""
+
+        from ntorque import model
+        create_app = model.CreateApplication()
+        get_key = model.GetActiveKey()
+        get_task = model.LookupTask()
+
+        # Create an application with a low default priority.
+        api = self.app_factory()
+        with transaction.manager:
+            app = create_app(u'example')
+            app.default_priority = u'low'
+            api_key = get_key(app).value.encode('utf-8')
+        headers = {'NTORQUE_API_KEY': api_key}
+
+        # Enque a task.
+        url = urllib.quote_plus(u'http://example.com/hook'.encode('utf-8'))
+        r = api.post('/?url=' + url, headers=headers, status=201)
+        task_id = int(r.headers['Location'].split('/')[-1])
+        with transaction.manager:
+            task_priority = get_task(task_id).priority
+        self.assertEquals(task_priority, u'low')
+
+class TestScheduledTasks(unittest.TestCase):
+    """Test enqueing tasks with a ``delay`` or ``due`` date."""
+
+    def setUp(self):
+        self.app_factory = boilerplate.TestAppFactory()
+
+    def tearDown(self):
+        self.app_factory.drop()
+
+    def test_delay(self):
+        """Delayed tasks are due in the future and scheduled, not pushed."""
+
+        from ntorque import model
+        get_task = model.LookupTask()
+
+        # Setup.
+        api = self.app_factory(**{'ntorque.authenticate': False})
+        settings = self.app_factory.settings
+        channel = settings.get('ntorque.redis_channel')
+        schedule = settings.get('ntorque.redis_schedule')
+        redis = self.app_factory.redis_client
+
+        # Enque the task.
+        url = u'http://example.com/hook'
+        endpoint = '/?delay=60&url=' + urllib.quote_plus(url.encode('utf-8'))
+        r = api.post(endpoint, status=201)
+        task_id = int(r.headers['Location'].split('/')[-1])
+
+        # It's due in the future.
+        with transaction.manager:
+            task = get_task(task_id)
+            task_due = task.due
+        self.assertTrue(task_due > datetime.utcnow() + timedelta(seconds=55))
+
+        # And its instruction is in the schedule, not the channel.
+        self.assertEquals(redis.llen(channel), 0)
+        self.assertEquals(redis.zrange(schedule, 0, -1), ['{0}:0'.format(task_id)])
+
+    def test_due(self):
+        """Tasks can be scheduled for an ISO 8601 due date."""
+
+        from ntorque import model
+        get_task = model.LookupTask()
+
+        # Setup.
+        api = self.app_factory(**{'ntorque.authenticate': False})
+
+        # Enque the task.
+        url = u'http://example.com/hook'
+        endpoint = '/?due=2100-01-01T12:00:00Z&url='
+        endpoint += urllib.quote_plus(url.encode('utf-8'))
+        r = api.post(endpoint, status=201)
+        task_id = int(r.headers['Location'].split('/')[-1])
+
+        # It's due when specified.
+        with transaction.manager:
+            task = get_task(task_id)
+            task_due = task.due
+        self.assertEquals(task_due, datetime(2100, 1, 1, 12))
+
+    def test_invalid_due(self):
+        """Invalid due dates and delays are bad requests."""
+
+        api = self.app_factory(**{'ntorque.authenticate': False})
+        url = urllib.quote_plus(u'http://example.com/hook'.encode('utf-8'))
+        api.post('/?due=tomorrow&url=' + url, status=400)
+        api.post('/?delay=-1&url=' + url, status=400)
+        api.post('/?delay=1&due=2100-01-01&url=' + url, status=400)
+
+class TestTopics(unittest.TestCase):
+    """Test subscribing to and publishing to topics."""
+
+    def setUp(self):
+        self.app_factory = boilerplate.TestAppFactory()
+
+    def tearDown(self):
+        self.app_factory.drop()
+
+    def test_publish_to_missing_topic(self):
+        """Publishing to a topic without subscriptions is not found."""
+
+        api = self.app_factory(**{'ntorque.authenticate': False})
+        r = api.post('/topics/foo', status=404)
+
+    def test_subscribe(self):
+        """Subscribing creates the topic and returns its location."""
+
+        api = self.app_factory(**{'ntorque.authenticate': False})
+        url = u'http://example.com/hook'
+        endpoint = '/topics?name=foo&url=' + urllib.quote_plus(url.encode('utf-8'))
+        r = api.post(endpoint, status=201)
+        location = r.headers['Location']
+        self.assertTrue(location.endswith('/topics/foo'))
+
+        # The topic lists the subscription.
+        r = api.get_json(location, status=200)
+        self.assertEquals(r.json['name'], u'foo')
+        self.assertEquals(r.json['subscriptions'][0]['url'], url)
+
+    def test_publish(self):
+        """Publishing fans out to a task per subscription with a shared body."""
+
+        from ntorque import model
+        get_task = model.LookupTask()
+
+        # Setup.
+        api = self.app_factory(**{'ntorque.authenticate': False})
+        settings = self.app_factory.settings
+        channel = settings.get('ntorque.redis_channel')
+        redis = self.app_factory.redis_client
+
+        # Subscribe two web hooks.
+        for url in (u'http://example.com/a', u'http://example.com/b'):
+            quoted = urllib.quote_plus(url.encode('utf-8'))
+            api.post('/topics?name=foo&url=' + quoted, status=201)
+
+        # Publish.
+        params = {u'foo': u'b€r'}
+        r = api.post_json('/topics/foo', params=params, status=201)
+        locations = r.json['tasks']
+        self.assertEquals(len(locations), 2)
+
+        # A notification is pushed per task.
+        self.assertEquals(redis.llen(channel), 2)
+
+        # And the tasks share a single stored body.
+        task_ids = [int(item.split('/')[-1]) for item in locations]
+        with transaction.manager:
+            tasks = [get_task(item) for item in task_ids]
+            payload_ids = set([item.payload_id for item in tasks])
+            urls = set([item.url for item in tasks])
+            data = tasks[0].__json__(include_request_data=True)
+        self.assertEquals(len(payload_ids), 1)
+        self.assertEquals(urls, set([u'http://example.com/a',
+                u'http://example.com/b']))
+        self.assertEquals(data['enctype'], u'application/json')
+        self.assertEquals(json.loads(data['body']), params)
+
+    def test_publish_fair(self):
+        """When fair scheduling, a topic's tasks belong to its application
+          and are pushed onto its sub-channel.
+        """
+
+        from ntorque import model
+        from ntorque.model import priority
+
+        # Setup.
+        api = self.app_factory(**{'ntorque.fair_scheduling': True})
+        settings = self.app_factory.settings
+        channel = settings.get('ntorque.redis_channel')
+        redis = self.app_factory.redis_client
+        with transaction.manager:
+            app = model.CreateApplication()(u'example')
+            app_id = app.id
+            api_key = model.GetActiveKey()(app).value.encode('utf-8')
+        headers = {'NTORQUE_API_KEY': api_key}
+
+        # Subscribe and publish.
+        quoted = urllib.quote_plus(u'http://example.com/hook'.encode('utf-8'))
+        api.post('/topics?name=foo&url=' + quoted, headers=headers, status=201)
+        r = api.post_json('/topics/foo', params={u'foo': u'bar'},
+                headers=headers, status=201)
+
+        # The task belongs to the application and is on its sub-channel.
+        task_id = int(r.json['tasks'][0].split('/')[-1])
+        with transaction.manager:
+            self.assertEquals(model.LookupTask()(task_id).app_id, app_id)
+        self.assertEquals(redis.llen(channel), 0)
+        key = priority.get_channel(channel, u'normal', app_id=app_id)
+        self.assertEquals(redis.lpop(key), '{0}:0'.format(task_id))
+
+class TestEndpoints(unittest.TestCase):
+    """Test registering endpoints and enqueuing tasks that reference them."""
+
+    def setUp(self):
+        self.app_factory = boilerplate.TestAppFactory()
+
+    def tearDown(self):
+        self.app_factory.drop()
+
+    def test_register(self):
+        """Registering an endpoint returns its location."""
+
+        api = self.app_factory(**{'ntorque.authenticate': False})
+        url = u'http://example.com/hooks'
+        quoted = urllib.quote_plus(url.encode('utf-8'))
+        headers = {'NTORQUE-PASSTHROUGH-FOO': 'Bar'}
+        endpoint = '/endpoints?name=hooks&max_retries=3&url=' + quoted
+        r = api.post(endpoint, headers=headers, status=201)
+        location = r.headers['Location']
+        self.assertTrue(location.endswith('/endpoints/hooks'))
+
+        # The endpoint is stored with its default headers.
+        r = api.get_json(location, status=200)
+        self.assertEquals(r.json['url'], url)
+        self.assertEquals(r.json['max_retries'], 3)
+        self.assertEquals(r.json['headers'], {u'Foo': u'Bar'})
+
+    def test_unknown_endpoint(self):
+        """Enqueuing a task for an unregistered endpoint is a bad request."""
+
+        api = self.app_factory(**{'ntorque.authenticate': False})
+        r = api.post('/?endpoint=foo', status=400)
+
+    def test_task_with_endpoint(self):
+        """Tasks reference the endpoint and append the path to its url."""
+
+        from ntorque import model
+        get_task = model.LookupTask()
+
+        # Register an endpoint.
+        api = self.app_factory(**{'ntorque.authenticate': False})
+        quoted = urllib.quote_plus('http://example.com/hooks')
+        headers = {'NTORQUE-PASSTHROUGH-FOO': 'Bar'}
+        api.post('/endpoints?name=hooks&method=PUT&url=' + quoted,
+                headers=headers, status=201)
+
+        # Enqueue a task that references it.
+        r = api.post('/?endpoint=hooks&path=/foo', status=201)
+        task_id = int(r.headers['Location'].split('/')[-1])
+        with transaction.manager:
+            task = get_task(task_id)
+            data = task.__json__(include_request_data=True)
+            self.assertEquals(task.url, None)
+            self.assertTrue(task.endpoint_id is not None)
+
+        # The task data is derived from the endpoint.
+        self.assertEquals(data['url'], u'http://example.com/hooks/foo')
+        self.assertEquals(data['method'], u'PUT')
+        self.assertEquals(data['headers'], {u'Foo': u'Bar'})
+
+    def test_invalid_path(self):
+        """Paths that could change the endpoint's host or that are too long
+          are bad requests.
+        """
+
+        api = self.app_factory(**{'ntorque.authenticate': False})
+        quoted = urllib.quote_plus('http://example.com/hooks')
+        api.post('/endpoints?name=hooks&url=' + quoted, status=201)
+        quoted = urllib.quote_plus('@other.example.com/x')
+        api.post('/?endpoint=hooks&path=' + quoted, status=400)
+        api.post('/?endpoint=hooks&path=/' + 'a' * 256, status=400)
+        api.post('/?endpoint=hooks&path=?foo=bar', status=201)
@@ -187,3 +187,56 @@ class TestDispatch(unittest.TestCase):
         task_id, retry_count = map(int, redis.lpop(channel).split(':'))
         self.assertTrue(task_id == task_id)
 
+    def test_hybrid_with_notifier(self):
+        """Use a notifier to notify the workers directly."""
+
+        from ntorque.model import transport
+
+        # Instantiate.
+        factory = self.app_factory
+        channel = factory.settings.get('ntorque.redis_channel')
+        redis = factory.redis_client
+        notifier = transport.ListNotifier(redis)
+        dispatcher = client.NoopDispatcher()
+        cli = client.HybridTorqueClient(dispatcher, 'http://localhost',
+                notifier=notifier, channel=channel)
+
+        # Enqueue.
+        with transaction.manager:
+            status, _, _ = cli('http://example.com/hook')
+        self.assertEquals(status, client.SUCCESS)
+
+        # Assert that the notification was pushed when the tx committed.
+        task_id, retry_count = map(int, redis.lpop(channel).split(':'))
+        self.assertEquals(retry_count, 0)
+
+    def test_hybrid_with_sharded_notifier(self):
+        """Use a sharded notifier to push onto the task's redis shard."""
+
+        from mock import Mock
+        from ntorque.model import shard
+        from ntorque.model import transport
+
+        # Instantiate, with the real redis client as one of two shards.
+        factory = self.app_factory
+        channel = factory.settings.get('ntorque.redis_channel')
+        redis = factory.redis_client
+        shards = shard.RedisShards({'redis://a': redis, 'redis://b': Mock()})
+        notifier = transport.ShardedNotifier(shards)
+        dispatcher = client.NoopDispatcher()
+        cli = client.HybridTorqueClient(dispatcher, 'http://localhost',
+                notifier=notifier, channel=channel)
+
+        # Enqueue tasks until one is routed to the real redis client.
+        for i in range(50):
+            with transaction.manager:
+                cli('http://example.com/hook')
+            if redis.llen(channel):
+                break
+
+        # Only tasks routed to that shard are pushed onto it.
+        task_id, retry_count = map(int, redis.lpop(channel).split(':'))
+        self.assertTrue(shards.get(task_id) is redis)
+        for call in shards.clients['redis://b'].rpush.call_args_list:
+            task_id = int(call[0][1].split(':')[0])
+            self.assertTrue(shards.get(task_id) is not redis)
@@ -12,6 +12,16 @@ import unittest
 
 from ntorque.tests import boilerplate
 
+def get_spawned(thread_cls, index=None):
+    """Return the args of the threads spawned using a ``Mock`` thread class,
+      or, if provided, the arg at ``index``.
+    """
+
+    args = [x[1]['args'] for x in thread_cls.call_args_list]
+    if index is None:
+        return args
+    return [x[index] for x in args]
+
 class TestChannelConsumer(unittest.TestCase):
     """Test consuming instructions from the redis channel."""
 
@@ -22,10 +32,899 @@ class TestChannelConsumer(unittest.TestCase):
     def tearDown(self):
         self.config_factory.drop()
 
-    #def test_foo(self):
-    #    """XXX"""
-    #
-    #    self.assertTrue('foo' == 'foo')
+    def test_weighted_channels(self):
+        """Channels are preferred in proportion to their weights, falling back
+          on the other channels in order.
+        """
+
+        from ntorque.work.consume import ChannelConsumer
+
+        weights = [('high', 2), ('normal', 1)]
+        consumer = ChannelConsumer(None, ['high', 'normal'], weights=weights)
+        sequence = [consumer.next_channels() for i in range(3)]
+        self.assertEquals(sequence, [
+            ['high', 'normal'],
+            ['normal', 'high'],
+            ['high', 'normal'],
+        ])
+
+    def test_pop_batch(self):
+        """Instructions are popped in batches, draining the preferred channel
+          first.
+        """
+
+        from ntorque.work.consume import ChannelConsumer
+
+        redis = self.config_factory.redis_client
+        redis.rpush('high', '1:0', '2:0')
+        redis.rpush('normal', '3:0', '4:0')
+        consumer = ChannelConsumer(redis, ['high', 'normal'])
+        self.assertEquals(consumer.pop(3), ['1:0', '2:0', '3:0'])
+        self.assertEquals(redis.lrange('normal', 0, -1), ['4:0'])
+        self.assertEquals(consumer.pop(3), ['4:0'])
+
+    def test_max_in_flight(self):
+        """The consumer only pops as many instructions as it has capacity to
+          perform.
+        """
+
+        from mock import Mock
+        from ntorque.work.consume import ChannelConsumer
+
+        thread_cls = Mock()
+
+        consumer = ChannelConsumer(None, ['normal'], max_in_flight=3,
+                thread_cls=thread_cls)
+        self.assertEquals(consumer.wait_for_capacity(), 3)
+        consumer.spawn('1:0')
+        consumer.spawn('2:0')
+        self.assertEquals(consumer.wait_for_capacity(), 1)
+
+    def test_adaptive_pool(self):
+        """The consumer's capacity grows whilst the web hooks are healthy
+          and shrinks when they're slow.
+        """
+
+        from ntorque.work.consume import ChannelConsumer
+        from ntorque.work.pool import WorkerPool
+
+        pool = WorkerPool(max_size=8, min_size=2, adaptive=True, window=1,
+                target_latency=5)
+        consumer = ChannelConsumer(None, ['normal'], pool=pool)
+        self.assertEquals(consumer.wait_for_capacity(), 2)
+        pool.record(0.1)
+        pool.record(0.1)
+        self.assertEquals(consumer.wait_for_capacity(), 4)
+        pool.record(60)
+        self.assertEquals(consumer.wait_for_capacity(), 2)
+
+    def test_drop_duplicates(self):
+        """Instructions that are in flight or were recently performed are
+          dropped and counted.
+        """
+
+        from mock import Mock
+        from ntorque.work.consume import ChannelConsumer
+        from ntorque.work.metrics import Metrics
+
+        thread_cls = Mock()
+        metrics = Metrics()
+        consumer = ChannelConsumer(None, ['normal'], metrics=metrics,
+                thread_cls=thread_cls)
+        consumer.spawn('1:0')
+        consumer.spawn('1:0')
+        consumer.seen.done('1:0')
+        consumer.spawn('1:0')
+        consumer.spawn('1:1')
+        self.assertEquals(get_spawned(thread_cls, 0), ['1:0', '1:1'])
+        self.assertEquals(metrics.snapshot()['consume.duplicates'], 2)
+
+    def test_acquire_error(self):
+        """Instructions whose acquire query fails aren't dropped as duplicates
+          when they're pushed again, unlike those that were acquired.
+        """
+
+        from threading import Event
+        from mock import Mock
+        from sqlalchemy.exc import SQLAlchemyError
+        from ntorque.work.consume import ChannelConsumer
+        from ntorque.work.perform import TaskPerformer
+
+        # Setup a performer whose acquire query fails.
+        task_manager = Mock()
+        task_manager.is_expired = False
+        task_manager.acquire.side_effect = SQLAlchemyError('db is down')
+        handler_cls = lambda **kwargs: TaskPerformer(session=Mock(),
+                task_manager_cls=lambda: task_manager, **kwargs)
+        consumer = ChannelConsumer(None, ['normal'], handler_cls=handler_cls)
+        consumer.control_flag = Event()
+
+        # The instruction is forgotten.
+        self.assertTrue(consumer.seen.add('1:0'))
+        consumer.perform('1:0')
+        self.assertTrue(consumer.seen.add('1:0'))
+
+        # Whereas a miss is remembered.
+        task_manager.acquire.side_effect = None
+        task_manager.acquire.return_value = None
+        consumer.perform('1:0')
+        self.assertFalse(consumer.seen.add('1:0'))
+
+    def test_acquire_batch_error(self):
+        """A batch of instructions whose acquire statement fails isn't
+          dropped as duplicates when it's pushed again.
+        """
+
+        from mock import Mock
+        from sqlalchemy.exc import SQLAlchemyError
+        from ntorque.work.consume import ChannelConsumer
+
+        task_manager = Mock()
+        task_manager.acquire_many.side_effect = SQLAlchemyError('db is down')
+        consumer = ChannelConsumer(None, ['normal'], session=Mock(),
+                task_manager_cls=lambda: task_manager)
+        consumer.spawn_batch(['1:0', '2:0'])
+        self.assertTrue(consumer.seen.add('1:0'))
+        self.assertTrue(consumer.seen.add('2:0'))
+
+    def test_degraded_mode(self):
+        """When redis keeps failing, the consumer claims tasks from the db
+          until redis responds again.
+        """
+
+        from mock import Mock
+        from redis import StrictRedis
+        from ntorque.work.consume import ChannelConsumer
+        from ntorque.work.metrics import Metrics
+
+        thread_cls = Mock()
+        # Setup a consumer with nothing listening on its redis port.
+        claim = Mock()
+        claim.return_value = [{'id': 1}]
+        metrics = Metrics()
+        consumer = ChannelConsumer(StrictRedis(port=1), ['normal'],
+                degrade_after=0, claim=claim, metrics=metrics, sleep=Mock(),
+                thread_cls=thread_cls)
+
+        # Redis fails, so due tasks are claimed from the db.
+        consumer.redis_failed()
+        self.assertTrue(consumer.is_degraded)
+        consumer.consume_degraded()
+        self.assertEquals(get_spawned(thread_cls), [({'id': 1},)])
+
+        # Until redis responds.
+        consumer.clients = [self.config_factory.redis_client]
+        consumer.consume_degraded()
+        self.assertFalse(consumer.is_degraded)
+        snapshot = metrics.snapshot()
+        self.assertEquals(snapshot['consume.degraded.entered'], 1)
+        self.assertEquals(snapshot['consume.degraded.exited'], 1)
+        self.assertEquals(snapshot['consume.degraded'], 0)
+
+    def test_listen_consumer_order(self):
+        """Notifications received together are handled in weighted order."""
+
+        from collections import namedtuple
+        from ntorque.work.consume import ListenConsumer
+
+        Notify = namedtuple('Notify', ['channel', 'payload'])
+        notifications = [Notify('normal', '1:0'), Notify('normal', '2:0'),
+                Notify('high', '3:0'), Notify('high', '4:0')]
+        weights = [('high', 2), ('normal', 1)]
+        consumer = ListenConsumer(None, ['high', 'normal'], weights=weights)
+        self.assertEquals(consumer.order(notifications),
+                ['3:0', '1:0', '4:0', '2:0'])
+
+    def test_stream_consumer_claims_dead_consumers_entries(self):
+        """Entries left pending by a dead consumer are claimed and performed
+          with ``recover=True``, whilst entries in flight are kept alive.
+        """
+
+        from ntorque.model import transport
+        from ntorque.work.consume import StreamConsumer
+
+        # Setup.
+        redis = self.config_factory.redis_client
+        channel = self.config_factory.settings.get('ntorque.redis_channel')
+        stream = transport.get_stream(channel)
+        notify = transport.StreamNotifier(redis)
+        notify(channel, '1:0', '2:0')
+
+        # A consumer reads both entries and then dies.
+        dead = StreamConsumer(redis, [channel], 'dead')
+        dead.create_groups()
+        entries = dead.read(0.01)
+        self.assertEquals([x[2] for x in entries], ['1:0'])
+        entries = dead.read(0.01)
+        self.assertEquals([x[2] for x in entries], ['2:0'])
+
+        # Another consumer claims them once they've been idle long enough.
+        consumer = StreamConsumer(redis, [channel], 'alive', claim_idle=0)
+        claimed = consumer.claim()
+        self.assertEquals([x[2] for x in claimed], ['1:0', '2:0'])
+
+        # Acknowledging deletes the entry.
+        consumer.ack(stream, claimed[0][1])
+        self.assertEquals(redis.execute_command('XLEN', stream), 1)
+
+    def test_stream_consumer_capacity(self):
+        """Stream entries are read in batches and only whilst the pool has
+          capacity to perform them.
+        """
+
+        from mock import Mock
+        from ntorque.model import transport
+        from ntorque.work.consume import StreamConsumer
+
+        thread_cls = Mock()
+
+        # Setup.
+        redis = self.config_factory.redis_client
+        channel = self.config_factory.settings.get('ntorque.redis_channel')
+        notify = transport.StreamNotifier(redis)
+        notify(channel, '1:0', '2:0', '3:0')
+
+        # Entries are read in batches.
+        consumer = StreamConsumer(redis, [channel], 'test', max_in_flight=2,
+                thread_cls=thread_cls)
+        consumer.create_groups()
+        entries = consumer.read(0.01, 2)
+        self.assertEquals([x[2] for x in entries], ['1:0', '2:0'])
+
+        # Performing them fills the pool.
+        for stream, entry_id, data in entries:
+            consumer.spawn_entry(stream, entry_id, data)
+        self.assertEquals(consumer.wait_for_capacity(timeout=0), 0)
+
+    def test_fair_consumer_round(self):
+        """Each application gets instructions performed in proportion to its
+          share, up to its in-flight cap.
+        """
+
+        from mock import Mock
+        from ntorque.model import priority
+        from ntorque.work.consume import FairConsumer
+
+        # Setup.
+        redis = self.config_factory.redis_client
+        channel = self.config_factory.settings.get('ntorque.redis_channel')
+        redis.sadd(priority.get_apps_key(channel), 1, 2, 3)
+        for app_id in (1, 2, 3):
+            key = priority.get_channel(channel, u'normal', app_id=app_id)
+            redis.rpush(key, *['{0}{1}:0'.format(app_id, x) for x in range(5)])
+        thread_cls = Mock()
+        # App 2 has twice the share of app 1 and app 3 is capped at one.
+        policies = {1: (1, None), 2: (2, None), 3: (1, 1)}
+        consumer = FairConsumer(redis, [channel], 'test',
+                get_policies=lambda: policies, thread_cls=thread_cls)
+        consumer.refresh()
+        self.assertEquals(consumer.round(), (4, False))
+        spawned = get_spawned(thread_cls, 1)
+        self.assertEquals(spawned, ['10:0', '20:0', '21:0', '30:0'])
+        self.assertEquals(consumer.round(), (3, True))
+        spawned = get_spawned(thread_cls, 1)
+        self.assertEquals(spawned[4:], ['11:0', '22:0', '23:0'])
+
+    def test_fair_consumer_capacity(self):
+        """A round spawns no more instructions than the pool has capacity
+          for and the next round starts with the applications that missed out.
+        """
+
+        from mock import Mock
+        from ntorque.model import priority
+        from ntorque.work.consume import FairConsumer
+
+        # Setup.
+        redis = self.config_factory.redis_client
+        channel = self.config_factory.settings.get('ntorque.redis_channel')
+        redis.sadd(priority.get_apps_key(channel), 1, 2, 3)
+        for app_id in (1, 2, 3):
+            key = priority.get_channel(channel, u'normal', app_id=app_id)
+            redis.rpush(key, *['{0}{1}:0'.format(app_id, x) for x in range(5)])
+        thread_cls = Mock()
+        # App 2 has twice the share of the others.
+        policies = {1: (1, None), 2: (2, None), 3: (1, None)}
+        consumer = FairConsumer(redis, [channel], 'test', max_in_flight=4,
+                get_policies=lambda: policies, thread_cls=thread_cls)
+        consumer.refresh()
+        self.assertEquals(consumer.round(2), (2, False))
+        spawned = get_spawned(thread_cls, 1)
+        self.assertEquals(spawned, ['10:0', '20:0'])
+        self.assertEquals(consumer.round(2), (2, False))
+        spawned = get_spawned(thread_cls, 1)
+        self.assertEquals(spawned[2:], ['30:0', '11:0'])
+        self.assertEquals(consumer.wait_for_capacity(timeout=0), 0)
+
+
+class TestScheduleReleaser(unittest.TestCase):
+    """Test releasing scheduled instructions onto the redis channel."""
+
+    def setUp(self):
+        self.config_factory = boilerplate.TestConfigFactory()
+        self.registry = self.config_factory().registry
+
+    def tearDown(self):
+        self.config_factory.drop()
+
+    def test_release(self):
+        """Only instructions that are due are released, in due order."""
+
+        import time
+        from ntorque.work.schedule import ScheduleReleaser
+
+        # Setup.
+        settings = self.config_factory.settings
+        channel = settings.get('ntorque.redis_channel')
+        schedule = settings.get('ntorque.redis_schedule')
+        redis = self.config_factory.redis_client
+
+        # Schedule two due and one future instruction.
+        now = time.time()
+        redis.zadd(schedule, **{'1:0': now - 1, '2:0': now - 2, '3:0': now + 60})
+
+        # Release.
+        releaser = ScheduleReleaser(redis, schedule, channel)
+        self.assertEquals(releaser.release(), 2)
+        self.assertEquals(redis.lrange(channel, 0, -1), ['2:0', '1:0'])
+        self.assertEquals(redis.zrange(schedule, 0, -1), ['3:0'])
+
+        # The next delay is capped at the interval.
+        self.assertEquals(releaser.next_delay(), releaser.interval)
+
+
+class TestQueueRebuilder(unittest.TestCase):
+    """Test rebuilding the redis channels from the db."""
+
+    def setUp(self):
+        self.config_factory = boilerplate.TestConfigFactory()
+        self.registry = self.config_factory().registry
+
+    def tearDown(self):
+        self.config_factory.drop()
+
+    def test_rebuild(self):
+        """Due tasks are pushed onto the channel and future tasks are added
+          to the schedule, once per redis instance.
+        """
+
+        from datetime import datetime
+        from datetime import timedelta
+        from ntorque import model
+        from ntorque.work.rebuild import QueueRebuilder
+
+        # Setup.
+        settings = self.config_factory.settings
+        channel = settings.get('ntorque.redis_channel')
+        schedule = settings.get('ntorque.redis_schedule')
+        redis = self.config_factory.redis_client
+
+        # Create a due and a scheduled task.
+        now = datetime.utcnow()
+        factory = model.TaskFactory(None, u'http://example.com', 20, u'POST')
+        with transaction.manager:
+            due = factory(due=now - timedelta(seconds=1)).id
+            scheduled = factory(due=now + timedelta(seconds=60)).id
+
+        # Rebuild.
+        rebuilder = QueueRebuilder(redis, channel, schedule, batch_size=1)
+        self.assertEquals(rebuilder.check(), 2)
+        self.assertEquals(redis.lrange(channel, 0, -1), ['{0}:0'.format(due)])
+        self.assertEquals(redis.zrange(schedule, 0, -1),
+                ['{0}:0'.format(scheduled)])
+
+        # Checking again is a noop, until the redis data is lost.
+        self.assertEquals(rebuilder.check(), None)
+        redis.flushdb()
+        self.assertEquals(rebuilder.check(), 2)
+
+
+class TestRequeuePoller(unittest.TestCase):
+    """Test requeueing due tasks from the db."""
+
+    def setUp(self):
+        self.config_factory = boilerplate.TestConfigFactory()
+        self.registry = self.config_factory().registry
+
+    def tearDown(self):
+        self.config_factory.drop()
+
+    def test_high_water(self):
+        """The poller only requeues enough tasks to fill the channels up to
+          the high water mark.
+        """
+
+        from ntorque.work.requeue import RequeuePoller
+
+        # Setup.
+        channel = self.config_factory.settings.get('ntorque.redis_channel')
+        redis = self.config_factory.redis_client
+        poller = RequeuePoller(redis, channel, limit=10, high_water=12)
+
+        # The capacity shrinks as the priority channels fill up.
+        self.assertEquals(poller.capacity(), 10)
+        redis.rpush(channel, '1:0', '2:0', '3:0')
+        redis.rpush('{0}:high'.format(channel), '4:0', '5:0', '6:0')
+        self.assertEquals(poller.capacity(), 6)
+        redis.rpush(channel, *['{0}:0'.format(x) for x in range(7, 20)])
+        self.assertEquals(poller.capacity(), 0)
+
+        # Unless the check is disabled.
+        poller.high_water = 0
+        self.assertEquals(poller.capacity(), 10)
+
+
+class TestStatusWriter(unittest.TestCase):
+    """Test writing back task statuses in batches."""
+
+    def setUp(self):
+        self.config_factory = boilerplate.TestConfigFactory()
+        self.registry = self.config_factory().registry
+
+    def tearDown(self):
+        self.config_factory.drop()
+
+    def test_flush(self):
+        """Buffered outcomes are written with a statement per action, iff
+          the task hasn't been acquired again since.
+        """
+
+        from ntorque import model
+        from ntorque.work.metrics import Metrics
+        from ntorque.work.writer import StatusWriter
+
+        # Create and acquire some tasks.
+        factory = model.TaskFactory(None, u'http://example.com', 20, u'POST')
+        with transaction.manager:
+            ids = [factory().id for i in range(4)]
+        tasks, _ = model.TaskManager().acquire_many([(x, 0) for x in ids])
+        self.assertEquals(len(tasks), 4)
+
+        # Buffer their outcomes, including a stale one.
+        metrics = Metrics()
+        writer = StatusWriter(metrics=metrics)
+        statuses = model.TASK_STATUSES
+        self.assertEquals(writer.add('complete', ids[0], 1), statuses['completed'])
+        self.assertEquals(writer.add('complete', ids[1], 1), statuses['completed'])
+        self.assertEquals(writer.add('fail', ids[2], 1), statuses['failed'])
+        self.assertEquals(writer.add('complete', ids[3], 0), statuses['completed'])
+
+        # Flush them.
+        self.assertEquals(writer.flush(), 3)
+        self.assertEquals(metrics.snapshot()['status_writer.commits'], 2)
+        with transaction.manager:
+            tasks = dict([(x.id, x.status) for x in model.Task.query])
+        self.assertEquals(tasks[ids[0]], statuses['completed'])
+        self.assertEquals(tasks[ids[1]], statuses['completed'])
+        self.assertEquals(tasks[ids[2]], statuses['failed'])
+        self.assertEquals(tasks[ids[3]], statuses['pending'])
+
+        # Flushing again is a noop.
+        self.assertEquals(writer.flush(), 0)
+
+    def test_stop(self):
+        """Outcomes added after the writer has stopped are written straight
+          away, rather than being dropped.
+        """
+
+        from ntorque import model
+        from ntorque.work.writer import StatusWriter
+
+        # Create and acquire a task.
+        factory = model.TaskFactory(None, u'http://example.com', 20, u'POST')
+        with transaction.manager:
+            task_id = factory().id
+        model.TaskManager().acquire(task_id, 0)
+
+        # Complete it after the writer has stopped.
+        writer = StatusWriter()
+        writer.stop()
+        writer.add('complete', task_id, 1)
+        self.assertEquals(writer.num_buffered, 0)
+        with transaction.manager:
+            status = model.LookupTask()(task_id).status
+        self.assertEquals(status, model.TASK_STATUSES['completed'])
+
+
+class TestDueClause(unittest.TestCase):
+    """Test generating due dates and statuses in SQL."""
+
+    def setUp(self):
+        self.config_factory = boilerplate.TestConfigFactory()
+        self.registry = self.config_factory().registry
+
+    def tearDown(self):
+        self.config_factory.drop()
+
+    def test_parity(self):
+        """The SQL expressions match the due and status factories."""
+
+        from datetime import datetime
+        from mock import Mock
+        from sqlalchemy.sql import literal
+        from sqlalchemy.sql import select
+        from sqlalchemy.types import Integer
+        from ntorque import model
+        from ntorque.model import due
+
+        now = datetime(2014, 1, 1, 12, 30)
+        mock_datetime = Mock()
+        mock_datetime.utcnow.return_value = now
+        for algorithm in (u'exponential', u'linear'):
+            settings = dict(due.DEFAULT_SETTINGS, backoff=algorithm,
+                    min_delay=2, max_delay=7200, max_retries=5)
+            get_due = due.DueFactory(datetime=mock_datetime, settings=settings)
+            get_status = due.StatusFactory(settings=settings)
+            due_clause = due.DueClause(settings=settings)
+            status_clause = due.StatusClause(settings=settings)
+            for timeout in (0, 20):
+                for retry_count in range(15):
+                    column = literal(retry_count, type_=Integer)
+                    query = select([due_clause(now, timeout, column),
+                            status_clause(column)])
+                    value, status = model.Session.execute(query).first()
+                    self.assertEquals(value, get_due(timeout, retry_count))
+                    self.assertEquals(status, get_status(retry_count))
+
+    def test_endpoint_retry_limit(self):
+        """A task that's past its endpoint's retry limit stays failed when
+          it's updated, e.g.: rescheduled.
+        """
+
+        from ntorque import model
+
+        # Create a task for an endpoint that's retried once.
+        with transaction.manager:
+            app = model.CreateApplication()(u'example')
+            endpoint = model.SaveEndpoint()(app, u'hook',
+                    u'http://example.com/hook', u'POST', max_retries=1)
+            factory = model.TaskFactory(app, None, 20, u'POST')
+            task_id = factory(endpoint=endpoint).id
+
+        # The first attempt fails and the task is rescheduled.
+        task_manager = model.TaskManager()
+        task_manager.acquire(task_id, 0)
+        task_manager.reschedule()
+        with transaction.manager:
+            status = model.LookupTask()(task_id).status
+        self.assertEquals(status, u'PENDING')
+
+        # The retry fails and is past the endpoint's limit.
+        task_manager = model.TaskManager()
+        task_manager.acquire(task_id, 1)
+        task_manager.reschedule()
+        with transaction.manager:
+            status = model.LookupTask()(task_id).status
+        self.assertEquals(status, u'FAILED')
+
+
+class TestClaimDueTasks(unittest.TestCase):
+    """Test claiming due tasks directly from the db."""
+
+    def setUp(self):
+        self.config_factory = boilerplate.TestConfigFactory()
+        self.registry = self.config_factory().registry
+
+    def tearDown(self):
+        self.config_factory.drop()
+
+    def test_claim(self):
+        """Due tasks are claimed once, in due order, with their request data."""
+
+        from datetime import datetime
+        from datetime import timedelta
+        from ntorque import model
+
+        # Create two due tasks and one scheduled task.
+        now = datetime.utcnow()
+        factory = model.TaskFactory(None, u'http://example.com', 20, u'POST')
+        with transaction.manager:
+            first = factory(due=now - timedelta(seconds=2)).id
+            second = factory(due=now - timedelta(seconds=1)).id
+            factory(due=now + timedelta(seconds=60))
+
+        # Claim them.
+        claim = model.ClaimDueTasks()
+        with transaction.manager:
+            tasks = claim(limit=1)
+        self.assertEquals([x['id'] for x in tasks], [first])
+        self.assertEquals(tasks[0]['retry_count'], 1)
+        self.assertEquals(tasks[0]['url'], u'http://example.com')
+        with transaction.manager:
+            tasks = claim(limit=10)
+        self.assertEquals([x['id'] for x in tasks], [second])
+
+        # Claiming again is a noop, as the claimed tasks are no longer due.
+        with transaction.manager:
+            self.assertEquals(claim(limit=10), [])
+
+    def test_perform_claimed(self):
+        """Claimed tasks are performed and marked as completed."""
+
+        from datetime import datetime
+        from datetime import timedelta
+        from mock import Mock
+        from threading import Event
+        flag = Event()
+        flag.set()
+
+        from ntorque import model
+        from ntorque.work.perform import TaskPerformer
+
+        # Create and claim a due task.
+        due = datetime.utcnow() - timedelta(seconds=1)
+        factory = model.TaskFactory(None, u'http://example.com', 20, u'POST')
+        with transaction.manager:
+            factory(due=due)
+        with transaction.manager:
+            task_data, = model.ClaimDueTasks()(limit=1)
+
+        # Perform it.
+        mock_make_request = Mock()
+        mock_make_request.return_value.status_code = 200
+        performer = TaskPerformer(make_request=mock_make_request)
+        status = performer.perform_claimed(task_data, flag)
+        self.assertEquals(status, model.TASK_STATUSES['completed'])
+
+
+class TestTaskManager(unittest.TestCase):
+    """Test acquiring tasks using the task manager."""
+
+    def setUp(self):
+        self.config_factory = boilerplate.TestConfigFactory()
+        self.registry = self.config_factory().registry
+
+    def tearDown(self):
+        self.config_factory.drop()
+
+    def test_acquire_many(self):
+        """A batch of instructions is acquired in one statement, skipping
+          the instructions that don't match and flagging expired tasks.
+        """
+
+        from datetime import datetime
+        from datetime import timedelta
+        from ntorque import model
+
+        # Create two tasks and an expired task.
+        now = datetime.utcnow()
+        factory = model.TaskFactory(None, u'http://example.com', 20, u'POST')
+        with transaction.manager:
+            first = factory().id
+            second = factory().id
+            expired = factory(expires=now - timedelta(seconds=1)).id
+
+        # Acquire them, along with a stale instruction.
+        task_manager = model.TaskManager()
+        tasks, skipped = task_manager.acquire_many([(first, 0), (second, 1),
+                (expired, 0)])
+        self.assertEquals([x['id'] for x in tasks], [first])
+        self.assertEquals(tasks[0]['retry_count'], 1)
+        self.assertEquals(tasks[0]['url'], u'http://example.com')
+        self.assertEquals(tasks[0]['status'], model.TASK_STATUSES['pending'])
+        self.assertEquals(sorted(skipped), sorted([(second, 1), (expired, 0)]))
+        self.assertEquals(task_manager.expired, [expired])
+
+        # The acquired instruction can't be acquired again.
+        tasks, skipped = task_manager.acquire_many([(first, 0)])
+        self.assertEquals((tasks, skipped), ([], [(first, 0)]))
+
+    def test_concurrent_acquire(self):
+        """When parallel workers have the same instructions, each task is
+          acquired, and so performed, exactly once.
+        """
+
+        import threading
+        from ntorque import model
+
+        # Create some tasks.
+        factory = model.TaskFactory(None, u'http://example.com', 20, u'POST')
+        with transaction.manager:
+            ids = [factory().id for i in range(50)]
+
+        # Acquire them in parallel, one at a time and in batches.
+        acquired = []
+        def acquire_each():
+            try:
+                for id_ in ids:
+                    task_data = model.TaskManager().acquire(id_, 0)
+                    if task_data:
+                        acquired.append(task_data['id'])
+            finally:
+                model.Session.remove()
+        def acquire_batches():
+            try:
+                for i in range(0, len(ids), 10):
+                    batch = [(x, 0) for x in ids[i:i + 10]]
+                    tasks, _ = model.TaskManager().acquire_many(batch)
+                    acquired.extend([x['id'] for x in tasks])
+            finally:
+                model.Session.remove()
+        threads = [threading.Thread(target=x)
+                for x in [acquire_each, acquire_batches] * 4]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # There were no duplicate acquisitions.
+        self.assertEquals(sorted(acquired), sorted(ids))
+
+    def test_concurrent_recover(self):
+        """Recovering an instruction doesn't acquire a task that another
+          worker is still performing, only one whose attempt has timed out.
+        """
+
+        import threading
+        from datetime import datetime
+        from datetime import timedelta
+        from ntorque import model
+
+        # Create some tasks.
+        factory = model.TaskFactory(None, u'http://example.com', 20, u'POST')
+        with transaction.manager:
+            ids = [factory().id for i in range(50)]
+
+        # Acquire them in parallel, with and without recovering.
+        acquired = []
+        def acquire_each(recover):
+            try:
+                for id_ in ids:
+                    task_data = model.TaskManager().acquire(id_, 0,
+                            recover=recover)
+                    if task_data:
+                        acquired.append(task_data['id'])
+            finally:
+                model.Session.remove()
+        threads = [threading.Thread(target=acquire_each, args=(x,))
+                for x in [False, True] * 4]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # There were no duplicate acquisitions.
+        self.assertEquals(sorted(acquired), sorted(ids))
+
+        # Once an attempt times out, recovering acquires the task again.
+        task_manager = model.TaskManager()
+        table = model.Task.__table__
+        past = datetime.utcnow() - timedelta(seconds=1)
+        task_manager.update_where(table.c.id==ids[0], due=past)
+        task_data = task_manager.acquire(ids[0], 0, recover=True)
+        self.assertEquals(task_data['retry_count'], 2)
+
+
+class TestMakeRequest(unittest.TestCase):
+    """Test making and logging web hook requests."""
+
+    def test_masks_secrets(self):
+        """The task token isn't logged when a request fails."""
+
+        from mock import Mock
+        from requests.exceptions import ConnectionError
+        from ntorque.work.perform import MakeRequest
+
+        mock_log = Mock()
+        mock_make_request = Mock()
+        mock_make_request.side_effect = ConnectionError()
+        make_request = MakeRequest(log=mock_log, make_request=mock_make_request)
+        headers = {'ntorque-task-token': 'secret', 'foo': 'bar'}
+        make_request('POST', 'http://example.com', headers=headers)
+        self.assertTrue(mock_log.warn.called)
+        self.assertFalse('secret' in repr(mock_log.mock_calls))
+        self.assertTrue('bar' in repr(mock_log.mock_calls))
+        self.assertEquals(headers['ntorque-task-token'], 'secret')
+
+
+class TestSessionPool(unittest.TestCase):
+    """Test reusing http sessions per web hook host."""
+
+    def test_sessions(self):
+        """Requests to the same host share a session, which is closed when
+          it's been idle for too long, unless it's in use.
+        """
+
+        from mock import Mock
+        from ntorque.work.perform import SessionPool
+
+        mock_time = Mock()
+        mock_time.time.return_value = 0
+        pool = SessionPool(idle_timeout=60, max_hosts=2,
+                session_cls=Mock, adapter_cls=Mock, time=mock_time)
+
+        # Hosts have a session each.
+        with pool.hold('https://a.com/hooks/1') as a:
+            with pool.hold('https://A.com/hooks/2') as session:
+                self.assertTrue(session is a)
+        with pool.hold('https://b.com/hooks') as b:
+            self.assertFalse(b is a)
+        with pool.hold('https://a.com/hooks/3'):
+            pass
+
+        # The least recently used session is closed to make room.
+        with pool.hold('http://a.com/hooks') as c:
+            pass
+        self.assertTrue(b.close.called)
+        self.assertFalse(a.close.called)
+
+        # As are idle sessions, unless they're in use.
+        with pool.hold('https://a.com/hooks'):
+            mock_time.time.return_value = 61
+            with pool.hold('https://c.com/hooks'):
+                pass
+            self.assertTrue(c.close.called)
+            self.assertFalse(a.close.called)
+
+        # Once they've been released.
+        mock_time.time.return_value = 122
+        with pool.hold('https://d.com/hooks'):
+            pass
+        self.assertTrue(a.close.called)
+
+
+class TestDNSCache(unittest.TestCase):
+    """Test caching dns lookups."""
+
+    def test_cache(self):
+        """Lookups are cached, failures are cached briefly and expired
+          entries are served whilst they're refreshed.
+        """
+
+        import socket
+        from mock import Mock
+        from ntorque.work.dns import DNSCache
+        from ntorque.work.metrics import Metrics
+
+        # Mock the resolver, clock and threads.
+        calls = []
+        families = []
+        def mock_getaddrinfo(host, port, *args, **kwargs):
+            calls.append(host)
+            families.append(kwargs.get('family'))
+            if host == 'bad.example.com':
+                raise socket.gaierror('Name or service not known')
+            return [(host, len(calls))]
+        mock_time = Mock()
+        mock_time.time.return_value = 0
+        class MockThread(object):
+            def __init__(self, target=None, args=None):
+                self.target = target
+                self.args = args
+            def start(self):
+                self.target(*self.args)
+
+        metrics = Metrics()
+        cache = DNSCache(mock_getaddrinfo, ttl=10, negative_ttl=2,
+                stale_ttl=30, metrics=metrics, time=mock_time,
+                thread_cls=MockThread)
+
+        # Lookups are cached.
+        self.assertEquals(cache('example.com', 443), [('example.com', 1)])
+        self.assertEquals(cache('example.com', 443), [('example.com', 1)])
+
+        # Expired entries are served stale whilst they're refreshed.
+        mock_time.time.return_value = 11
+        self.assertEquals(cache('example.com', 443), [('example.com', 1)])
+        self.assertEquals(cache('example.com', 443), [('example.com', 2)])
+
+        # Failures are cached for the negative ttl.
+        for i in range(2):
+            self.assertRaises(socket.gaierror, cache, 'bad.example.com', 443)
+        mock_time.time.return_value = 14
+        self.assertRaises(socket.gaierror, cache, 'bad.example.com', 443)
+        self.assertEquals(calls, ['example.com', 'example.com',
+                'bad.example.com', 'bad.example.com'])
+
+        # Keyword arguments are forwarded and cached separately.
+        for i in range(2):
+            self.assertEquals(cache('example.com', 443, family=socket.AF_INET),
+                    [('example.com', 5)])
+        self.assertEquals(families[-1], socket.AF_INET)
+
+        # The hit ratio is instrumented, without counting background refreshes
+        # as misses.
+        snapshot = metrics.snapshot()
+        self.assertEquals((snapshot['dns.hits'], snapshot['dns.misses']), (5, 4))
 
 
 class TestTaskPerformer(unittest.TestCase):
@@ -78,6 +977,50 @@ class TestTaskPerformer(unittest.TestCase):
         status = performer(instruction, flag)
         self.assertTrue(status is TASK_STATUSES[u'completed'])
 
+    def test_performing_inline_task(self):
+        """Tasks whose request data is carried by the instruction are
+          performed with it, and can only be acquired once.
+        """
+
+        from mock import Mock
+        from pyramid.request import Request
+        from threading import Event
+        flag = Event()
+        flag.set()
+
+        from ntorque.model import TASK_STATUSES
+        from ntorque.model import CreateTask
+        from ntorque.model import Task
+        from ntorque.model import instruction
+        from ntorque.work.perform import TaskPerformer
+
+        # Create a task and encode its request data into an instruction.
+        req = Request.blank('/')
+        create_task = CreateTask(req)
+        with transaction.manager:
+            task = create_task(None, 'http://example.com', 20, u'POST')
+            task_data = task.__json__(include_request_data=True)
+            task_data['expires'] = task.expires
+            data = instruction.encode(task.id, 0, task_data=task_data)
+            task_id = task.id
+        self.assertIsNotNone(instruction.decode(data)[2])
+
+        # Performing it makes the request without reading the task data.
+        mock_make_request = Mock()
+        mock_make_request.return_value.status_code = 200
+        performer = TaskPerformer(make_request=mock_make_request)
+        status = performer(data, flag)
+        self.assertTrue(status is TASK_STATUSES[u'completed'])
+        args = mock_make_request.call_args[0]
+        self.assertEquals(args, (u'POST', u'http://example.com'))
+        with transaction.manager:
+            task = Task.query.get(task_id)
+            self.assertEquals(task.retry_count, 1)
+            self.assertEquals(task.status, TASK_STATUSES[u'completed'])
+
+        # The instruction is now stale.
+        self.assertIsNone(performer(data, flag))
+
     def test_performing_task_connection_error(self):
         """Tasks are retried when arbitrary connection errors occur."""
 
@@ -213,6 +1156,116 @@ class TestTaskPerformer(unittest.TestCase):
         status = performer(instruction_two, flag)
         self.assertTrue(status is TASK_STATUSES[u'pending'])
 
+    def test_performing_task_accepted(self):
+        """Tasks are leased, rather than completed, when the web hook responds
+          with a 202.
+        """
+
+        from datetime import datetime
+        from datetime import timedelta
+        from mock import Mock
+        from pyramid.request import Request
+        from threading import Event
+        flag = Event()
+        flag.set()
+
+        from ntorque.model import TASK_STATUSES
+        from ntorque.model import CreateTask
+        from ntorque.model import LookupTask
+        from ntorque.work.perform import TaskPerformer
+
+        # Create a task.
+        req = Request.blank('/')
+        create_task = CreateTask(req)
+        with transaction.manager:
+            task = create_task(None, 'http://example.com', 20, u'POST')
+            task_id = task.id
+            instruction = '{0}:0'.format(task_id)
+
+        # Perform it with the web hook accepting a ten minute lease.
+        mock_make_request = Mock()
+        mock_make_request.return_value.status_code = 202
+        mock_make_request.return_value.headers = {'NTORQUE-LEASE': '600'}
+        mock_log = Mock()
+        performer = TaskPerformer(make_request=mock_make_request, log=mock_log)
+        status = performer(instruction, flag)
+        self.assertTrue(status is TASK_STATUSES[u'pending'])
+
+        # The task token was passed to the web hook, but wasn't logged.
+        headers = mock_make_request.call_args_list[0][1]['headers']
+        token = headers['ntorque-task-token']
+        self.assertTrue(token)
+        self.assertFalse(token in repr(mock_log.mock_calls))
+
+        # And the task is due once the lease runs out.
+        with transaction.manager:
+            task = LookupTask()(task_id)
+            lease_end = datetime.utcnow() + timedelta(seconds=600)
+            self.assertTrue(task.due > lease_end - timedelta(seconds=5))
+
+    def test_lease_after_completion(self):
+        """A task that the web hook completes before it's leased stays
+          completed.
+        """
+
+        from ntorque import model
+
+        # Create and acquire a task.
+        factory = model.TaskFactory(None, u'http://example.com', 20, u'POST')
+        with transaction.manager:
+            task_id = factory().id
+        task_manager = model.TaskManager()
+        task_manager.acquire(task_id, 0)
+
+        # The web hook calls back to complete it before it's leased.
+        callback = model.TaskManager()
+        callback.assign(task_manager.task_data)
+        callback.complete()
+        task_manager.lease(600)
+
+        # It's still completed.
+        with transaction.manager:
+            status = model.LookupTask()(task_id).status
+        self.assertEquals(status, u'COMPLETED')
+
+    def test_performing_expired_task(self):
+        """Expired tasks are flagged as expired without being performed."""
+
+        from datetime import datetime
+        from datetime import timedelta
+        from mock import Mock
+        from pyramid.request import Request
+        from threading import Event
+        flag = Event()
+        flag.set()
+
+        from ntorque.model import TASK_STATUSES
+        from ntorque.model import CreateTask
+        from ntorque.model import LookupTask
+        from ntorque.work.perform import TaskPerformer
+
+        # Create a task that has already expired.
+        req = Request.blank('/')
+        create_task = CreateTask(req)
+        expires = datetime.utcnow() - timedelta(seconds=1)
+        with transaction.manager:
+            task = create_task(None, 'http://example.com', 20, u'POST',
+                    expires=expires)
+            task_id = task.id
+            instruction = '{0}:0'.format(task_id)
+
+        # Performing it doesn't make a request.
+        mock_make_request = Mock()
+        performer = TaskPerformer(make_request=mock_make_request)
+        status = performer(instruction, flag)
+        self.assertTrue(status is TASK_STATUSES[u'expired'])
+        self.assertFalse(mock_make_request.called)
+
+        # And the task is flagged as expired.
+        with transaction.manager:
+            task = LookupTask()(task_id)
+            self.assertEquals(task.status, TASK_STATUSES[u'expired'])
+
     def test_performing_task_with_method(self):
         """Tasks are performed using the stored method."""
 
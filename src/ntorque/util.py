@@ -5,6 +5,8 @@
 __all__ = [
     'call_in_process',
     'generate_random_digest',
+    'parse_datetime',
+    'to_timestamp',
 ]
 
 import logging
@@ -12,9 +14,19 @@ logger = logging.getLogger(__name__)
 
 import Queue
 import binascii
+import calendar
 import multiprocessing
 import os
 
+from datetime import datetime
+
+DATETIME_FORMATS = (
+    '%Y-%m-%dT%H:%M:%S.%f',
+    '%Y-%m-%dT%H:%M:%S',
+    '%Y-%m-%dT%H:%M',
+    '%Y-%m-%d',
+)
+
 def call_in_process(f, *args, **kwargs):
     """Calls a function or method with the args and kwargs provided
       in a new process. We use this to make sure we don't get a memory
@@ -76,3 +88,42 @@ def generate_random_digest(num_bytes=20):
 
     r = os.urandom(num_bytes)
     return unicode(binascii.hexlify(r))
+
+def parse_datetime(value, formats=DATETIME_FORMATS):
+    """Parse an ISO 8601 formatted UTC datetime string, with an optional ``Z``
+      suffix, into a naive ``datetime``::
+
+          >>> parse_datetime('2014-12-22T10:36:23Z')
+          datetime.datetime(2014, 12, 22, 10, 36, 23)
+          >>> parse_datetime('2014-12-22T10:36:23.871146')
+          datetime.datetime(2014, 12, 22, 10, 36, 23, 871146)
+          >>> parse_datetime('2014-12-22')
+          datetime.datetime(2014, 12, 22, 0, 0)
+
+      Raises a ``ValueError`` if the value can't be parsed::
+
+          >>> parse_datetime('tomorrow')
+          Traceback (most recent call last):
+          ...
+          ValueError: Invalid datetime: tomorrow
+
+    """
+
+    if value.endswith('Z'):
+        value = value[:-1]
+    for item in formats:
+        try:
+            return datetime.strptime(value, item)
+        except ValueError:
+            pass
+    raise ValueError(u'Invalid datetime: {0}'.format(value))
+
+def to_timestamp(dt):
+    """Convert a naive UTC ``datetime`` into a unix timestamp::
+
+          >>> to_timestamp(datetime(1970, 1, 1, 0, 1, 0, 500000))
+          60.5
+
+    """
+
+    return calendar.timegm(dt.utctimetuple()) + dt.microsecond / 1e6
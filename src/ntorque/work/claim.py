@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+
+"""Provides ``TaskClaimer``, a utility that claims batches of due tasks
+  directly from the db and spawns a new (green) thread to perform each task.
+
+  This is an alternative to the consume, requeue and schedule processes that
+  doesn't need Redis at all.
+"""
+
+__all__ = [
+    'TaskClaimer',
+]
+
+from . import patch
+patch.green_threads()
+
+import logging
+logger = logging.getLogger(__name__)
+
+import threading
+import time
+import transaction
+
+from sqlalchemy.exc import SQLAlchemyError
+
+from ntorque import model
+
+from .main import Bootstrap
+from .perform import TaskPerformer
+
+class TaskClaimer(object):
+    """Claims batches of due tasks, performing each one in a new thread.
+
+      Claims at most ``max_in_flight - len(self.in_flight)`` tasks at a time,
+      so the number of tasks being performed is bounded. Polls again
+      immediately if a full batch was claimed, otherwise waits ``interval``
+      seconds.
+    """
+
+    def __init__(self, batch_size=100, interval=0.5, max_in_flight=500,
+            **kwargs):
+        self.batch_size = batch_size
+        self.interval = interval
+        self.max_in_flight = max_in_flight
+        self.claim = kwargs.get('claim', model.ClaimDueTasks())
+        self.flag_cls = kwargs.get('flag_cls', threading.Event)
+        self.handler_cls = kwargs.get('handler_cls', TaskPerformer)
+        self.logger = kwargs.get('logger', logger)
+        self.session = kwargs.get('session', model.Session)
+        self.sleep = kwargs.get('sleep', time.sleep)
+        self.thread_cls = kwargs.get('thread_cls', threading.Thread)
+        self.tx_manager = kwargs.get('tx_manager', transaction.manager)
+        self.in_flight = set()
+
+    def start(self):
+        self.control_flag = self.flag_cls()
+        self.control_flag.set()
+        try:
+            self.poll()
+        finally:
+            self.control_flag.clear()
+
+    def poll(self):
+        """Claim and perform tasks ad-infinitum."""
+
+        while True:
+            limit = min(self.batch_size, self.max_in_flight - len(self.in_flight))
+            tasks = self.claim_tasks(limit) if limit > 0 else []
+            for task_data in tasks:
+                self.spawn(task_data)
+            if len(tasks) < self.batch_size:
+                self.sleep(self.interval)
+
+    def claim_tasks(self, limit):
+        """Claim up to ``limit`` tasks in a transaction."""
+
+        tasks = []
+        try:
+            with self.tx_manager:
+                tasks = self.claim(limit=limit)
+        except SQLAlchemyError as err:
+            self.logger.warn(err, exc_info=True)
+        finally:
+            self.session.remove()
+        return tasks
+
+    def spawn(self, task_data):
+        """Perform the task in a new thread."""
+
+        self.in_flight.add(task_data['id'])
+        thread = self.thread_cls(target=self.handle, args=(task_data,))
+        thread.start()
+
+    def handle(self, task_data):
+        handler = self.handler_cls()
+        try:
+            handler.perform_claimed(task_data, self.control_flag)
+        finally:
+            self.in_flight.discard(task_data['id'])
+
+class ConsoleScript(object):
+    """Bootstrap the environment and run the claimer."""
+
+    def __init__(self, **kwargs):
+        self.claimer_cls = kwargs.get('claimer_cls', TaskClaimer)
+        self.get_config = kwargs.get('get_config', Bootstrap())
+        self.session = kwargs.get('session', model.Session)
+
+    def __call__(self):
+        """Get the configured registry. Unpack the batch size, interval and
+          in-flight limit, instantiate and start the claimer.
+        """
+
+        # Get the configured registry.
+        config = self.get_config()
+
+        # Unpack the claim settings.
+        settings = config.registry.settings
+        batch_size = int(settings.get('ntorque.claim_batch_size'))
+        interval = float(settings.get('ntorque.claim_interval'))
+        max_in_flight = int(settings.get('ntorque.claim_max_in_flight'))
+
+        # Instantiate and start the claimer.
+        claimer = self.claimer_cls(batch_size=batch_size, interval=interval,
+                max_in_flight=max_in_flight)
+        try:
+            claimer.start()
+        finally:
+            self.session.remove()
+
+main = ConsoleScript()
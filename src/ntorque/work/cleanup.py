@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 
-"""Provides ``Cleaner``, a utility that polls the db and deletes old tasks."""
+"""Provides ``Cleaner``, a utility that polls the db, flags expired tasks and
+  deletes old tasks.
+"""
 
 __all__ = [
     'Cleaner',
@@ -21,12 +23,13 @@ from ntorque import model
 from .main import Bootstrap
 
 class Cleaner(object):
-    """Polls the db and delete old tasks."""
+    """Polls the db, flags expired tasks and deletes old tasks."""
 
     def __init__(self, days, interval=7200, **kwargs):
         self.days = days
         self.interval = interval
         self.delete_tasks = kwargs.get('delete_tasks', model.DeleteOldTasks())
+        self.expire_tasks = kwargs.get('expire_tasks', model.ExpireTasks())
         self.logger = kwargs.get('logger', logger)
         self.session = kwargs.get('session', model.Session)
         self.time = kwargs.get('time', time)
@@ -42,6 +45,7 @@ class Cleaner(object):
         while True:
             t1 = self.time.time()
             try:
+                self.expire_tasks()
                 self.delete_tasks(delta)
             except SQLAlchemyError as err:
                 self.logger.warn(err, exc_info=True)
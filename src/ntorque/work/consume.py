@@ -1,11 +1,42 @@
 # -*- coding: utf-8 -*-
 
 """Provides ``ChannelConsumer``, a utility that consumes task instructions from
-  a redis channel and spawns a new (green) thread to perform each task.
+  a redis channel and spawns a new (green) thread to perform each task, plus
+  ``StreamConsumer`` and ``ListenConsumer``, which do the same using redis
+  streams and postgres ``LISTEN`` respectively, and ``FairConsumer``, which
+  consumes per-application sub-channels fairly.
+
+  All of the consumers drop duplicate instructions using an
+  ``InstructionFilter``, which remembers the instructions in flight and those
+  seen recently::
+
+      >>> seen = InstructionFilter(size=2)
+      >>> seen.add('1:0'), seen.add('1:0')
+      (True, False)
+      >>> seen.done('1:0')
+      >>> seen.add('1:0'), seen.add('2:0'), seen.add('3:0')
+      (False, True, True)
+      >>> for item in ('2:0', '3:0'):
+      ...     seen.done(item)
+      >>> seen.add('1:0')
+      True
+
+  Instructions whose task may not have been acquired, e.g.: because the db
+  was down, are forgotten rather than remembered, so they aren't dropped
+  when they're pushed again::
+
+      >>> seen.forget('1:0')
+      >>> seen.add('1:0')
+      True
+
 """
 
 __all__ = [
     'ChannelConsumer',
+    'FairConsumer',
+    'InstructionFilter',
+    'ListenConsumer',
+    'StreamConsumer',
 ]
 
 from . import patch
@@ -14,33 +45,199 @@ patch.green_threads()
 import logging
 logger = logging.getLogger(__name__)
 
+import collections
+import itertools
+import os
+import select
+import socket
 import threading
 import time
+import transaction
 
+from psycopg2 import Error as PostgresError
+from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
 from redis.exceptions import RedisError
+from redis.exceptions import ResponseError
+from pyramid.settings import asbool
 from pyramid_redis.hooks import RedisFactory
+from sqlalchemy.exc import SQLAlchemyError
 
 from ntorque import model
+from ntorque.model import constants
+from ntorque.model import instruction as instructions
+from ntorque.model import priority
+from ntorque.model import shard
+from ntorque.model import transport
 
+from . import metrics
 from .main import Bootstrap
 from .perform import TaskPerformer
+from .pool import WorkerPool
+from .writer import StatusWriter
+
+# Pop up to ``ARGV[1]`` instructions from the ``KEYS``, draining each key in
+# turn. Popping a batch in one round trip means a consumer isn't limited by
+# its latency to redis when there's a backlog.
+POP_SCRIPT = """
+local items = {}
+local remaining = tonumber(ARGV[1])
+for _, key in ipairs(KEYS) do
+    if remaining <= 0 then
+        break
+    end
+    local popped = redis.call('lrange', key, 0, remaining - 1)
+    if #popped > 0 then
+        redis.call('ltrim', key, #popped, -1)
+        for _, item in ipairs(popped) do
+            table.insert(items, item)
+        end
+        remaining = remaining - #popped
+    end
+end
+return items
+"""
+
+# Take an in-flight slot, iff there are fewer than ``ARGV[1]`` unexpired slots
+# in the ``KEYS[1]`` sorted set. Slots are scored by their expiry timestamp, so
+# the slots held by a consumer that crashes are freed after ``ARGV[5]`` secs.
+ACQUIRE_SLOT_SCRIPT = """
+redis.call('zremrangebyscore', KEYS[1], '-inf', ARGV[2])
+if redis.call('zcard', KEYS[1]) >= tonumber(ARGV[1]) then
+    return 0
+end
+redis.call('zadd', KEYS[1], ARGV[3], ARGV[4])
+redis.call('expire', KEYS[1], ARGV[5])
+return 1
+"""
+
+class InstructionFilter(object):
+    """Remembers the instructions that are in flight and the ``size`` most
+      recently performed, so duplicate notifications can be dropped before
+      they hit the db.
+
+      This is safe because acquiring a task increments its retry count: once
+      an ``id:retry`` instruction has been performed, it can't be acquired
+      again.
+    """
+
+    def __init__(self, size=10000, **kwargs):
+        self.size = size
+        self.lock = kwargs.get('lock_cls', threading.Lock)()
+        self.in_flight = set()
+        self.recent = collections.OrderedDict()
+
+    def add(self, instruction):
+        """Add the ``instruction`` to the in flight set, returning ``False``
+          if it's a duplicate.
+        """
+
+        with self.lock:
+            if instruction in self.in_flight or instruction in self.recent:
+                return False
+            self.in_flight.add(instruction)
+            return True
+
+    def forget(self, instruction):
+        """Remove the ``instruction`` from the in flight set without
+          remembering it.
+        """
+
+        with self.lock:
+            self.in_flight.discard(instruction)
+
+    def done(self, instruction):
+        """Move the ``instruction`` from the in flight set to the recently
+          seen instructions, evicting the oldest if there are too many.
+        """
+
+        with self.lock:
+            self.in_flight.discard(instruction)
+            self.recent[instruction] = True
+            while len(self.recent) > self.size:
+                self.recent.popitem(last=False)
 
 class ChannelConsumer(object):
     """Takes instructions from one or more redis channels. Calls a handle
       function in a new thread, passing through a flag that the handle
       function can periodically check to exit.
+
+      If ``weights`` are provided, as a list of ``(channel, weight)`` tuples,
+      each pop prefers the next channel in a smoothly interleaved weighted
+      sequence, falling back on the other channels (in order) when it's
+      empty. This means higher weighted channels are consumed proportionally
+      more often without lower weighted channels ever being starved.
+
+      Instructions are popped in batches of up to ``batch_size``, draining
+      the preferred channel first, and the consumer only blocks (using
+      ``BLPOP``) when the channels are empty. Tasks are performed in a
+      bounded ``pool`` of at most ``max_in_flight`` tasks, which may adapt
+      its size to the web hooks' latency and error rate and limit the tasks'
+      db connections and in-flight body bytes: when it's full, the consumer
+      waits for tasks to finish before popping any more.
+
+      Duplicate instructions, e.g.: from a task being pushed again whilst its
+      notification is still pending, are dropped and counted.
+
+      If ``acquire_batch``, the tasks for each batch of instructions are
+      acquired in a single statement, before they're performed.
+
+      If ``shards`` are provided, the channels are consumed from each redis
+      shard in turn, blocking for at most ``shard_timeout`` seconds on each
+      one when they're all empty.
+
+      If redis keeps failing for ``degrade_after`` seconds, the consumer
+      switches to a degraded mode, where it claims due tasks directly from
+      the db, at up to ``degraded_rate`` tasks per second, until redis
+      responds again.
     """
 
-    def __init__(self, redis, channels, delay=0.001, timeout=10, **kwargs):
+    def __init__(self, redis, channels, delay=0.001, timeout=10, weights=None,
+            batch_size=100, max_in_flight=1000, dedup_size=10000, shards=None,
+            shard_timeout=1, degrade_after=30, degraded_rate=100,
+            degraded_interval=1, acquire_batch=False, **kwargs):
         self.redis = redis
+        self.clients = [redis] if shards is None else shards.values()
+        self.shard_timeout = shard_timeout
+        self.shard_counter = itertools.count()
         self.channels = channels
         self.connect_delay = delay
         self.timeout = timeout
+        self.batch_size = batch_size
+        self.max_in_flight = max_in_flight
+        self.degrade_after = degrade_after
+        self.degraded_rate = degraded_rate
+        self.degraded_interval = degraded_interval
+        self.acquire_batch = acquire_batch
+        self.claim = kwargs.get('claim', model.ClaimDueTasks())
+        self.condition = kwargs.get('condition_cls', threading.Condition)()
+        self.decode = kwargs.get('decode', instructions.decode)
+        self.interleave = kwargs.get('interleave', priority.interleave)
         self.handler_cls = kwargs.get('handler_cls', TaskPerformer)
         self.logger = kwargs.get('logger', logger)
+        self.get_key = kwargs.get('get_key', instructions.get_key)
+        self.metrics = kwargs.get('metrics', metrics.registry)
+        self.pool = kwargs.get('pool', None) or WorkerPool(
+                max_size=max_in_flight)
+        self.status_writer = kwargs.get('status_writer', None)
+        self.handler_kwargs = dict(pool=self.pool,
+                status_writer=self.status_writer)
+        self.seen = kwargs.get('seen', InstructionFilter(size=dedup_size))
+        self.session = kwargs.get('session', model.Session)
         self.sleep = kwargs.get('sleep', time.sleep)
+        self.task_manager_cls = kwargs.get('task_manager_cls', model.TaskManager)
         self.thread_cls = kwargs.get('thread_cls', threading.Thread)
+        self.time = kwargs.get('time', time)
+        self.tx_manager = kwargs.get('tx_manager', transaction.manager)
         self.flag_cls = kwargs.get('flag_cls', threading.Event)
+        self.sequence = None
+        if weights:
+            self.sequence = itertools.cycle(self.interleave(weights))
+        self.pop_script = None
+        if redis is not None:
+            self.pop_script = redis.register_script(POP_SCRIPT)
+        self.num_in_flight = 0
+        self.failing_since = None
+        self.is_degraded = False
 
     def start(self):
         self.control_flag = self.flag_cls()
@@ -54,33 +251,741 @@ class ChannelConsumer(object):
         """Consume the redis channel ad-infinitum."""
 
         while True:
+            if self.is_degraded:
+                self.consume_degraded()
+                continue
+            capacity = self.wait_for_capacity()
             try:
-                return_value = self.redis.blpop(self.channels, timeout=self.timeout)
+                items = self.pop(min(self.batch_size, capacity))
             except RedisError as err:
                 self.logger.warn(err, exc_info=True)
+                self.redis_failed()
                 self.sleep(self.timeout)
             else:
-                if return_value is not None:
-                    channel, data = return_value
+                self.failing_since = None
+                if self.acquire_batch:
+                    self.spawn_batch(items)
+                    continue
+                for data in items:
                     self.spawn(data)
-                    self.sleep(self.connect_delay)
+
+    def redis_failed(self):
+        """Record a redis failure, switching to degraded mode if redis has
+          been failing for ``degrade_after`` seconds.
+        """
+
+        now = self.time.time()
+        if self.failing_since is None:
+            self.failing_since = now
+        if self.degrade_after is None:
+            return
+        if now - self.failing_since >= self.degrade_after:
+            self.set_degraded(True)
+
+    def set_degraded(self, is_degraded):
+        """Switch into or out of degraded mode."""
+
+        self.is_degraded = is_degraded
+        self.failing_since = None
+        self.metrics.gauge('consume.degraded', int(is_degraded))
+        if is_degraded:
+            self.metrics.incr('consume.degraded.entered')
+            self.logger.warn('Redis is down: claiming tasks from the db.')
+        else:
+            self.metrics.incr('consume.degraded.exited')
+            self.logger.warn('Redis is back: consuming notifications.')
+
+    def consume_degraded(self):
+        """Switch back if redis has recovered. Otherwise claim and perform
+          a rate limited batch of due tasks from the db.
+        """
+
+        try:
+            for client in self.clients:
+                client.ping()
+        except RedisError:
+            pass
+        else:
+            return self.set_degraded(False)
+        limit = max(1, int(self.degraded_rate * self.degraded_interval))
+        limit = min(self.batch_size, self.wait_for_capacity(), limit)
+        tasks = []
+        try:
+            with self.tx_manager:
+                tasks = self.claim(limit=limit)
+        except SQLAlchemyError as err:
+            self.logger.warn(err, exc_info=True)
+        finally:
+            self.session.remove()
+        self.metrics.incr('consume.degraded.claimed', len(tasks))
+        for task_data in tasks:
+            self.spawn_claimed(task_data)
+        self.sleep(self.degraded_interval)
+
+    def pop(self, count):
+        """Pop up to ``count`` instructions in a single round trip, blocking
+          for up to ``self.timeout`` seconds if the channels are empty.
+        """
+
+        channels = self.next_channels()
+        clients = self.next_clients()
+        for client in clients:
+            items = self.pop_script(keys=channels, args=[count], client=client)
+            if items:
+                return items
+        timeout = self.timeout if len(clients) == 1 else self.shard_timeout
+        return_value = clients[0].blpop(channels, timeout=timeout)
+        if return_value is not None:
+            channel, data = return_value
+            return [data]
+        return []
+
+    def next_clients(self):
+        """Return the redis clients, starting from the next shard."""
+
+        i = next(self.shard_counter) % len(self.clients)
+        return self.clients[i:] + self.clients[:i]
+
+    def wait_for_capacity(self, timeout=None):
+        """Block until the pool has room for more tasks, or for at most
+          ``timeout`` seconds, if provided, and return how many more can be
+          performed.
+        """
+
+        deadline = None
+        if timeout is not None:
+            deadline = self.time.time() + timeout
+        with self.condition:
+            while True:
+                room = self.pool.room(self.num_in_flight)
+                self.metrics.gauge('consume.in_flight', self.num_in_flight)
+                if room:
+                    return room
+                wait = self.timeout
+                if deadline is not None:
+                    wait = min(wait, deadline - self.time.time())
+                    if wait <= 0:
+                        return 0
+                self.condition.wait(wait)
+
+    def next_channels(self):
+        """Return the channels to pop from, in order of preference."""
+
+        if self.sequence is None:
+            return self.channels
+        preferred = next(self.sequence)
+        return [preferred] + [x for x in self.channels if x != preferred]
+
+    def is_duplicate(self, data):
+        """Is the instruction already in flight or recently performed? If
+          not, it's added to the in flight set.
+        """
+
+        if self.seen.add(self.get_key(data)):
+            self.metrics.incr('consume.received')
+            return False
+        self.metrics.incr('consume.duplicates')
+        return True
 
     def spawn(self, data):
+        """Handle the ``data`` in a new thread, unless it's a duplicate."""
+
+        if self.is_duplicate(data):
+            return
+        with self.condition:
+            self.num_in_flight += 1
+        thread = self.thread_cls(target=self.perform, args=(data,))
+        thread.start()
+
+    def perform(self, data):
+        """Perform the task and then free up its in-flight capacity."""
+
+        handler = self.handler_cls(**self.handler_kwargs)
+        try:
+            handler(data, self.control_flag)
+        finally:
+            self.finish(data, handler)
+            self.release()
+
+    def finish(self, data, handler):
+        """Remember the instruction as performed iff the ``handler``'s
+          acquire query ran, so its task was either acquired or missed.
+          Otherwise forget it, so it can be performed when it's pushed again.
+        """
+
+        key = self.get_key(data)
+        if getattr(handler, 'did_acquire', True):
+            self.seen.done(key)
+        else:
+            self.seen.forget(key)
+
+    def spawn_batch(self, items):
+        """Acquire the tasks for a batch of instructions, dropping
+          duplicates, in a single statement and perform them in new threads.
+        """
+
+        items = [x for x in items if not self.is_duplicate(x)]
+        if not items:
+            return
+        tasks, skipped = [], []
+        did_acquire = False
+        task_manager = self.task_manager_cls()
+        try:
+            with self.pool.db():
+                tasks, skipped = task_manager.acquire_many(
+                        [self.decode(x)[:2] for x in items])
+            did_acquire = True
+        except SQLAlchemyError as err:
+            self.logger.warn(err, exc_info=True)
+        finally:
+            self.session.remove()
+            # Acquiring increments the retry counts, so the instructions
+            # can't be acquired again. Unless the statement failed.
+            for data in items:
+                if did_acquire:
+                    self.seen.done(self.get_key(data))
+                else:
+                    self.seen.forget(self.get_key(data))
+        self.metrics.incr('consume.acquired', len(tasks))
+        self.metrics.incr('consume.skipped', len(skipped))
+        for task_data in tasks:
+            self.spawn_claimed(task_data)
+
+    def spawn_claimed(self, task_data):
+        """Perform a task claimed from the db in a new thread."""
+
+        with self.condition:
+            self.num_in_flight += 1
+        thread = self.thread_cls(target=self.perform_claimed, args=(task_data,))
+        thread.start()
+
+    def perform_claimed(self, task_data):
+        handler = self.handler_cls(**self.handler_kwargs)
+        try:
+            handler.perform_claimed(task_data, self.control_flag)
+        finally:
+            self.release()
+
+    def release(self):
+        """Free up a task's in-flight capacity."""
+
+        with self.condition:
+            self.num_in_flight -= 1
+            self.condition.notify()
+
+class StreamConsumer(ChannelConsumer):
+    """Reads instructions from the redis streams derived from ``channels``,
+      using a consumer group, so each instruction stays in this consumer's
+      pending list until it's acknowledged -- after the task's status has
+      been written.
+
+      Every ``claim_idle / 3`` seconds, the consumer resets the idle time of
+      the instructions it's still performing and claims any instructions that
+      have been pending for longer than ``claim_idle`` seconds. These can
+      only belong to dead consumers, so they're performed with
+      ``recover=True``. This means a crashed worker's tasks are recovered
+      within seconds, rather than being left for the ``RequeuePoller``.
+
+      Entries are read and claimed in batches of up to ``batch_size``, as
+      long as the pool has capacity to perform them. Whilst it's full, the
+      consumer keeps heartbeating its entries in flight.
+    """
+
+    def __init__(self, redis, channels, name, delay=0.001, timeout=10,
+            weights=None, claim_idle=30, claim_count=100, **kwargs):
+        super(StreamConsumer, self).__init__(redis, channels, delay=delay,
+                timeout=timeout, weights=weights, **kwargs)
+        self.name = name
+        self.claim_idle = claim_idle
+        self.claim_count = claim_count
+        self.field = kwargs.get('field', transport.STREAM_FIELD)
+        self.get_stream = kwargs.get('get_stream', transport.get_stream)
+        self.group = kwargs.get('group', transport.CONSUMER_GROUP)
+        self.streams = dict([(x, self.get_stream(x)) for x in channels])
+        self.in_flight = set()
+        self.last_claimed = 0
+
+    def start(self):
+        self.create_groups()
+        super(StreamConsumer, self).start()
+
+    def create_groups(self):
+        """Create the consumer group for each stream, if necessary."""
+
+        for stream in self.streams.values():
+            try:
+                self.redis.execute_command('XGROUP', 'CREATE', stream,
+                        self.group, '0', 'MKSTREAM')
+            except ResponseError as err:
+                if not str(err).startswith('BUSYGROUP'):
+                    raise
+
+    def consume(self):
+        """Consume the redis streams ad-infinitum."""
+
+        claim_interval = self.claim_idle / 3.0
+        while True:
+            if self.is_degraded:
+                self.consume_degraded()
+                continue
+            capacity = self.wait_for_capacity(timeout=claim_interval)
+            entries = []
+            try:
+                if self.time.time() - self.last_claimed > claim_interval:
+                    self.heartbeat()
+                    if capacity:
+                        count = min(self.claim_count, capacity)
+                        for stream, entry_id, data in self.claim(count):
+                            self.spawn_entry(stream, entry_id, data,
+                                    recover=True)
+                            capacity -= 1
+                    self.last_claimed = self.time.time()
+                if capacity:
+                    entries = self.read(min(self.timeout, claim_interval),
+                            min(self.batch_size, capacity))
+            except RedisError as err:
+                self.logger.warn(err, exc_info=True)
+                self.redis_failed()
+                self.sleep(self.timeout)
+            else:
+                self.failing_since = None
+                for stream, entry_id, data in entries:
+                    if self.is_duplicate(data):
+                        self.ack(stream, entry_id)
+                        continue
+                    self.spawn_entry(stream, entry_id, data)
+
+    def parse(self, stream, items):
+        """Parse ``(entry_id, fields)`` replies into a list of
+          ``(stream, entry_id, instruction)`` tuples. Note that the fields
+          of entries deleted whilst pending are ``None``.
+        """
+
+        entries = []
+        for entry_id, fields in items:
+            values = dict(zip(fields[::2], fields[1::2])) if fields else {}
+            entries.append((stream, entry_id, values.get(self.field)))
+        return entries
+
+    def read(self, timeout, count=1):
+        """Block for up to ``timeout`` seconds reading up to ``count`` new
+          entries from each of the streams, in order of preference.
+        """
+
+        streams = [self.streams[x] for x in self.next_channels()]
+        args = ['XREADGROUP', 'GROUP', self.group, self.name, 'COUNT', count,
+                'BLOCK', int(timeout * 1000), 'STREAMS']
+        args += streams + ['>'] * len(streams)
+        entries = []
+        for stream, items in self.redis.execute_command(*args) or []:
+            entries.extend(self.parse(stream, items))
+        return entries
+
+    def heartbeat(self):
+        """Reset the idle time of the entries this consumer is performing,
+          so they're not claimed by another consumer.
+        """
+
+        by_stream = {}
+        for stream, entry_id in list(self.in_flight):
+            by_stream.setdefault(stream, []).append(entry_id)
+        for stream, entry_ids in by_stream.items():
+            self.redis.execute_command('XCLAIM', stream, self.group, self.name,
+                    0, *(entry_ids + ['JUSTID']))
+
+    def claim(self, count=None):
+        """Claim up to ``count`` entries that have been pending for longer
+          than ``claim_idle`` seconds and delete idle consumers that have
+          nothing pending.
+        """
+
+        if count is None:
+            count = self.claim_count
+        entries = []
+        min_idle = int(self.claim_idle * 1000)
+        for stream in self.streams.values():
+            remaining = count - len(entries)
+            if remaining > 0:
+                reply = self.redis.execute_command('XAUTOCLAIM', stream,
+                        self.group, self.name, min_idle, '0-0', 'COUNT',
+                        remaining)
+                for item in self.parse(stream, reply[1]):
+                    if item[2] is None:
+                        self.ack(*item[:2])
+                    else:
+                        entries.append(item)
+            consumers = self.redis.execute_command('XINFO', 'CONSUMERS', stream,
+                    self.group)
+            for consumer in consumers:
+                info = dict(zip(consumer[::2], consumer[1::2]))
+                if info['name'] != self.name and not info['pending'] and \
+                        info['idle'] > min_idle:
+                    self.redis.execute_command('XGROUP', 'DELCONSUMER', stream,
+                            self.group, info['name'])
+        return entries
+
+    def ack(self, stream, entry_id):
+        """Acknowledge and delete the entry."""
+
+        pipeline = self.redis.pipeline()
+        pipeline.execute_command('XACK', stream, self.group, entry_id)
+        pipeline.execute_command('XDEL', stream, entry_id)
+        pipeline.execute()
+
+    def spawn_entry(self, stream, entry_id, data, recover=False):
+        """Handle the entry in a new thread."""
+
+        self.in_flight.add((stream, entry_id))
+        with self.condition:
+            self.num_in_flight += 1
+        args = (stream, entry_id, data, recover)
+        thread = self.thread_cls(target=self.handle, args=args)
+        thread.start()
+
+    def handle(self, stream, entry_id, data, recover):
+        """Perform the task and then acknowledge the entry. If the handler
+          raises, or fails to run its acquire query, the entry is left
+          pending, to be claimed and retried.
+        """
+
+        handler = self.handler_cls(**self.handler_kwargs)
+        try:
+            handler(data, self.control_flag, recover=recover)
+        finally:
+            self.in_flight.discard((stream, entry_id))
+            if not recover:
+                self.finish(data, handler)
+            self.release()
+        if not getattr(handler, 'did_acquire', True):
+            return
+        try:
+            self.ack(stream, entry_id)
+        except RedisError as err:
+            self.logger.warn(err, exc_info=True)
+
+class ListenConsumer(ChannelConsumer):
+    """Receives instructions as postgres notifications, by ``LISTEN``ing on
+      the ``channels`` using a dedicated connection. Waits for notifications
+      using ``select``, which the gevent monkey patching makes cooperative.
+
+      Notifications received together are handled in the weighted order of
+      their channels. Note that notifications are not persistent: any sent
+      whilst the consumer isn't listening are recovered by the
+      ``RequeuePoller``.
+    """
+
+    def __init__(self, get_connection, channels, delay=0.001, timeout=10,
+            weights=None, **kwargs):
+        super(ListenConsumer, self).__init__(None, channels, delay=delay,
+                timeout=timeout, weights=weights, **kwargs)
+        self.get_connection = get_connection
+        self.select = kwargs.get('select', select.select)
+        self.connection = None
+
+    def listen(self):
+        """Get a connection in autocommit mode and listen on the channels."""
+
+        connection = self.get_connection()
+        connection.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+        cursor = connection.cursor()
+        for channel in self.channels:
+            cursor.execute('LISTEN "{0}"'.format(channel.replace('"', '""')))
+        cursor.close()
+        self.connection = connection
+
+    def consume(self):
+        """Consume the notifications ad-infinitum."""
+
+        while True:
+            try:
+                if self.connection is None:
+                    self.listen()
+                notifications = self.receive()
+            except PostgresError as err:
+                self.logger.warn(err, exc_info=True)
+                self.close()
+                self.sleep(self.timeout)
+            else:
+                for data in self.order(notifications):
+                    self.wait_for_capacity()
+                    self.spawn(data)
+
+    def receive(self):
+        """Wait for up to ``self.timeout`` seconds for notifications and
+          return them.
+        """
+
+        connection = self.connection
+        if not connection.notifies:
+            readable, _, _ = self.select([connection], [], [], self.timeout)
+            if readable:
+                connection.poll()
+        notifications = connection.notifies[:]
+        del connection.notifies[:]
+        return notifications
+
+    def order(self, notifications):
+        """Return the notification payloads, ordered by preferring the next
+          channel with pending notifications in the weighted sequence.
+        """
+
+        pending = {}
+        for item in notifications:
+            pending.setdefault(item.channel, []).append(item.payload)
+        payloads = []
+        while pending:
+            for channel in self.next_channels():
+                if channel in pending:
+                    payloads.append(pending[channel].pop(0))
+                    if not pending[channel]:
+                        del pending[channel]
+                    break
+            else: # Notifications on channels we don't know about.
+                for items in pending.values():
+                    payloads.extend(items)
+                pending = {}
+        return payloads
+
+    def close(self):
+        """Close the connection, if any, so it's re-opened."""
+
+        connection = self.connection
+        self.connection = None
+        if connection is not None:
+            try:
+                connection.close()
+            except PostgresError as err:
+                self.logger.warn(err, exc_info=True)
+
+class FairConsumer(ChannelConsumer):
+    """Consumes per-application sub-channels of the ``bases`` channels using
+      deficit round robin, so one application's backlog can't starve the
+      others.
+
+      Each round, every application's deficit is credited with ``quantum``
+      times its share and the consumer pops (at most) that many of its
+      instructions, preferring its priority channels by ``weights``. An
+      application's optional ``max_in_flight`` cap is enforced across all
+      consumer processes using a redis sorted set of expiring slots.
+
+      When there's nothing to pop, the consumer blocks on all of the
+      channels, putting back the instruction that wakes it up, so that it's
+      consumed in the next round.
+
+      Each round pops at most as many instructions as the pool has capacity
+      for. If it runs out, the next round starts from the first application
+      that missed out.
+    """
+
+    def __init__(self, redis, bases, name, delay=0.001, timeout=10,
+            weights=None, quantum=1, refresh_interval=10, slot_ttl=300,
+            **kwargs):
+        super(FairConsumer, self).__init__(redis, [], delay=delay,
+                timeout=timeout, **kwargs)
+        self.bases = bases
+        self.name = name
+        self.quantum = quantum
+        self.refresh_interval = refresh_interval
+        self.slot_ttl = slot_ttl
+        if not weights:
+            weights = [(x, 1) for x in constants.TASK_PRIORITIES]
+        self.priority_weights = weights
+        self.get_apps_key = kwargs.get('get_apps_key', priority.get_apps_key)
+        self.get_channel = kwargs.get('get_channel', priority.get_channel)
+        self.get_policies = kwargs.get('get_policies',
+                model.GetSchedulingPolicies())
+        self.idle_delay = kwargs.get('idle_delay', 0.05)
+        self.acquire_slot_script = self.redis.register_script(
+                ACQUIRE_SLOT_SCRIPT)
+        self.counter = itertools.count()
+        self.deficits = {}
+        self.policies = {}
+        self.queues = [(x, None) for x in bases]
+        self.sequences = {}
+        self.last_refreshed = 0
+        self.next_queue = 0
+
+    def consume(self):
+        """Consume the sub-channels ad-infinitum."""
+
+        while True:
+            if self.is_degraded:
+                self.consume_degraded()
+                continue
+            capacity = self.wait_for_capacity()
+            try:
+                if self.time.time() - self.last_refreshed > self.refresh_interval:
+                    self.refresh()
+                num_spawned, is_capped = self.round(capacity)
+                if not num_spawned:
+                    if is_capped:
+                        self.sleep(self.idle_delay)
+                    else:
+                        self.wait()
+            except RedisError as err:
+                self.logger.warn(err, exc_info=True)
+                self.redis_failed()
+                self.sleep(self.timeout)
+            else:
+                self.failing_since = None
+
+    def refresh(self):
+        """Refresh the registered application ids and their policies."""
+
+        try:
+            with self.tx_manager:
+                self.policies = self.get_policies()
+        except SQLAlchemyError as err:
+            self.logger.warn(err, exc_info=True)
+        finally:
+            self.session.remove()
+        queues = []
+        for base in self.bases:
+            queues.append((base, None))
+            app_ids = self.redis.smembers(self.get_apps_key(base))
+            queues.extend([(base, x) for x in sorted(map(int, app_ids))])
+        self.queues = queues
+        self.last_refreshed = self.time.time()
+
+    def round(self, capacity=None):
+        """Consume a deficit round robin round, spawning at most ``capacity``
+          instructions, if provided. Returns how many instructions were
+          spawned and whether any applications were at their cap.
+        """
+
+        num_spawned = 0
+        is_capped = False
+        start = self.next_queue % max(len(self.queues), 1)
+        queues = self.queues[start:] + self.queues[:start]
+        self.next_queue = 0
+        for i, queue in enumerate(queues):
+            if capacity is not None and num_spawned >= capacity:
+                self.next_queue = start + i
+                break
+            base, app_id = queue
+            share, cap = self.policies.get(app_id, (1, None))
+            credit = self.quantum * max(share or 1, 1)
+            deficit = self.deficits.get(queue, 0) + credit
+            while deficit >= 1:
+                if capacity is not None and num_spawned >= capacity:
+                    break
+                slot = None
+                if cap is not None:
+                    slot = self.acquire_slot(queue, cap)
+                    if slot is None:
+                        is_capped = True
+                        break
+                data = self.pop(queue)
+                if data is None or self.is_duplicate(data):
+                    if slot is not None:
+                        self.release_slot(queue, slot)
+                    if data is not None:
+                        continue
+                    deficit = 0
+                    break
+                deficit -= 1
+                self.spawn_queued(queue, data, slot)
+                num_spawned += 1
+            self.deficits[queue] = min(deficit, credit)
+        return num_spawned, is_capped
+
+    def queue_channels(self, queue):
+        """Return the queue's channels, in order of preference."""
+
+        base, app_id = queue
+        sequence = self.sequences.get(queue)
+        if sequence is None:
+            sequence = itertools.cycle(self.interleave(self.priority_weights))
+            self.sequences[queue] = sequence
+        preferred = next(sequence)
+        values = [preferred]
+        values += [x for x, _ in self.priority_weights if x != preferred]
+        return [self.get_channel(base, x, app_id=app_id) for x in values]
+
+    def pop(self, queue):
+        """Pop the next instruction from the queue, if there is one."""
+
+        for channel in self.queue_channels(queue):
+            data = self.redis.lpop(channel)
+            if data is not None:
+                return data
+
+    def wait(self):
+        """Block until an instruction arrives on any of the channels and put
+          it back, to be consumed in the next round.
+        """
+
+        channels = []
+        for base, app_id in self.queues:
+            channels += [self.get_channel(base, x, app_id=app_id)
+                    for x, _ in self.priority_weights]
+        return_value = self.redis.blpop(channels, timeout=self.timeout)
+        if return_value is not None:
+            channel, data = return_value
+            self.redis.lpush(channel, data)
+
+    def get_slots_key(self, queue):
+        base, app_id = queue
+        return '{0}:inflight:{1}'.format(base, app_id)
+
+    def acquire_slot(self, queue, cap):
+        """Take an in-flight slot, returning its id, or ``None`` if the
+          application is at its cap.
+        """
+
+        now = self.time.time()
+        slot = '{0}:{1}'.format(self.name, next(self.counter))
+        args = [cap, now, now + self.slot_ttl, slot, int(self.slot_ttl)]
+        keys = [self.get_slots_key(queue)]
+        if self.acquire_slot_script(keys=keys, args=args):
+            return slot
+
+    def release_slot(self, queue, slot):
+        self.redis.zrem(self.get_slots_key(queue), slot)
+
+    def spawn_queued(self, queue, data, slot):
         """Handle the ``data`` in a new thread."""
 
-        args = (data, self.control_flag)
-        handler = self.handler_cls()
-        thread = self.thread_cls(target=handler, args=args)
+        with self.condition:
+            self.num_in_flight += 1
+        args = (queue, data, slot)
+        thread = self.thread_cls(target=self.handle, args=args)
         thread.start()
 
+    def handle(self, queue, data, slot):
+        """Perform the task and then release the in-flight slot, if any."""
+
+        handler = self.handler_cls(**self.handler_kwargs)
+        try:
+            handler(data, self.control_flag)
+        finally:
+            self.finish(data, handler)
+            self.release()
+            if slot is not None:
+                try:
+                    self.release_slot(queue, slot)
+                except RedisError as err:
+                    self.logger.warn(err, exc_info=True)
+
 class ConsoleScript(object):
     """Bootstrap the environment and run the consumer."""
 
     def __init__(self, **kwargs):
         self.consumer_cls = kwargs.get('consumer_cls', ChannelConsumer)
+        self.fair_consumer_cls = kwargs.get('fair_consumer_cls', FairConsumer)
+        self.listen_consumer_cls = kwargs.get('listen_consumer_cls',
+                ListenConsumer)
+        self.stream_consumer_cls = kwargs.get('stream_consumer_cls',
+                StreamConsumer)
+        self.base = kwargs.get('base', model.Base)
         self.get_redis = kwargs.get('get_redis', RedisFactory())
+        self.get_shards = kwargs.get('get_shards', shard.GetRedisShards())
         self.get_config = kwargs.get('get_config', Bootstrap())
+        self.metrics = kwargs.get('metrics', metrics.registry)
+        self.pool_cls = kwargs.get('pool_cls', WorkerPool)
+        self.reporter_cls = kwargs.get('reporter_cls', metrics.MetricsReporter)
         self.session = kwargs.get('session', model.Session)
+        self.writer_cls = kwargs.get('writer_cls', StatusWriter)
 
     def __call__(self):
         """Get the configured registry. Unpack the redis client and input
@@ -97,12 +1002,89 @@ class ConsoleScript(object):
         redis_client = self.get_redis(settings, registry=config.registry)
         input_channels = settings.get('ntorque.redis_channel').strip().split()
 
-        # Instantiate and start the consumer.
-        consumer = self.consumer_cls(redis_client, input_channels, delay=delay,
-                timeout=timeout)
+        # Expand the input channels into weighted priority channels.
+        weights = []
+        raw_weights = settings.get('ntorque.priority_weights')
+        for channel in input_channels:
+            for value, weight in priority.parse_weights(raw_weights):
+                weights.append((priority.get_channel(channel, value), weight))
+        channels = [item for item, _ in weights]
+
+        # Instantiate and start the consumer for the configured transport.
+        batch_size = int(settings.get('ntorque.consume_batch_size'))
+        max_in_flight = int(settings.get('ntorque.consume_max_in_flight'))
+        dedup_size = int(settings.get('ntorque.consume_dedup_size'))
+        degrade_after = float(settings.get('ntorque.consume_degrade_after'))
+        degraded_rate = float(settings.get('ntorque.consume_degraded_rate'))
+        pool = self.pool_cls(max_size=max_in_flight,
+                min_size=int(settings.get('ntorque.consume_min_in_flight')),
+                adaptive=asbool(settings.get('ntorque.consume_adaptive')),
+                target_latency=float(settings.get(
+                        'ntorque.consume_target_latency')),
+                max_error_rate=float(settings.get(
+                        'ntorque.consume_max_error_rate')),
+                max_db_connections=int(settings.get(
+                        'ntorque.consume_max_db_connections')) or None,
+                max_body_bytes=int(settings.get(
+                        'ntorque.consume_max_body_bytes')) or None)
+        acquire_batch = asbool(settings.get('ntorque.consume_acquire_batch'))
+        transport_name = settings.get('ntorque.transport')
+
+        # Batch the status writes, if configured to. Not for the stream
+        # transport, which acks each notification after its status is written.
+        status_writer = None
+        status_delay = float(settings.get('ntorque.consume_status_delay'))
+        if status_delay and transport_name != transport.STREAM:
+            status_writer = self.writer_cls(delay=status_delay)
+            status_writer.start()
+
+        kwargs = dict(delay=delay, timeout=timeout, weights=weights,
+                max_in_flight=max_in_flight, dedup_size=dedup_size, pool=pool,
+                status_writer=status_writer)
+        redis_kwargs = dict(degrade_after=degrade_after or None,
+                degraded_rate=degraded_rate)
+        if transport_name == transport.STREAM:
+            name = '{0}:{1}'.format(socket.gethostname(), os.getpid())
+            claim_idle = int(settings.get('ntorque.stream_claim_idle'))
+            kwargs.update(redis_kwargs)
+            consumer = self.stream_consumer_cls(redis_client, channels, name,
+                    claim_idle=claim_idle, **kwargs)
+        elif priority.is_fair(settings):
+            name = '{0}:{1}'.format(socket.gethostname(), os.getpid())
+            consumer = self.fair_consumer_cls(redis_client, input_channels, name,
+                    delay=delay, timeout=timeout,
+                    weights=priority.parse_weights(raw_weights),
+                    quantum=int(settings.get('ntorque.fair_quantum')),
+                    refresh_interval=float(settings.get(
+                            'ntorque.fair_refresh_interval')),
+                    slot_ttl=int(settings.get('ntorque.fair_slot_ttl')),
+                    max_in_flight=max_in_flight, dedup_size=dedup_size,
+                    pool=pool, status_writer=status_writer, **redis_kwargs)
+        elif transport_name == transport.POSTGRES:
+            consumer = self.listen_consumer_cls(self.get_connection, channels,
+                    **kwargs)
+        else:
+            kwargs.update(redis_kwargs)
+            shards = self.get_shards(settings, registry=config.registry)
+            consumer = self.consumer_cls(redis_client, channels,
+                    batch_size=batch_size, shards=shards,
+                    acquire_batch=acquire_batch, **kwargs)
+        interval = float(settings.get('ntorque.metrics_interval'))
+        self.reporter_cls(self.metrics, interval=interval).start()
         try:
             consumer.start()
         finally:
+            if status_writer is not None:
+                status_writer.stop()
             self.session.remove()
 
+    def get_connection(self):
+        """Return a dedicated db connection, detached from the pool, as we
+          change its isolation level and keep it open indefinitely.
+        """
+
+        connection = self.base.metadata.bind.raw_connection()
+        connection.detach()
+        return connection
+
 main = ConsoleScript()
@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+
+"""Provides ``DNSCache``, which caches ``getaddrinfo`` lookups, so the worker
+  doesn't resolve a web hook's hostname every time it calls it::
+
+      >>> calls = []
+      >>> def lookup(host, port, *args):
+      ...     calls.append(host)
+      ...     return [('addr', host)]
+      >>> cache = DNSCache(lookup, ttl=60, metrics=metrics.Metrics())
+      >>> cache('example.com', 443)
+      [('addr', 'example.com')]
+      >>> cache('example.com', 443)
+      [('addr', 'example.com')]
+      >>> calls
+      ['example.com']
+
+  Failed lookups are cached too, for ``negative_ttl`` seconds. Once an
+  entry's ``ttl`` has passed, it's served stale, for up to ``stale_ttl``
+  seconds, whilst it's refreshed in the background.
+
+  ``getaddrinfo`` doesn't expose the records' TTLs, so entries live for the
+  configured ``ttl``.
+"""
+
+__all__ = [
+    'DNSCache',
+    'install',
+]
+
+import logging
+logger = logging.getLogger(__name__)
+
+import collections
+import os
+import socket
+import threading
+import time
+
+from . import metrics
+
+# How long, in seconds, to cache successful and failed lookups for, how long
+# to serve an expired entry for whilst it's refreshed and the maximum number
+# of entries. A ttl of ``0`` disables the cache.
+DNS_CACHE_TTL = float(os.environ.get('NTORQUE_DNS_CACHE_TTL', 60))
+DNS_NEGATIVE_TTL = float(os.environ.get('NTORQUE_DNS_NEGATIVE_TTL', 5))
+DNS_STALE_TTL = float(os.environ.get('NTORQUE_DNS_STALE_TTL', 300))
+DNS_CACHE_SIZE = int(os.environ.get('NTORQUE_DNS_CACHE_SIZE', 10000))
+
+class DNSCache(object):
+    """A bounded, least recently used cache in front of ``getaddrinfo``."""
+
+    def __init__(self, getaddrinfo, ttl=60, negative_ttl=5, stale_ttl=300,
+            max_size=10000, **kwargs):
+        self.getaddrinfo = getaddrinfo
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.stale_ttl = stale_ttl
+        self.max_size = max_size
+        self.lock = kwargs.get('lock_cls', threading.Lock)()
+        self.metrics = kwargs.get('metrics', metrics.registry)
+        self.thread_cls = kwargs.get('thread_cls', threading.Thread)
+        self.time = kwargs.get('time', time)
+        self.entries = collections.OrderedDict()
+        self.refreshing = set()
+        self.num_hits = 0
+        self.num_lookups = 0
+
+    def __call__(self, host, port, *args, **kwargs):
+        if host is None:
+            return self.getaddrinfo(host, port, *args, **kwargs)
+        key = (host, port, args, tuple(sorted(kwargs.items())))
+        now = self.time.time()
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                self.entries[key] = entry
+        if entry is None:
+            self.record(False)
+            result, error = self.lookup(key)
+        else:
+            expires, result, error = entry
+            if now >= expires + self.stale_ttl or (error and now >= expires):
+                self.record(False)
+                result, error = self.lookup(key)
+            elif now >= expires:
+                self.metrics.incr('dns.stale')
+                self.refresh(key)
+                self.record(True)
+            else:
+                self.record(True)
+        if error is not None:
+            raise error
+        return result
+
+    def record(self, is_hit):
+        with self.lock:
+            self.num_lookups += 1
+            if is_hit:
+                self.num_hits += 1
+            ratio = self.num_hits / float(self.num_lookups)
+        self.metrics.incr('dns.hits' if is_hit else 'dns.misses')
+        self.metrics.gauge('dns.hit_ratio', round(ratio, 4))
+
+    def lookup(self, key):
+        """Resolve and cache the ``key``, returning ``(result, error)``."""
+
+        host, port, args, kwargs = key
+        result, error = None, None
+        t1 = self.time.time()
+        try:
+            result = self.getaddrinfo(host, port, *args, **dict(kwargs))
+        except socket.gaierror as err:
+            error = err
+            self.metrics.incr('dns.errors')
+        now = self.time.time()
+        self.metrics.timing('dns.lookup', now - t1)
+        ttl = self.ttl if error is None else self.negative_ttl
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (now + ttl, result, error)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+        return result, error
+
+    def refresh(self, key):
+        """Refresh the ``key`` in a (green) thread, unless it already is."""
+
+        with self.lock:
+            if key in self.refreshing:
+                return
+            self.refreshing.add(key)
+        thread = self.thread_cls(target=self.revalidate, args=(key,))
+        thread.daemon = True
+        thread.start()
+
+    def revalidate(self, key):
+        try:
+            result, error = self.lookup(key)
+            if error is not None:
+                logger.warn(error)
+        finally:
+            with self.lock:
+                self.refreshing.discard(key)
+
+def install(ttl=DNS_CACHE_TTL, **kwargs):
+    """Install a ``DNSCache`` in front of the (monkey patched) socket module's
+      ``getaddrinfo``, which ``gevent.socket.create_connection`` uses too.
+      Returns the cache, or ``None`` if the ``ttl`` is ``0``.
+    """
+
+    if not ttl:
+        return None
+    modules = [socket]
+    try:
+        import gevent.socket
+    except ImportError: # pragma: no cover
+        pass
+    else:
+        modules.append(gevent.socket)
+    if isinstance(socket.getaddrinfo, DNSCache):
+        return socket.getaddrinfo
+    kwargs.setdefault('negative_ttl', DNS_NEGATIVE_TTL)
+    kwargs.setdefault('stale_ttl', DNS_STALE_TTL)
+    kwargs.setdefault('max_size', DNS_CACHE_SIZE)
+    cache = DNSCache(socket.getaddrinfo, ttl=ttl, **kwargs)
+    for module in modules:
+        module.getaddrinfo = cache
+    return cache
@@ -22,11 +22,44 @@ import pyramid_basemodel as model
 
 DEFAULTS = {
     'mode': os.environ.get('MODE', 'development'),
+    'priority_weights': os.environ.get('NTORQUE_PRIORITY_WEIGHTS',
+            'high:6 normal:3 low:1'),
     'redis_channel': os.environ.get('NTORQUE_REDIS_CHANNEL', 'ntorque'),
+    'redis_schedule': os.environ.get('NTORQUE_REDIS_SCHEDULE', 'ntorque:scheduled'),
+    'redis_shards': os.environ.get('NTORQUE_REDIS_SHARDS', ''),
+    'claim_batch_size': int(os.environ.get('NTORQUE_CLAIM_BATCH_SIZE', 100)),
+    'claim_interval': float(os.environ.get('NTORQUE_CLAIM_INTERVAL', 0.5)),
+    'claim_max_in_flight': int(os.environ.get('NTORQUE_CLAIM_MAX_IN_FLIGHT', 500)),
     'cleanup_after_days': os.environ.get('NTORQUE_CLEANUP_AFTER_DAYS', 7),
+    'consume_acquire_batch': os.environ.get('NTORQUE_CONSUME_ACQUIRE_BATCH', False),
+    'consume_adaptive': os.environ.get('NTORQUE_CONSUME_ADAPTIVE', False),
+    'consume_batch_size': int(os.environ.get('NTORQUE_CONSUME_BATCH_SIZE', 100)),
+    'consume_dedup_size': int(os.environ.get('NTORQUE_CONSUME_DEDUP_SIZE', 10000)),
+    'consume_degrade_after': float(os.environ.get('NTORQUE_CONSUME_DEGRADE_AFTER', 30)),
+    'consume_degraded_rate': float(os.environ.get('NTORQUE_CONSUME_DEGRADED_RATE', 100)),
     'consume_delay': float(os.environ.get('NTORQUE_CONSUME_DELAY', 0.001)),
+    'consume_max_body_bytes': int(os.environ.get('NTORQUE_CONSUME_MAX_BODY_BYTES', 0)),
+    'consume_max_db_connections': int(os.environ.get('NTORQUE_CONSUME_MAX_DB_CONNECTIONS', 0)),
+    'consume_max_error_rate': float(os.environ.get('NTORQUE_CONSUME_MAX_ERROR_RATE', 0.1)),
+    'consume_max_in_flight': int(os.environ.get('NTORQUE_CONSUME_MAX_IN_FLIGHT', 1000)),
+    'consume_min_in_flight': int(os.environ.get('NTORQUE_CONSUME_MIN_IN_FLIGHT', 10)),
+    'consume_status_delay': float(os.environ.get('NTORQUE_CONSUME_STATUS_DELAY', 0)),
+    'consume_target_latency': float(os.environ.get('NTORQUE_CONSUME_TARGET_LATENCY', 5)),
     'consume_timeout': int(os.environ.get('NTORQUE_CONSUME_TIMEOUT', 10)),
+    'fair_quantum': int(os.environ.get('NTORQUE_FAIR_QUANTUM', 1)),
+    'fair_refresh_interval': float(os.environ.get('NTORQUE_FAIR_REFRESH_INTERVAL', 10)),
+    'fair_scheduling': os.environ.get('NTORQUE_FAIR_SCHEDULING', False),
+    'fair_slot_ttl': int(os.environ.get('NTORQUE_FAIR_SLOT_TTL', 300)),
+    'metrics_interval': float(os.environ.get('NTORQUE_METRICS_INTERVAL', 60)),
+    'rebuild_auto': os.environ.get('NTORQUE_REBUILD_AUTO', True),
+    'rebuild_batch_size': int(os.environ.get('NTORQUE_REBUILD_BATCH_SIZE', 1000)),
+    'rebuild_rate': float(os.environ.get('NTORQUE_REBUILD_RATE', 10000)),
+    'requeue_batch_size': int(os.environ.get('NTORQUE_REQUEUE_BATCH_SIZE', 99)),
+    'requeue_high_water': int(os.environ.get('NTORQUE_REQUEUE_HIGH_WATER', 100000)),
     'requeue_interval': os.environ.get('NTORQUE_REQUEUE_INTERVAL', 5),
+    'schedule_interval': float(os.environ.get('NTORQUE_SCHEDULE_INTERVAL', 0.5)),
+    'stream_claim_idle': int(os.environ.get('NTORQUE_STREAM_CLAIM_IDLE', 30)),
+    'transport': os.environ.get('NTORQUE_TRANSPORT', 'list'),
 }
 
 class Bootstrap(object):
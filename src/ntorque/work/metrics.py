@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+
+"""Provides ``Metrics``, an in-process registry of counters, gauges and
+  timings that the worker processes record to, and ``MetricsReporter``, which
+  periodically logs them and, when the process is run under the newrelic
+  agent, records them as custom metrics::
+
+      >>> metrics = Metrics()
+      >>> metrics.incr('consume.received')
+      >>> metrics.incr('consume.received', 2)
+      >>> metrics.gauge('consume.in_flight', 7)
+      >>> metrics.timing('consume.pop', 0.5)
+      >>> metrics.timing('consume.pop', 1.5)
+      >>> snapshot = metrics.snapshot()
+      >>> snapshot['consume.received'], snapshot['consume.in_flight']
+      (3, 7)
+      >>> snapshot['consume.pop.count'], snapshot['consume.pop.mean']
+      (2, 1.0)
+
+  Counters are cumulative, whereas timings are reset by each snapshot.
+"""
+
+__all__ = [
+    'Metrics',
+    'MetricsReporter',
+    'registry',
+]
+
+import logging
+logger = logging.getLogger(__name__)
+
+import threading
+import time
+
+try: # The newrelic agent is optional.
+    import newrelic.agent
+except ImportError: # pragma: no cover
+    newrelic = None
+
+class Metrics(object):
+    """Thread safe counters, gauges and timings, keyed by name."""
+
+    def __init__(self, **kwargs):
+        self.lock = kwargs.get('lock_cls', threading.Lock)()
+        self.counters = {}
+        self.gauges = {}
+        self.timings = {}
+
+    def incr(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def gauge(self, name, value):
+        with self.lock:
+            self.gauges[name] = value
+
+    def timing(self, name, secs):
+        with self.lock:
+            count, total, maximum = self.timings.get(name, (0, 0.0, 0.0))
+            self.timings[name] = (count + 1, total + secs, max(maximum, secs))
+
+    def snapshot(self):
+        """Return a flat ``{name: value}`` dict of the current values,
+          resetting the timings.
+        """
+
+        with self.lock:
+            values = dict(self.counters)
+            values.update(self.gauges)
+            for name, (count, total, maximum) in self.timings.items():
+                values['{0}.count'.format(name)] = count
+                values['{0}.mean'.format(name)] = total / count
+                values['{0}.max'.format(name)] = maximum
+            self.timings = {}
+        return values
+
+class MetricsReporter(object):
+    """Logs and records a snapshot of the ``metrics`` every ``interval``
+      seconds, in a (green) daemon thread.
+    """
+
+    def __init__(self, metrics, interval=60, **kwargs):
+        self.metrics = metrics
+        self.interval = interval
+        self.logger = kwargs.get('logger', logger)
+        self.newrelic = kwargs.get('newrelic', newrelic)
+        self.sleep = kwargs.get('sleep', time.sleep)
+        self.thread_cls = kwargs.get('thread_cls', threading.Thread)
+
+    def start(self):
+        if not self.interval:
+            return
+        thread = self.thread_cls(target=self.poll)
+        thread.daemon = True
+        thread.start()
+
+    def poll(self):
+        while True:
+            self.sleep(self.interval)
+            self.report()
+
+    def report(self):
+        values = self.metrics.snapshot()
+        if not values:
+            return
+        items = sorted(values.items())
+        self.logger.info(' '.join(['{0}={1}'.format(k, v) for k, v in items]))
+        if self.newrelic is not None:
+            application = self.newrelic.agent.application()
+            for name, value in items:
+                metric = 'Custom/ntorque/{0}'.format(name.replace('.', '/'))
+                self.newrelic.agent.record_custom_metric(metric, value,
+                        application=application)
+
+# The process wide registry.
+registry = Metrics()
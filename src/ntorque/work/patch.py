@@ -1,8 +1,18 @@
 # -*- coding: utf-8 -*-
 
+import os
+
 import gevent.monkey
 import gevent_psycopg2
 
 def green_threads():
+    # Select gevent's resolver, e.g.: ``ares``, before the hub is created.
+    resolver = os.environ.get('NTORQUE_DNS_RESOLVER')
+    if resolver:
+        os.environ['GEVENT_RESOLVER'] = resolver
     gevent.monkey.patch_all()
     gevent_psycopg2.monkey_patch()
+
+    # Cache dns lookups -- imported here, so it uses the patched modules.
+    from . import dns
+    dns.install()
@@ -2,9 +2,15 @@
 
 """Provides ``TaskPerformer``, a utility that aquires a task from the db,
   and performs it by making a POST request to the task's web hook url.
+
+  Requests are made using a ``requests.Session`` per web hook host, so
+  connections (and their TLS handshakes) are kept alive and reused by the
+  tasks for the same host.
 """
 
 __all__ = [
+    'MakeRequest',
+    'SessionPool',
     'TaskPerformer',
 ]
 
@@ -14,27 +20,161 @@ patch.green_threads()
 import logging
 logger = logging.getLogger(__name__)
 
+import collections
+import contextlib
+import cookielib
 import gevent
 import requests
 import socket
 import os
+import threading
+import time
+import urlparse
 
+from requests.adapters import HTTPAdapter
 from requests.exceptions import RequestException
 from sqlalchemy.exc import SQLAlchemyError
 
 from ntorque import backoff
 from ntorque import model
+from ntorque.model import instruction as instructions
+
+from .pool import WorkerPool
 
 # Configurable transient request errors.
 TRANSIENT_REQUEST_ERRORS = os.environ.get('NTORQUE_TRANSIENT_REQUEST_ERRORS',
                                                 '408,423,429,449')
 
+# How long, in seconds, to wait for a web hook that responded with a 202 to
+# asynchronously complete or fail the task before retrying it.
+DEFAULT_LEASE = int(os.environ.get('NTORQUE_DEFAULT_LEASE', 3600))
+MAX_LEASE = int(os.environ.get('NTORQUE_MAX_LEASE', 86400))
+
+# How many connections to keep alive per web hook host, how long, in seconds,
+# a host's connections can be idle before they're closed and the maximum
+# number of hosts to keep connections to. A pool size of ``0`` disables
+# connection reuse.
+HTTP_POOL_SIZE = int(os.environ.get('NTORQUE_HTTP_POOL_SIZE', 10))
+HTTP_IDLE_TIMEOUT = float(os.environ.get('NTORQUE_HTTP_IDLE_TIMEOUT', 60))
+HTTP_MAX_HOSTS = int(os.environ.get('NTORQUE_HTTP_MAX_HOSTS', 1000))
+
+# Request headers whose values are masked when they're logged.
+SECRET_HEADERS = ('ntorque-task-token',)
+
+def mask_headers(headers):
+    """Return a copy of the ``headers`` with any secrets masked, to log."""
+
+    if not headers:
+        return headers
+    return dict([(k, u'***' if k.lower() in SECRET_HEADERS else v)
+            for k, v in headers.items()])
+
+class SessionPool(object):
+    """Makes requests using a ``requests.Session`` per scheme and host, each
+      keeping up to ``pool_size`` connections alive. Sessions that haven't
+      been used for ``idle_timeout`` seconds, or the least recently used
+      beyond ``max_hosts``, are closed -- unless they're in use, as each
+      session counts the requests it's making.
+
+      The sessions don't store cookies, so tasks can't leak state to other
+      tasks for the same host.
+    """
+
+    def __init__(self, pool_size=10, idle_timeout=60, max_hosts=1000, **kwargs):
+        self.pool_size = pool_size
+        self.idle_timeout = idle_timeout
+        self.max_hosts = max_hosts
+        self.adapter_cls = kwargs.get('adapter_cls', HTTPAdapter)
+        self.lock = kwargs.get('lock_cls', threading.Lock)()
+        self.session_cls = kwargs.get('session_cls', requests.Session)
+        self.time = kwargs.get('time', time)
+        self.sessions = collections.OrderedDict()
+
+    def __call__(self, method, url, **kwargs):
+        with self.hold(url) as session:
+            return session.request(method, url, **kwargs)
+
+    @contextlib.contextmanager
+    def hold(self, url):
+        """Use the session for the ``url``'s host, creating it if necessary,
+          for the duration of the ``with`` block.
+        """
+
+        parts = urlparse.urlsplit(url)
+        key = (parts.scheme.lower(), parts.netloc.lower())
+        session = self.acquire(key)
+        try:
+            yield session
+        finally:
+            self.release(key)
+
+    def acquire(self, key):
+        now = self.time.time()
+        with self.lock:
+            session, _, num_users = self.sessions.pop(key, (None, None, 0))
+            self.evict(now)
+            if session is None:
+                session = self.create()
+            self.sessions[key] = (session, now, num_users + 1)
+        return session
+
+    def release(self, key):
+        now = self.time.time()
+        with self.lock:
+            session, _, num_users = self.sessions.pop(key)
+            self.sessions[key] = (session, now, num_users - 1)
+
+    def create(self):
+        session = self.session_cls()
+        session.cookies.set_policy(cookielib.DefaultCookiePolicy(
+                allowed_domains=[]))
+        adapter = self.adapter_cls(pool_connections=1,
+                pool_maxsize=self.pool_size)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    def evict(self, now):
+        """Close the idle sessions and the least recently used sessions
+          beyond ``max_hosts``, skipping any that are in use. Must be called
+          with the lock held.
+        """
+
+        keys = []
+        excess = len(self.sessions) + 1 - self.max_hosts
+        for key, (session, last_used, num_users) in self.sessions.iteritems():
+            if num_users:
+                continue
+            is_idle = now - last_used > self.idle_timeout
+            if not is_idle and excess <= 0:
+                break
+            keys.append(key)
+            excess -= 1
+        for key in keys:
+            session, _, _ = self.sessions.pop(key)
+            session.close()
+
+def get_make_request(pool_size=HTTP_POOL_SIZE, **kwargs):
+    """Return a function to make requests with, which reuses connections
+      unless the ``pool_size`` is ``0``.
+    """
+
+    if not pool_size:
+        return requests.request
+    return SessionPool(pool_size=pool_size, **kwargs)
+
+# The process wide request function.
+make_request = get_make_request(idle_timeout=HTTP_IDLE_TIMEOUT,
+        max_hosts=HTTP_MAX_HOSTS)
+
 class MakeRequest(object):
-    """Wrap ``requests.request`` with some instrumentation."""
+    """Wrap the process wide ``make_request`` function, which reuses
+      connections per host, with some instrumentation.
+    """
 
     def __init__(self, **kwargs):
         self.log = kwargs.get('log', logger)
-        self.make_request = kwargs.get('make_request', requests.request)
+        self.make_request = kwargs.get('make_request', make_request)
         self.request_exc = kwargs.get('request_exc', RequestException)
         self.sock_timeout = kwargs.get('sock_timeout', socket.timeout)
 
@@ -56,8 +196,11 @@ class MakeRequest(object):
             except self.request_exc as err:
                 error = err
 
-        # Log appropriately.
+        # Log appropriately, without any secrets.
         key = u'torque.work.perform.request'
+        kwargs = dict(kwargs)
+        if 'headers' in kwargs:
+            kwargs['headers'] = mask_headers(kwargs['headers'])
         if error:
             self.log.warn((key, args, kwargs))
             self.log.warn(error)
@@ -70,47 +213,104 @@ class MakeRequest(object):
         return response
 
 class TaskPerformer(object):
-    """Utility that acquires and performs a task by making an HTTP request."""
+    """Utility that acquires and performs a task by making an HTTP request.
+      The ``pool`` is shared by the tasks a worker performs: it limits their
+      db connections and in-flight body bytes and records their requests'
+      latency and errors. If a ``status_writer`` is provided, task outcomes
+      are written back by it, in batches.
+
+      ``did_acquire`` is set once the acquire query has run, whether or not
+      it acquired the task, so the consumer knows whether the instruction
+      can be dropped if it's pushed again.
+    """
 
     def __init__(self, **kwargs):
         self.log = kwargs.get('log', logger)
         self.task_manager_cls = kwargs.get('task_manager_cls', model.TaskManager)
         self.backoff_cls = kwargs.get('backoff', backoff.Backoff)
+        self.decode = kwargs.get('decode', instructions.decode)
+        self.default_lease = kwargs.get('default_lease', DEFAULT_LEASE)
+        self.max_lease = kwargs.get('max_lease', MAX_LEASE)
         self.make_request = kwargs.get('make_request', MakeRequest())
+        self.pool = kwargs.get('pool', None) or WorkerPool()
         self.session = kwargs.get('session', model.Session)
         self.sleep = kwargs.get('sleep', gevent.sleep)
         self.spawn = kwargs.get('spawn', gevent.spawn)
+        self.status_writer = kwargs.get('status_writer', None)
+        self.time = kwargs.get('time', time)
         self.transient_errors = kwargs.get('transient_errors',TRANSIENT_REQUEST_ERRORS)
+        self.did_acquire = False
 
-    def __call__(self, instruction, control_flag):
+    def __call__(self, instruction, control_flag, recover=False):
         """Perform a task and close any db connections."""
 
         try:
-            return self.perform(instruction, control_flag)
+            return self.perform(instruction, control_flag, recover=recover)
         finally:
             self.session.remove()
 
-    def perform(self, instruction, control_flag):
-        """Acquire a task, perform it and update its status accordingly."""
+    def perform_claimed(self, task_data, control_flag):
+        """Perform a task that's already been acquired, e.g.: claimed in a
+          batch by the ``TaskClaimer``, and close any db connections.
+        """
 
-        # Unpack http codes and transform into an int list.
-        http_transient_request_errors = map(int, self.transient_errors.split(','))
+        task_manager = self.task_manager_cls()
+        task_manager.assign(task_data)
+        try:
+            return self.perform_acquired(task_manager, task_data, control_flag)
+        finally:
+            self.session.remove()
+
+    def perform(self, instruction, control_flag, recover=False):
+        """Acquire a task, perform it and update its status accordingly.
+          Pass ``recover=True`` for instructions reclaimed from a dead
+          consumer.
+        """
 
         # Parse the instruction to transactionally
         # get-the-task-and-incr-its-retry-count. This ensures that even if the
         # next instruction off the queue is for the same task, or if a parallel
         # worker has the same instruction, the task will only be acquired once.
+        # If the instruction carries the task's request data, it doesn't need
+        # to be read from the db.
         task_data = None
         task_manager = self.task_manager_cls()
-        task_id, retry_count = map(int, instruction.split(':'))
+        task_id, retry_count, inline_data = self.decode(instruction)
         try:
-            task_data = task_manager.acquire(task_id, retry_count)
+            with self.pool.db():
+                if inline_data is not None and not recover:
+                    task_data = task_manager.acquire_inline(task_id,
+                            retry_count, inline_data)
+                else:
+                    task_data = task_manager.acquire(task_id, retry_count,
+                            recover=recover)
+            self.did_acquire = True
         except SQLAlchemyError as err:
             logger.warn(err)
+        if task_manager.is_expired:
+            self.log.info(('NTORQUE Task expired', 'id', task_id))
+            return task_manager.statuses['expired']
         if not task_data:
             return
+        return self.perform_acquired(task_manager, task_data, control_flag)
+
+    def perform_acquired(self, task_manager, task_data, control_flag):
+        """Perform an acquired task, holding its body's bytes in the pool,
+          and update its status accordingly.
+        """
+
+        with self.pool.body(len(task_data['body'] or '')):
+            return self.perform_request(task_manager, task_data, control_flag)
+
+    def perform_request(self, task_manager, task_data, control_flag):
+        """Make the task's request and update its status accordingly."""
+
+        # Unpack http codes and transform into an int list.
+        http_transient_request_errors = map(int, self.transient_errors.split(','))
 
         # Unpack the task data.
+        task_id = task_data['id']
+        retry_count = task_data['retry_count'] - 1
         url = task_data['url']
         body = task_data['body']
         timeout = task_data['timeout']
@@ -119,13 +319,18 @@ class TaskPerformer(object):
                 task_data['enctype'], task_data['charset'])
         headers['ntorque-task-id'] = task_id
         headers['ntorque-task-retry-count'] = retry_count
-        max_retries = task_manager.due_factory.settings['max_retries']
+        max_retries = task_data['max_retries']
+        if max_retries is None:
+            max_retries = task_manager.due_factory.settings['max_retries']
         headers['ntorque-task-retry-limit'] = max_retries
+        if task_data['token']:
+            headers['ntorque-task-token'] = task_data['token']
         method = task_data['method']
 
         # Spawn a POST to the web hook in a greenlet -- so we can monitor
         # the control flag in case we want to exit whilst waiting.
         kwargs = dict(data=body, headers=headers, timeout=timeout)
+        t1 = self.time.time()
         greenlet = self.spawn(self.make_request, method, url, **kwargs)
 
         # Wait for the request to complete, checking the greenlet's progress
@@ -153,15 +358,22 @@ class TaskPerformer(object):
             code = 500
         else:
             code = response.status_code
+        is_error = code > 499 or code in http_transient_request_errors
+        self.pool.record(self.time.time() - t1, is_error=is_error)
         if code < 202:
-            status = task_manager.complete()
-        elif code > 499 or code in http_transient_request_errors:
+            status = self.resolve(task_manager, 'complete')
+        elif code == 202:
+            # The web hook is performing the task asynchronously and will
+            # complete or fail it using the task token.
+            with self.pool.db():
+                status = task_manager.lease(self.get_lease(response))
+        elif is_error:
             # XXX what we could also do here are:
             # - set a more informative status flag (even if only descriptive)
             # - noop if the greenlet request timed out
-            status = task_manager.reschedule()
+            status = self.resolve(task_manager, 'reschedule')
         else:
-            status = task_manager.fail()
+            status = self.resolve(task_manager, 'fail')
 
         # Logging to be possible to follow events in production.
         self.log.warn(
@@ -169,7 +381,29 @@ class TaskPerformer(object):
                 'status', status,
                 'url', url,
                 'code', code,
-                'headers', headers,
+                'headers', mask_headers(headers),
                 'body', body,
             ))
         return status
+
+    def resolve(self, task_manager, action):
+        """``complete``, ``fail`` or ``reschedule`` the task, using the
+          status writer, if there is one.
+        """
+
+        if self.status_writer is not None:
+            return self.status_writer.add(action, task_manager.task_id,
+                    task_manager.task_data['retry_count'])
+        with self.pool.db():
+            return getattr(task_manager, action)()
+
+    def get_lease(self, response):
+        """Read the lease duration from the ``NTORQUE-LEASE`` response header,
+          falling back on the default lease and limiting to the max lease.
+        """
+
+        try:
+            lease = int(response.headers.get('NTORQUE-LEASE', self.default_lease))
+        except (TypeError, ValueError):
+            lease = self.default_lease
+        return max(0, min(lease, self.max_lease))
@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+
+"""Provides ``WorkerPool``, which bounds how many tasks a worker performs at
+  once. Its size adapts to the web hooks, AIMD style: it grows by one task
+  for every ``window`` requests that are fast and succeed and halves when
+  they're slow or fail::
+
+      >>> pool = WorkerPool(max_size=8, min_size=2, adaptive=True, window=2,
+      ...         target_latency=1)
+      >>> pool.size
+      2
+      >>> for secs in (0.1, 0.1, 0.2, 0.1):
+      ...     pool.record(secs)
+      >>> pool.size
+      4
+      >>> pool.record(3)
+      >>> pool.record(0.1, is_error=True)
+      >>> pool.size
+      2
+
+  It also limits the number of db connections that tasks hold and the total
+  size of the request bodies in flight::
+
+      >>> pool = WorkerPool(max_size=8, max_body_bytes=100)
+      >>> pool.room(6)
+      2
+      >>> with pool.body(150):
+      ...     pool.room(0)
+      0
+      >>> pool.room(0)
+      8
+
+  A body larger than the budget is let through when nothing else is in
+  flight, so it can't block forever.
+"""
+
+__all__ = [
+    'Budget',
+    'WorkerPool',
+]
+
+import logging
+logger = logging.getLogger(__name__)
+
+import contextlib
+import threading
+
+from . import metrics
+
+class Budget(object):
+    """A counting semaphore for ``capacity`` units, e.g.: bytes. Acquiring
+      blocks until there's room, unless nothing is held. A ``capacity`` of
+      ``None`` is unlimited.
+    """
+
+    def __init__(self, capacity=None, **kwargs):
+        self.capacity = capacity
+        self.condition = kwargs.get('condition_cls', threading.Condition)()
+        self.used = 0
+
+    def is_full(self):
+        return bool(self.capacity) and self.used >= self.capacity
+
+    def acquire(self, units=1):
+        with self.condition:
+            if self.capacity:
+                while self.used and self.used + units > self.capacity:
+                    self.condition.wait()
+            self.used += units
+
+    def release(self, units=1):
+        with self.condition:
+            self.used -= units
+            self.condition.notify_all()
+
+    @contextlib.contextmanager
+    def hold(self, units=1):
+        self.acquire(units)
+        try:
+            yield
+        finally:
+            self.release(units)
+
+class WorkerPool(object):
+    """Bounds the tasks in flight to ``size``, which, if ``adaptive``, starts
+      at ``min_size`` and adapts to the mean latency and error rate of every
+      ``window`` requests, within ``min_size`` and ``max_size``. Otherwise
+      it's fixed at ``max_size``.
+
+      Tasks hold one of ``max_db_connections`` whilst they use the db and
+      their body's bytes of ``max_body_bytes`` whilst they're performed.
+    """
+
+    def __init__(self, max_size=1000, min_size=1, adaptive=False,
+            target_latency=5, max_error_rate=0.1, window=50,
+            max_db_connections=None, max_body_bytes=None, **kwargs):
+        self.max_size = max_size
+        self.min_size = min(min_size, max_size)
+        self.adaptive = adaptive
+        self.target_latency = target_latency
+        self.max_error_rate = max_error_rate
+        self.window = window
+        self.lock = kwargs.get('lock_cls', threading.Lock)()
+        self.metrics = kwargs.get('metrics', metrics.registry)
+        self.db_connections = Budget(max_db_connections, **kwargs)
+        self.body_bytes = Budget(max_body_bytes, **kwargs)
+        self.limit = float(self.min_size if adaptive else max_size)
+        self.samples = []
+
+    @property
+    def size(self):
+        return int(self.limit)
+
+    def room(self, num_in_flight):
+        """How many more tasks can be performed, given ``num_in_flight``?"""
+
+        if self.body_bytes.is_full():
+            return 0
+        return max(self.size - num_in_flight, 0)
+
+    def record(self, secs, is_error=False):
+        """Record a web hook request, adapting the size at the end of each
+          ``window``.
+        """
+
+        if not self.adaptive:
+            return
+        with self.lock:
+            self.samples.append((secs, is_error))
+            if len(self.samples) < self.window:
+                return
+            latency = sum([x for x, _ in self.samples]) / len(self.samples)
+            errors = len([x for _, x in self.samples if x])
+            self.samples = []
+            if latency > self.target_latency or \
+                    errors > self.max_error_rate * self.window:
+                self.limit = max(self.limit / 2, self.min_size)
+            else:
+                self.limit = min(self.limit + 1, self.max_size)
+        self.metrics.gauge('pool.size', self.size)
+
+    def db(self):
+        """Hold a db connection for the duration of the ``with`` block."""
+
+        return self.db_connections.hold()
+
+    def body(self, size):
+        """Hold ``size`` bytes for the duration of the ``with`` block."""
+
+        return self.body_bytes.hold(size)
@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+
+"""Provides ``QueueRebuilder``, a utility that re-pushes the instruction of
+  every pending task from the db, to rebuild the notification channels and
+  schedules after redis has lost its data, e.g.: when it's flushed or fails
+  over without persistence.
+"""
+
+__all__ = [
+    'GetRebuilder',
+    'QueueRebuilder',
+]
+
+from . import patch
+patch.green_threads()
+
+import logging
+logger = logging.getLogger(__name__)
+
+import time
+import transaction
+
+from datetime import datetime
+
+from pyramid_redis.hooks import RedisFactory
+
+from ntorque import model
+from ntorque import util
+from ntorque.model import constants
+from ntorque.model import instruction
+from ntorque.model import priority
+from ntorque.model import shard
+from ntorque.model import transport
+
+from . import main as bootstrap
+
+def get_marker_key(channel):
+    """Return the key that holds the ``run_id`` of the redis instance that
+      the channel was last rebuilt on.
+    """
+
+    return '{0}:run_id'.format(channel)
+
+class QueueRebuilder(object):
+    """Streams every pending task from the db and re-pushes its instruction,
+      in batches of ``batch_size``, at up to ``rate`` instructions a second.
+      Due tasks are pushed onto their channel and tasks that are due in the
+      future are added to their schedule.
+
+      Call ``check`` to rebuild iff a redis instance is new, i.e.: its
+      ``run_id`` doesn't match the marker set by the last rebuild, or the
+      marker is missing, as it is after a flush. A lock key means only one
+      process rebuilds at a time.
+    """
+
+    def __init__(self, redis, channel, schedule, batch_size=1000, rate=10000,
+            transport_name=constants.DEFAULT_TRANSPORT, is_fair=False,
+            shards=None, lock_ttl=3600, **kwargs):
+        self.redis = redis
+        self.channel = channel
+        self.schedule = schedule
+        self.batch_size = batch_size
+        self.rate = rate
+        self.is_fair = is_fair
+        self.shards = shards
+        self.lock_ttl = lock_ttl
+        self.encode = kwargs.get('encode', instruction.encode_text)
+        self.get_apps_key = kwargs.get('get_apps_key', priority.get_apps_key)
+        self.get_channel = kwargs.get('get_channel', priority.get_channel)
+        self.get_marker_key = kwargs.get('get_marker_key', get_marker_key)
+        self.get_notifier = kwargs.get('get_notifier', transport.get_notifier)
+        self.get_tasks = kwargs.get('get_tasks', model.GetPendingTasks())
+        self.logger = kwargs.get('logger', logger)
+        self.session = kwargs.get('session', model.Session)
+        self.time = kwargs.get('time', time)
+        self.to_timestamp = kwargs.get('to_timestamp', util.to_timestamp)
+        self.tx_manager = kwargs.get('tx_manager', transaction.manager)
+        self.utcnow = kwargs.get('utcnow', datetime.utcnow)
+        self.clients = [redis] if shards is None else shards.values()
+        self.notify = self.get_notifier(transport_name, redis=redis,
+                shards=shards)
+
+    def check(self, force=False):
+        """Rebuild if any of the redis instances is new, or if ``force``d,
+          and then mark them as rebuilt. Returns the number of instructions
+          pushed, or ``None`` if there was no need to rebuild.
+        """
+
+        # Get the instances' current run ids.
+        marker_key = self.get_marker_key(self.channel)
+        run_ids = [(x, x.info('server')['run_id']) for x in self.clients]
+        if not force and all([x.get(marker_key) == y for x, y in run_ids]):
+            return None
+
+        # Rebuild, unless another process already is.
+        lock_key = '{0}:lock'.format(marker_key)
+        if not self.redis.set(lock_key, 1, nx=True, ex=self.lock_ttl):
+            return None
+        self.logger.warn('Rebuilding the notification channels.')
+        try:
+            num_pushed = self.rebuild()
+            for client, run_id in run_ids:
+                client.set(marker_key, run_id)
+        finally:
+            self.redis.delete(lock_key)
+        self.logger.warn('Rebuilt {0} instructions.'.format(num_pushed))
+        return num_pushed
+
+    def rebuild(self):
+        """Re-push the instruction of every pending task, returning how many
+          were pushed.
+        """
+
+        num_pushed = 0
+        t1 = self.time.time()
+        try:
+            with self.tx_manager:
+                batch = []
+                for row in self.get_tasks(batch_size=self.batch_size):
+                    batch.append(row)
+                    if len(batch) < self.batch_size:
+                        continue
+                    num_pushed += self.push(batch)
+                    batch = []
+                    self.throttle(num_pushed, t1)
+                if batch:
+                    num_pushed += self.push(batch)
+        finally:
+            self.session.remove()
+        return num_pushed
+
+    def throttle(self, num_pushed, t1):
+        """Sleep for long enough to limit the push rate."""
+
+        delay = num_pushed / float(self.rate) - (self.time.time() - t1)
+        if delay > 0:
+            self.time.sleep(delay)
+
+    def push(self, rows):
+        """Push a batch of ``(id, retry_count, priority, app_id, due)`` rows,
+          using a command per channel and schedule.
+        """
+
+        # Group the instructions by channel and schedule.
+        now = self.utcnow()
+        app_ids = set()
+        instructions = {}
+        scheduled = {}
+        for id_, retry_count, task_priority, app_id, due in rows:
+            if not self.is_fair:
+                app_id = None
+            elif app_id is not None:
+                app_ids.add(app_id)
+            item = self.encode(id_, retry_count)
+            if due > now:
+                key = self.get_channel(self.schedule, task_priority,
+                        app_id=app_id)
+                redis = self.redis if self.shards is None else self.shards.get(id_)
+                scheduled.setdefault((redis, key), {})[item] = self.to_timestamp(due)
+            else:
+                key = self.get_channel(self.channel, task_priority,
+                        app_id=app_id)
+                instructions.setdefault(key, []).append(item)
+
+        # Push them.
+        if app_ids:
+            self.redis.sadd(self.get_apps_key(self.channel), *app_ids)
+        for channel, items in instructions.items():
+            self.notify(channel, *items)
+        for (redis, schedule), items in scheduled.items():
+            redis.zadd(schedule, **items)
+        return len(rows)
+
+class GetRebuilder(object):
+    """Get a ``QueueRebuilder`` for the configured redis instance(s), or
+      ``None`` for the ``postgres`` transport, which doesn't use redis.
+    """
+
+    def __init__(self, **kwargs):
+        self.get_redis = kwargs.get('get_redis', RedisFactory())
+        self.get_shards = kwargs.get('get_shards', shard.GetRedisShards())
+        self.rebuilder_cls = kwargs.get('rebuilder_cls', QueueRebuilder)
+
+    def __call__(self, config):
+        settings = config.registry.settings
+        transport_name = settings.get('ntorque.transport')
+        if transport_name == transport.POSTGRES:
+            return None
+        redis_client = self.get_redis(settings, registry=config.registry)
+        shards = self.get_shards(settings, registry=config.registry)
+        return self.rebuilder_cls(redis_client,
+                settings.get('ntorque.redis_channel'),
+                settings.get('ntorque.redis_schedule'),
+                batch_size=int(settings.get('ntorque.rebuild_batch_size')),
+                rate=float(settings.get('ntorque.rebuild_rate')),
+                transport_name=transport_name,
+                is_fair=priority.is_fair(settings), shards=shards)
+
+class ConsoleScript(object):
+    """Bootstrap the environment and rebuild the notification channels."""
+
+    def __init__(self, **kwargs):
+        self.get_config = kwargs.get('get_config', bootstrap.Bootstrap())
+        self.get_rebuilder = kwargs.get('get_rebuilder', GetRebuilder())
+        self.session = kwargs.get('session', model.Session)
+
+    def __call__(self):
+        """Get the configured registry, instantiate the rebuilder and force
+          a rebuild.
+        """
+
+        config = self.get_config()
+        rebuilder = self.get_rebuilder(config)
+        if rebuilder is None:
+            raise SystemExit('The postgres transport has nothing to rebuild.')
+        try:
+            rebuilder.check(force=True)
+        finally:
+            self.session.remove()
+
+main = ConsoleScript()
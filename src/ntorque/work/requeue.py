@@ -18,26 +18,64 @@ from datetime import datetime
 from redis.exceptions import RedisError
 from sqlalchemy.exc import SQLAlchemyError
 
+from pyramid.settings import asbool
 from pyramid_redis.hooks import RedisFactory
 
 from ntorque import model
 from ntorque import util
+from ntorque.model import constants
+from ntorque.model import instruction
+from ntorque.model import priority
+from ntorque.model import shard
+from ntorque.model import transport
 
 from . import main
+from . import metrics
+from . import rebuild
 
 class RequeuePoller(object):
-    """Polls the database for tasks that should be re-queued."""
-
-    def __init__(self, redis, channel, delay=0.001, interval=5, **kwargs):
+    """Polls the database for tasks that should be re-queued, pushing them
+      onto their priority channel using the configured ``transport``'s
+      notifier. If ``is_fair``, instructions are routed to per-application
+      sub-channels. If ``shards`` are provided, instructions are pushed onto
+      the channel on their task's shard.
+
+      If a ``rebuilder`` is provided, it's checked every poll, so the
+      notification channels are rebuilt as soon as redis loses its data.
+
+      Each poll requeues up to ``limit`` tasks, oldest due first, but no more
+      than it takes to fill the channels up to the ``high_water`` mark, so a
+      backlog (e.g.: during a webhook outage) isn't bloated with duplicate
+      instructions. Set ``high_water`` to ``0`` to disable the check.
+    """
+
+    def __init__(self, redis, channel, delay=0.001, interval=5,
+            transport_name=constants.DEFAULT_TRANSPORT, is_fair=False,
+            shards=None, limit=99, high_water=100000, **kwargs):
         self.redis = redis
         self.channel = channel
         self.delay = delay
         self.interval = interval
+        self.limit = limit
+        self.high_water = high_water
+        self.transport_name = transport_name
+        self.is_fair = is_fair
         self.call_in_process = kwargs.get('call_in_process', util.call_in_process)
+        self.encode = kwargs.get('encode', instruction.encode_text)
+        self.get_apps_key = kwargs.get('get_apps_key', priority.get_apps_key)
+        self.get_channel = kwargs.get('get_channel', priority.get_channel)
+        self.get_notifier = kwargs.get('get_notifier', transport.get_notifier)
         self.get_tasks = kwargs.get('get_tasks', model.GetDueTasks())
         self.logger = kwargs.get('logger', logger)
+        self.metrics = kwargs.get('metrics', metrics.registry)
         self.session = kwargs.get('session', model.Session)
         self.time = kwargs.get('time', time)
+        self.tx_manager = kwargs.get('tx_manager', transaction.manager)
+        self.rebuilder = kwargs.get('rebuilder', None)
+        self.notify = self.get_notifier(transport_name, redis=redis,
+                shards=shards)
+        self.get_depth = kwargs.get('get_depth', transport.QueueDepth(
+                transport_name, redis=redis, shards=shards, is_fair=is_fair))
 
     def start(self):
         self.poll()
@@ -47,12 +85,20 @@ class RequeuePoller(object):
 
         while True:
             t1 = self.time.time()
-            tasks = self.call_in_process(self.query)
+            if self.rebuilder is not None:
+                try:
+                    self.rebuilder.check()
+                except (RedisError, SQLAlchemyError) as err:
+                    self.logger.warn(err, exc_info=True)
+            tasks = None
+            limit = self.capacity()
+            if limit:
+                tasks = self.call_in_process(self.query, limit)
             if tasks:
                 for task in tasks:
                     try:
                         self.enqueue(*task)
-                    except RedisError as err:
+                    except (RedisError, SQLAlchemyError) as err:
                         self.logger.warn(err, exc_info=True)
                     self.time.sleep(self.delay)
             current_time = self.time.time()
@@ -60,22 +106,56 @@ class RequeuePoller(object):
             if current_time < due_time:
                 self.time.sleep(due_time - current_time)
 
-    def query(self):
+    def capacity(self):
+        """Return how many tasks to requeue: the ``limit``, capped at the
+          room left below the ``high_water`` mark.
+        """
+
+        if not self.high_water:
+            return self.limit
+        try:
+            depth = self.get_depth(self.channel)
+        except RedisError as err:
+            self.logger.warn(err, exc_info=True)
+            return 0
+        if depth is None:
+            return self.limit
+        self.metrics.gauge('requeue.depth', depth)
+        room = max(self.high_water - depth, 0)
+        if room < self.limit:
+            self.metrics.incr('requeue.throttled')
+            self.logger.info('Queue depth {0} is near the high water mark.'.format(
+                    depth))
+        return min(room, self.limit)
+
+    def query(self, limit):
         tasks = []
         with transaction.manager:
             try:
-                tasks = [(x.id, x.retry_count) for x in self.get_tasks()]
+                tasks = [(x.id, x.retry_count, x.priority, x.app_id)
+                        for x in self.get_tasks(limit=limit)]
             except SQLAlchemyError as err:
                 self.logger.warn(err, exc_info=True)
             finally:
                 self.session.remove()
         return tasks
 
-    def enqueue(self, id_, retry_count):
+    def enqueue(self, id_, retry_count, priority=None, app_id=None):
         """Push an instruction to re-try the task on the redis channel."""
 
-        instruction = '{0}:{1}'.format(id_, retry_count)
-        self.redis.rpush(self.channel, instruction)
+        data = self.encode(id_, retry_count)
+        if not self.is_fair:
+            app_id = None
+        elif app_id is not None:
+            self.redis.sadd(self.get_apps_key(self.channel), app_id)
+        channel = self.get_channel(self.channel, priority, app_id=app_id)
+        if not self.notify.is_transactional:
+            return self.notify(channel, data)
+        try:
+            with self.tx_manager:
+                self.notify(channel, data)
+        finally:
+            self.session.remove()
 
 class ConsoleScript(object):
     """Bootstrap the environment and run the consumer."""
@@ -83,7 +163,11 @@ class ConsoleScript(object):
     def __init__(self, **kwargs):
         self.requeue_cls = kwargs.get('requeue_cls', RequeuePoller)
         self.get_redis = kwargs.get('get_redis', RedisFactory())
+        self.get_shards = kwargs.get('get_shards', shard.GetRedisShards())
         self.get_config = kwargs.get('get_config', main.Bootstrap())
+        self.get_rebuilder = kwargs.get('get_rebuilder', rebuild.GetRebuilder())
+        self.metrics = kwargs.get('metrics', metrics.registry)
+        self.reporter_cls = kwargs.get('reporter_cls', metrics.MetricsReporter)
         self.session = kwargs.get('session', model.Session)
 
     def __call__(self):
@@ -97,13 +181,27 @@ class ConsoleScript(object):
         # Unpack the redis client and input channels.
         settings = config.registry.settings
         redis_client = self.get_redis(settings, registry=config.registry)
+        shards = self.get_shards(settings, registry=config.registry)
         channel = settings.get('ntorque.redis_channel')
+        transport_name = settings.get('ntorque.transport')
 
-        # Get the requeue interval.
+        # Get the requeue interval and backpressure settings.
         interval = int(settings.get('ntorque.requeue_interval'))
+        limit = int(settings.get('ntorque.requeue_batch_size'))
+        high_water = int(settings.get('ntorque.requeue_high_water'))
+
+        # Rebuild the channels automatically, if configured to.
+        rebuilder = None
+        if asbool(settings.get('ntorque.rebuild_auto')):
+            rebuilder = self.get_rebuilder(config)
 
         # Instantiate and start the consumer.
-        poller = self.requeue_cls(redis_client, channel, interval=interval)
+        poller = self.requeue_cls(redis_client, channel, interval=interval,
+                transport_name=transport_name,
+                is_fair=priority.is_fair(settings), shards=shards,
+                limit=limit, high_water=high_water, rebuilder=rebuilder)
+        interval = float(settings.get('ntorque.metrics_interval'))
+        self.reporter_cls(self.metrics, interval=interval).start()
         try:
             poller.start()
         finally:
@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+
+"""Provides ``ScheduleReleaser``, a utility that moves scheduled task
+  instructions from the redis schedule sorted set onto the notification
+  channel when they fall due.
+"""
+
+__all__ = [
+    'ScheduleReleaser',
+]
+
+from . import patch
+patch.green_threads()
+
+import logging
+logger = logging.getLogger(__name__)
+
+import threading
+import time
+
+from redis.exceptions import RedisError
+from pyramid_redis.hooks import RedisFactory
+
+from ntorque import model
+from ntorque.model import constants
+from ntorque.model import priority
+from ntorque.model import shard
+from ntorque.model import transport
+
+from . import main
+
+# Atomically pop up to ``ARGV[2]`` instructions scored at or before ``ARGV[1]``
+# from the schedule and push them onto the channel, or add them to the stream
+# if ``ARGV[3]`` is ``stream``. This means that parallel releasers never
+# release the same instruction twice.
+RELEASE_SCRIPT = """
+local is_stream = ARGV[3] == 'stream'
+if is_stream then
+    redis.replicate_commands()
+end
+local items = redis.call('zrangebyscore', KEYS[1], '-inf', ARGV[1],
+        'LIMIT', 0, ARGV[2])
+if #items > 0 then
+    redis.call('zrem', KEYS[1], unpack(items))
+    if is_stream then
+        for _, item in ipairs(items) do
+            redis.call('xadd', KEYS[2], '*', ARGV[4], item)
+        end
+    else
+        redis.call('rpush', KEYS[2], unpack(items))
+    end
+end
+return #items
+"""
+
+class ScheduleReleaser(object):
+    """Releases scheduled instructions onto the channel when they're due.
+
+      Sleeps until the earliest scheduled instruction is due, or for at most
+      ``interval`` seconds, so release is prompt without polling the db. Note
+      that the ``RequeuePoller`` still picks up any due tasks whose scheduled
+      instruction has been lost.
+
+      Each task priority has its own schedule, which is released onto the
+      corresponding priority channel. If ``is_fair``, so does each registered
+      application. If the channels are sharded, a releaser is run per shard.
+    """
+
+    def __init__(self, redis, schedule, channel, interval=0.5, batch_size=999,
+            transport_name=constants.DEFAULT_TRANSPORT, is_fair=False,
+            **kwargs):
+        self.redis = redis
+        self.schedule = schedule
+        self.channel = channel
+        self.interval = interval
+        self.batch_size = batch_size
+        self.transport_name = transport_name
+        self.is_fair = is_fair
+        self.get_apps_key = kwargs.get('get_apps_key', priority.get_apps_key)
+        self.get_channel = kwargs.get('get_channel', priority.get_channel)
+        self.get_stream = kwargs.get('get_stream', transport.get_stream)
+        self.logger = kwargs.get('logger', logger)
+        self.priorities = kwargs.get('priorities', constants.TASK_PRIORITIES)
+        self.time = kwargs.get('time', time)
+        self.release_script = self.redis.register_script(RELEASE_SCRIPT)
+
+    def start(self):
+        self.poll()
+
+    def poll(self):
+        """Release due instructions ad-infinitum."""
+
+        while True:
+            try:
+                num_released = self.release()
+                delay = self.next_delay() if num_released < self.batch_size else 0
+            except RedisError as err:
+                self.logger.warn(err, exc_info=True)
+                delay = self.interval
+            if delay:
+                self.time.sleep(delay)
+
+    def release(self):
+        """Release a batch of due instructions from each schedule, returning
+          how many were released in total.
+        """
+
+        num_released = 0
+        args = [self.time.time(), self.batch_size, self.transport_name,
+                transport.STREAM_FIELD]
+        for schedule, channel in self.get_keys():
+            num_released += self.release_script(keys=[schedule, channel],
+                    args=args)
+        return num_released
+
+    def next_delay(self):
+        """How long to wait before the next instruction is due, capped at
+          ``self.interval``.
+        """
+
+        delay = self.interval
+        now = self.time.time()
+        for schedule, _ in self.get_keys():
+            items = self.redis.zrange(schedule, 0, 0, withscores=True)
+            if items:
+                _, score = items[0]
+                delay = min(max(score - now, 0), delay)
+        return delay
+
+    def get_keys(self):
+        """Return a list of ``(schedule, channel)`` key pairs."""
+
+        app_ids = [None]
+        if self.is_fair:
+            app_ids += sorted(self.redis.smembers(self.get_apps_key(self.channel)))
+        keys = []
+        for app_id in app_ids:
+            for item in self.priorities:
+                schedule = self.get_channel(self.schedule, item, app_id=app_id)
+                target = self.get_channel(self.channel, item, app_id=app_id)
+                if self.transport_name == transport.STREAM:
+                    target = self.get_stream(target)
+                keys.append((schedule, target))
+        return keys
+
+class ConsoleScript(object):
+    """Bootstrap the environment and run the releaser."""
+
+    def __init__(self, **kwargs):
+        self.releaser_cls = kwargs.get('releaser_cls', ScheduleReleaser)
+        self.get_redis = kwargs.get('get_redis', RedisFactory())
+        self.get_shards = kwargs.get('get_shards', shard.GetRedisShards())
+        self.get_config = kwargs.get('get_config', main.Bootstrap())
+        self.session = kwargs.get('session', model.Session)
+        self.thread_cls = kwargs.get('thread_cls', threading.Thread)
+
+    def __call__(self):
+        """Get the configured registry. Unpack the redis client, schedule and
+          output channel, instantiate and start the releaser.
+        """
+
+        # Get the configured registry.
+        config = self.get_config()
+
+        # Unpack the redis client, schedule and channel.
+        settings = config.registry.settings
+        redis_client = self.get_redis(settings, registry=config.registry)
+        shards = self.get_shards(settings, registry=config.registry)
+        schedule = settings.get('ntorque.redis_schedule')
+        channel = settings.get('ntorque.redis_channel')
+        interval = float(settings.get('ntorque.schedule_interval'))
+        transport_name = settings.get('ntorque.transport')
+
+        # Instantiate and start a releaser per shard.
+        clients = [redis_client] if shards is None else shards.values()
+        threads = []
+        for client in clients:
+            releaser = self.releaser_cls(client, schedule, channel,
+                    interval=interval, transport_name=transport_name,
+                    is_fair=priority.is_fair(settings))
+            threads.append(self.thread_cls(target=releaser.start))
+        try:
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            self.session.remove()
+
+main = ConsoleScript()
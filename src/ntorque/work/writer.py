@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+
+"""Provides ``StatusWriter``, which buffers the outcomes of the tasks that a
+  worker process performs for a few milliseconds and then writes them back
+  with a single ``UPDATE`` per action, rather than a transaction per task.
+
+  Each update is still conditioned on the task's ``retry_count``, so a task
+  that has been acquired again in the meantime isn't overwritten. If the
+  process dies before a buffer is flushed, its tasks are left pending and
+  are retried when they're due. Once the writer has been stopped, outcomes
+  are written as they're added, rather than buffered.
+"""
+
+__all__ = [
+    'StatusWriter',
+]
+
+import logging
+logger = logging.getLogger(__name__)
+
+import threading
+import time
+
+from sqlalchemy.exc import SQLAlchemyError
+
+from ntorque import model
+
+from . import metrics
+
+class StatusWriter(object):
+    """Buffers ``complete``, ``fail`` and ``reschedule`` actions, flushing
+      them ``delay`` seconds after the first one is added, in batches of up
+      to ``max_batch`` tasks, from a (green) daemon thread.
+    """
+
+    def __init__(self, delay=0.005, max_batch=1000, **kwargs):
+        self.delay = delay
+        self.max_batch = max_batch
+        self.condition = kwargs.get('condition_cls', threading.Condition)()
+        self.logger = kwargs.get('logger', logger)
+        self.metrics = kwargs.get('metrics', metrics.registry)
+        self.session = kwargs.get('session', model.Session)
+        self.sleep = kwargs.get('sleep', time.sleep)
+        self.statuses = kwargs.get('statuses', model.TASK_STATUSES)
+        self.task_manager_cls = kwargs.get('task_manager_cls', model.TaskManager)
+        self.thread_cls = kwargs.get('thread_cls', threading.Thread)
+        self.time = kwargs.get('time', time)
+        self.buffers = {}
+        self.num_buffered = 0
+        self.is_stopped = False
+
+    def start(self):
+        thread = self.thread_cls(target=self.run)
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        """Stop buffering and flush any buffered actions, e.g.: on shutdown."""
+
+        with self.condition:
+            self.is_stopped = True
+        self.flush()
+
+    def add(self, action, task_id, retry_count):
+        """Buffer an ``action``, or write it straight away if the writer has
+          been stopped, and return the task's resulting status.
+        """
+
+        with self.condition:
+            is_stopped = self.is_stopped
+            if not is_stopped:
+                self.buffers.setdefault(action, []).append((task_id,
+                        retry_count))
+                self.num_buffered += 1
+                self.condition.notify()
+        if is_stopped:
+            self.write(action, [(task_id, retry_count)])
+        if action == 'complete':
+            return self.statuses['completed']
+        if action == 'fail':
+            return self.statuses['failed']
+        return self.statuses['pending']
+
+    def run(self):
+        """Flush ``delay`` seconds after an action is added, ad-infinitum."""
+
+        while True:
+            with self.condition:
+                while not self.num_buffered:
+                    self.condition.wait()
+            self.sleep(self.delay)
+            self.flush()
+
+    def flush(self):
+        """Write the buffered actions, returning how many were written."""
+
+        with self.condition:
+            buffers = self.buffers
+            self.buffers = {}
+            self.num_buffered = 0
+        if not buffers:
+            return 0
+        t1 = self.time.time()
+        num_written = 0
+        for action, rows in sorted(buffers.items()):
+            for i in range(0, len(rows), self.max_batch):
+                num_written += self.write(action, rows[i:i + self.max_batch])
+        self.metrics.timing('status_writer.flush', self.time.time() - t1)
+        return num_written
+
+    def write(self, action, rows):
+        """Write a batch of ``(id, retry_count)`` rows in one statement."""
+
+        num_written = 0
+        task_manager = self.task_manager_cls()
+        try:
+            num_written = task_manager.resolve_many(action, rows)
+        except SQLAlchemyError as err:
+            self.logger.warn(err, exc_info=True)
+            self.logger.warn(u'Dropped {0} outcomes: {1}'.format(action, rows))
+            self.metrics.incr('status_writer.errors')
+        else:
+            self.metrics.incr('status_writer.commits')
+            self.metrics.incr('status_writer.rows', len(rows))
+        finally:
+            self.session.remove()
+        return num_written